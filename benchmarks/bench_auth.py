@@ -0,0 +1,58 @@
+"""
+Per-request overhead of authentication.
+
+Times resolving the identity of authenticated requests (decoding their bearer token) with the verified-token
+cache emptied before each request, as every request used to verify its token, and with the cache warm.
+Runs against the testing configuration (TestConfig), without touching the database.
+
+    python benchmarks/bench_auth.py --requests 20000
+"""
+
+import argparse
+import time
+
+from flask import request
+
+from firepot.factory import create_app
+
+
+def time_requests(label, app, headers, count, clear):
+    from firepot.utils import Identity, token_cache
+
+    with app.test_request_context("/auth/", headers=headers):
+        started = time.perf_counter()
+
+        for _ in range(count):
+            if clear:
+                token_cache.clear()
+
+            Identity.from_request(request)
+
+        elapsed = time.perf_counter() - started
+
+    print("{0:<12} {1:8.2f}us/request".format(label, elapsed / count * 1000000))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=20000)
+    args = parser.parse_args()
+
+    app = create_app(testing=True)
+
+    with app.app_context():
+        from firepot.utils import encode_auth_token
+
+        token = encode_auth_token(1)
+
+        if isinstance(token, bytes):
+            token = token.decode("utf-8")
+
+    headers = {'Authorization': 'Bearer {0}'.format(token)}
+
+    time_requests("no cache", app, headers, args.requests, clear=True)
+    time_requests("cached", app, headers, args.requests, clear=False)
+
+
+if __name__ == '__main__':
+    main()
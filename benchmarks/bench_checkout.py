@@ -0,0 +1,132 @@
+"""
+Throughput benchmark of /cart/checkout/ with many buyers contending for the stock of one item.
+
+Creates an item with a limited stock and users each holding it in their cart in the testing database
+(TestConfig), then checks the carts out from a number of client threads. Each cart is checked out ``--attempts``
+times at once, as a client retrying without an Idempotency-Key would. Reports the checkouts per second, the
+refused ones (409) and the retries finding an empty cart, and verifies that each buyer ordered at most once and
+that exactly the stock ordered was taken, never going below 0. Everything created is removed afterwards.
+
+    python benchmarks/bench_checkout.py --buyers 500 --clients 16 --stock 300 --amount 2 --attempts 2
+"""
+
+import argparse
+import datetime
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from firepot.factory import create_app
+from firepot.extensions import db
+
+ITEM_NAME = "Bench Checkout"
+EMAIL = "bench-checkout-{0}@firepot.ca"
+
+
+def cleanup():
+    from firepot.models import User, Item, Product, Order, OrderItem, CartItem
+
+    users = db.session.query(User.id).filter(User.email.like(EMAIL.format('%')))
+    orders = db.session.query(Order.id).filter(Order.user_id.in_(users))
+
+    OrderItem.query.filter(OrderItem.order_id.in_(orders)).delete(synchronize_session=False)
+    Order.query.filter(Order.user_id.in_(users)).delete(synchronize_session=False)
+    CartItem.query.filter(CartItem.user_id.in_(users)).delete(synchronize_session=False)
+    User.query.filter(User.email.like(EMAIL.format('%'))).delete(synchronize_session=False)
+
+    items = db.session.query(Item.id).filter(Item.name == ITEM_NAME)
+
+    Product.query.filter(Product.item_id.in_(items)).delete(synchronize_session=False)
+    Item.query.filter(Item.name == ITEM_NAME).delete(synchronize_session=False)
+    db.session.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--buyers', type=int, default=500)
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--stock', type=int, default=300)
+    parser.add_argument('--amount', type=int, default=2, help="Amount of the item in each cart.")
+    parser.add_argument('--attempts', type=int, default=2, help="Concurrent checkouts of each cart.")
+    args = parser.parse_args()
+
+    app = create_app(testing=True)
+
+    with app.app_context():
+        from firepot.models import User, Item, Product, CartItem
+        from firepot.utils import encode_auth_token
+
+        cleanup()
+
+        item = Item(name=ITEM_NAME, description="Contended item", cover_image_id=None, images=[], tags=[],
+                    stock=args.stock)
+        item.save(commit=True)
+
+        product = Product(name="{0} (1g)".format(ITEM_NAME), item_id=item.id, cost=10)
+        product.save(commit=True)
+
+        item_id, product_id = item.id, product.id
+        tokens = []
+
+        for i in range(args.buyers):
+            user = User(first_name="Bench", last_name="Checkout", email=EMAIL.format(i),
+                        phone_number="7098{0:06d}".format(i), password="bench-password",
+                        birth_date=datetime.datetime(1990, 1, 1))
+            user.save(commit=True)
+
+            CartItem(user_id=user.id, product_id=product_id, amount=args.amount).save(commit=True)
+            tokens.append(encode_auth_token(user.id))
+
+    client = app.test_client()
+    statuses = {}
+    lock = threading.Lock()
+
+    def checkout(token):
+        req = client.post("/cart/checkout/", headers={'Authorization': 'Bearer {0}'.format(token)})
+
+        if req.status_code == 200:
+            outcome = 'ordered' if req.get_json()['status'] == 'success' else 'empty'
+        else:
+            outcome = req.status_code
+
+        with lock:
+            statuses[outcome] = statuses.get(outcome, 0) + 1
+
+    try:
+        started = time.perf_counter()
+
+        with ThreadPoolExecutor(max_workers=args.clients) as executor:
+            list(executor.map(checkout, [token for token in tokens for attempt in range(args.attempts)]))
+
+        elapsed = time.perf_counter() - started
+
+        with app.app_context():
+            from firepot.models import Item, Order
+
+            stock = Item.query.get(item_id).stock
+            orders_per_user = db.session.query(db.func.count(Order.id)) \
+                .join(User, Order.user_id == User.id) \
+                .filter(User.email.like(EMAIL.format('%'))) \
+                .group_by(Order.user_id).all()
+    finally:
+        with app.app_context():
+            cleanup()
+
+    ordered = statuses.get('ordered', 0)
+    orders = sum(count for count, in orders_per_user)
+
+    print("{0} buyers, {1} clients, stock {2}, {3} per cart, {4} attempts".format(
+        args.buyers, args.clients, args.stock, args.amount, args.attempts))
+    print("ordered {0}  refused {1}  empty {2}  {3:.1f} checkouts/s".format(
+        ordered, statuses.get(409, 0), statuses.get('empty', 0), args.buyers * args.attempts / elapsed))
+    print("stock left {0}, {1} orders".format(stock, orders))
+
+    assert orders == ordered, "orders don't match the successful checkouts"
+    assert all(count == 1 for count, in orders_per_user), "a cart was ordered more than once"
+    assert stock == args.stock - ordered * args.amount, "stock taken doesn't match the orders"
+    assert stock >= 0, "stock went below 0"
+    assert ordered == min(args.buyers, args.stock // args.amount), "checkouts refused while stock was left"
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""
+Throughput benchmark of /auth/login/ under concurrent logins.
+
+Creates a user in the testing database (TestConfig), hashed with the configured rounds, then fires logins
+from a number of client threads and reports the completed logins per second, the refused ones (503) and
+their latencies. The user is removed afterwards.
+
+    python benchmarks/bench_login.py --logins 2000 --clients 32 --rounds 10000
+"""
+
+import argparse
+import datetime
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from firepot.factory import create_app
+from firepot.extensions import db
+
+EMAIL = "bench-login@firepot.ca"
+PASSWORD = "bench-password"
+
+
+def cleanup():
+    from firepot.models import User
+
+    User.query.filter_by(email=EMAIL).delete(synchronize_session=False)
+    db.session.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--logins', type=int, default=2000)
+    parser.add_argument('--clients', type=int, default=32)
+    parser.add_argument('--rounds', type=int, default=10000)
+    args = parser.parse_args()
+
+    app = create_app(testing=True)
+    app.config['HASHING_ROUNDS'] = args.rounds
+
+    from firepot.extensions import password_hasher
+    password_hasher.init_app(app)
+
+    with app.app_context():
+        from firepot.models import User
+
+        cleanup()
+
+        User(first_name="Bench", last_name="Login", email=EMAIL, phone_number="7099999999", password=PASSWORD,
+             birth_date=datetime.datetime(1990, 1, 1)).save(commit=True)
+
+    client = app.test_client()
+    statuses = {}
+    timings = []
+    lock = threading.Lock()
+
+    def login(_):
+        started = time.perf_counter()
+        req = client.post("/auth/login/", json={'email': EMAIL, 'password': PASSWORD})
+        elapsed = (time.perf_counter() - started) * 1000
+
+        with lock:
+            statuses[req.status_code] = statuses.get(req.status_code, 0) + 1
+            timings.append(elapsed)
+
+    try:
+        started = time.perf_counter()
+
+        with ThreadPoolExecutor(max_workers=args.clients) as executor:
+            list(executor.map(login, range(args.logins)))
+
+        elapsed = time.perf_counter() - started
+    finally:
+        with app.app_context():
+            cleanup()
+
+    timings.sort()
+
+    print("{0} logins, {1} clients, {2} rounds, concurrency {3}, queue depth {4}".format(
+        args.logins, args.clients, args.rounds, password_hasher.concurrency, password_hasher.queue_depth))
+    print("ok {0}  refused {1}  {2:.1f} logins/s".format(statuses.get(200, 0), statuses.get(503, 0),
+                                                        statuses.get(200, 0) / elapsed))
+    print("latency mean {0:.2f}ms  p50 {1:.2f}ms  p95 {2:.2f}ms".format(
+        statistics.mean(timings), timings[len(timings) // 2], timings[int(len(timings) * 0.95)]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+"""
+Latency benchmark of /user/orders, paging through the history of a user with many orders.
+
+Creates a user with a number of orders of a few lines each in the testing database (TestConfig), inserted in
+bulk, then walks the whole history page by page and reports the latency of the first and of the deepest pages,
+which keyset pagination keeps alike. The query plan of a page is printed too: it scans the ``(user_id, id)``
+index, unless the user holds most of the orders table where scanning the primary key backwards is as good.
+Everything created is removed afterwards.
+
+    python benchmarks/bench_orders.py --orders 10000 --lines 3 --limit 50
+"""
+
+import argparse
+import datetime
+import statistics
+import time
+
+from firepot.factory import create_app
+from firepot.extensions import db
+
+EMAIL = "bench-orders@firepot.ca"
+ITEM_NAME = "Bench Orders"
+
+
+def cleanup():
+    from firepot.models import User, Item, Product, Order, OrderItem
+
+    users = db.session.query(User.id).filter(User.email == EMAIL)
+    orders = db.session.query(Order.id).filter(Order.user_id.in_(users))
+
+    OrderItem.query.filter(OrderItem.order_id.in_(orders)).delete(synchronize_session=False)
+    Order.query.filter(Order.user_id.in_(users)).delete(synchronize_session=False)
+    User.query.filter(User.email == EMAIL).delete(synchronize_session=False)
+
+    items = db.session.query(Item.id).filter(Item.name == ITEM_NAME)
+
+    Product.query.filter(Product.item_id.in_(items)).delete(synchronize_session=False)
+    Item.query.filter(Item.name == ITEM_NAME).delete(synchronize_session=False)
+    db.session.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--orders', type=int, default=10000)
+    parser.add_argument('--lines', type=int, default=3, help="Lines per order.")
+    parser.add_argument('--limit', type=int, default=50, help="Orders per page.")
+    args = parser.parse_args()
+
+    app = create_app(testing=True)
+
+    with app.app_context():
+        from firepot.models import User, Item, Product, Order, OrderItem
+        from firepot.utils import encode_auth_token
+
+        cleanup()
+
+        user = User(first_name="Bench", last_name="Orders", email=EMAIL, phone_number="7097999999",
+                    password="bench-password", birth_date=datetime.datetime(1990, 1, 1))
+        user.save(commit=True)
+
+        item = Item(name=ITEM_NAME, description="Ordered item", cover_image_id=None, images=[], tags=[], stock=0)
+        item.save(commit=True)
+
+        product = Product(name="{0} (1g)".format(ITEM_NAME), item_id=item.id, cost=10)
+        product.save(commit=True)
+
+        user_id, product_id = user.id, product.id
+
+        order_ids = db.session.execute(
+            Order.__table__.insert().values([{'user_id': user_id}] * args.orders).returning(Order.__table__.c.id)
+        ).scalars().all()
+
+        db.session.execute(OrderItem.__table__.insert(), [
+            dict(order_id=order_id, product_id=product_id, name=ITEM_NAME, amount=line + 1, price=10)
+            for order_id in order_ids for line in range(args.lines)
+        ])
+        db.session.commit()
+
+        db.session.execute("ANALYZE \"order\"")
+        db.session.execute("ANALYZE order_items")
+        db.session.commit()
+
+        plan = db.session.execute(
+            "EXPLAIN " + str(Order.query.filter(Order.user_id == user_id, Order.id < order_ids[-1])
+                             .order_by(Order.id.desc()).limit(args.limit + 1)
+                             .statement.compile(compile_kwargs={'literal_binds': True}))
+        ).scalars().all()
+
+        token = encode_auth_token(user_id)
+
+    client = app.test_client()
+    headers = {'Authorization': 'Bearer {0}'.format(token)}
+    timings = []
+    fetched = 0
+    cursor = None
+
+    try:
+        started = time.perf_counter()
+
+        while True:
+            url = "/user/orders?limit={0}".format(args.limit)
+
+            if cursor is not None:
+                url += "&cursor={0}".format(cursor)
+
+            page_started = time.perf_counter()
+            data = client.get(url, headers=headers).get_json()
+            timings.append((time.perf_counter() - page_started) * 1000)
+
+            fetched += len(data['payload'])
+            cursor = data['next_cursor']
+
+            if cursor is None:
+                break
+
+        elapsed = time.perf_counter() - started
+    finally:
+        with app.app_context():
+            cleanup()
+
+    print("{0} orders of {1} lines, {2} per page".format(args.orders, args.lines, args.limit))
+    print('\n'.join(plan))
+    print("{0} orders in {1} pages, {2:.1f} pages/s".format(fetched, len(timings), len(timings) / elapsed))
+
+    tenth = max(len(timings) // 10, 1)
+
+    print("page latency first 10% {0:.2f}ms  last 10% {1:.2f}ms  p95 {2:.2f}ms".format(
+        statistics.mean(timings[:tenth]), statistics.mean(timings[-tenth:]),
+        sorted(timings)[int(len(timings) * 0.95)]))
+
+    assert fetched == args.orders, "orders missing from the history"
+
+
+if __name__ == '__main__':
+    main()
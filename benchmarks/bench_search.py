@@ -0,0 +1,114 @@
+"""
+Latency benchmark of /store/search over a synthetic catalog.
+
+Fills the testing database (TestConfig) with a synthetic catalog, then times full-text searches against the
+ranked search path, and an ILIKE scan over the same rows for comparison. The synthetic rows are removed afterwards.
+
+    python benchmarks/bench_search.py --items 100000 --queries 200
+"""
+
+import argparse
+import datetime
+import random
+import statistics
+import time
+
+from firepot.factory import create_app
+from firepot.extensions import db
+
+SYLLABLES = ["ha", "ze", "ku", "sh", "le", "mon", "ber", "ry", "die", "sel", "dre", "am", "sku", "nk", "wi", "dow",
+             "coo", "kie", "ge", "la", "to", "man", "go", "pur", "ple", "sil", "ver", "ja", "ck", "sou", "blu"]
+
+random.seed(1)
+WORDS = sorted(set("".join(random.sample(SYLLABLES, 3)) for _ in range(5000)))
+TAGS = ["Sativa", "Indica", "Hybrid", "CBD", "Exotic", "Budget"]
+PREFIX = "bench-"
+
+
+def synthetic_rows(count, start_id):
+    now = datetime.datetime.utcnow()
+
+    for i in range(count):
+        name = "{0}{1} {2}".format(PREFIX, " ".join(random.sample(WORDS, 2)).title(), i)
+        description = " ".join(random.choice(WORDS) for _ in range(20))
+        keywords = " ".join(random.sample(TAGS, 2)) + " " + name + " (1g)"
+
+        yield dict(id=start_id + i, name=name, description=description), dict(
+            item_id=start_id + i, document='{"id": %d}' % (start_id + i), min_price=10, in_stock=True,
+            for_sale=True, search_text="\n".join([name, keywords, description]), search_name=name,
+            search_keywords=keywords, search_description=description, updated_at=now)
+
+
+def populate(count, batch_size=5000):
+    from firepot import catalog
+    from firepot.models import Item
+
+    start_id = (db.session.query(db.func.max(Item.id)).scalar() or 0) + 1
+    rows = list(synthetic_rows(count, start_id))
+
+    for i in range(0, count, batch_size):
+        batch = rows[i:i + batch_size]
+        db.session.execute(Item.__table__.insert(), [dict(item, cover_image_id=-1, stock=10) for item, _ in batch])
+        catalog.read_model_insert(db.session, [row for _, row in batch])
+        db.session.commit()
+
+    db.session.execute("ANALYZE catalog_read_model")
+    db.session.commit()
+
+    return start_id
+
+
+def cleanup():
+    from firepot.models import Item, CatalogReadModel
+
+    item_ids = db.session.query(Item.id).filter(Item.name.like(PREFIX + '%'))
+    CatalogReadModel.query.filter(CatalogReadModel.item_id.in_(item_ids)).delete(synchronize_session=False)
+    Item.query.filter(Item.name.like(PREFIX + '%')).delete(synchronize_session=False)
+    db.session.commit()
+
+
+def time_queries(label, queries, run):
+    timings = []
+
+    for text in queries:
+        started = time.perf_counter()
+        run(text)
+        timings.append((time.perf_counter() - started) * 1000)
+
+    timings.sort()
+
+    print("{0:<12} mean {1:7.2f}ms  p50 {2:7.2f}ms  p95 {3:7.2f}ms".format(
+        label, statistics.mean(timings), timings[len(timings) // 2], timings[int(len(timings) * 0.95)]))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--items', type=int, default=100000)
+    parser.add_argument('--queries', type=int, default=200)
+    args = parser.parse_args()
+
+    app = create_app(testing=True)
+
+    with app.app_context():
+        from firepot import search
+        from firepot.models import CatalogReadModel
+
+        cleanup()
+
+        started = time.perf_counter()
+        populate(args.items)
+        print("Inserted {0} items in {1:.1f}s".format(args.items, time.perf_counter() - started))
+
+        queries = [" ".join(random.sample(WORDS, random.choice((1, 2)))) for _ in range(args.queries)]
+
+        try:
+            time_queries("search", queries, lambda text: search.search(text, limit=20))
+            time_queries("ilike scan", queries, lambda text: CatalogReadModel.query
+                         .filter(CatalogReadModel.search_text.ilike('%' + text + '%'))
+                         .order_by(CatalogReadModel.item_id).limit(20).all())
+        finally:
+            cleanup()
+
+
+if __name__ == '__main__':
+    main()
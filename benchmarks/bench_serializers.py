@@ -0,0 +1,78 @@
+"""
+Throughput benchmark of serializing catalog items to json.
+
+Compares the hand-written ``to_dict`` chain dumped with flask's json (how items used to be serialized) against
+the compiled serializers of :mod:`firepot.serializers` and their json backend, over synthetic items.
+
+    python benchmarks/bench_serializers.py --items 5000 --rounds 10
+"""
+
+import argparse
+import random
+import time
+from types import SimpleNamespace
+
+from flask import Flask, json
+
+from firepot import serializers
+
+TAGS = ["Sativa", "Indica", "Hybrid", "CBD", "Exotic", "Budget"]
+
+
+def synthetic_items(count):
+    random.seed(1)
+
+    for i in range(count):
+        yield SimpleNamespace(
+            id=i, name="Item {0}".format(i), description="Description of item {0}".format(i) * 4, cover_image_id=i,
+            images=[SimpleNamespace(name="image_{0}_{1}".format(i, j), url="/images/{0:064x}".format(i * 10 + j),
+                                    content_type="image/png", size=random.randint(1000, 100000)) for j in range(2)],
+            tags=[SimpleNamespace(id=j, name=name) for j, name in enumerate(random.sample(TAGS, 2))],
+            products=[SimpleNamespace(name="{0}g".format(weight), item_id=i, cost=weight * 10, sale_cost=0,
+                                      stock_weight=weight) for weight in (1, 3, 7)])
+
+
+def legacy_to_dict(item):
+    return dict(
+        id=item.id,
+        name=item.name,
+        description=item.description,
+        cover_image_id=item.cover_image_id,
+        images=[dict(name=img.name, url=img.url, content_type=img.content_type, size=img.size) for img in item.images],
+        tags=[dict(id=tag.id, name=tag.name) for tag in item.tags],
+        products=[dict(name=product.name, item_id=product.item_id, cost=product.cost, sale_cost=product.sale_cost,
+                       stock_weight=product.stock_weight) for product in item.products]
+    )
+
+
+def time_rounds(label, items, rounds, run):
+    started = time.perf_counter()
+
+    for _ in range(rounds):
+        for item in items:
+            run(item)
+
+    elapsed = time.perf_counter() - started
+
+    print("{0:<12} {1:10.0f} items/s  {2:7.2f}us/item".format(
+        label, len(items) * rounds / elapsed, elapsed / (len(items) * rounds) * 1000000))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--items', type=int, default=5000)
+    parser.add_argument('--rounds', type=int, default=10)
+    args = parser.parse_args()
+
+    items = list(synthetic_items(args.items))
+
+    print("json backend: {0}".format("orjson" if serializers.orjson is not None else "json"))
+
+    with Flask(__name__).app_context():
+        time_rounds("to_dict", items, args.rounds, lambda item: json.dumps(legacy_to_dict(item)))
+        time_rounds("serializers", items, args.rounds,
+                    lambda item: serializers.dumps(serializers.ITEM.serialize(item)))
+
+
+if __name__ == '__main__':
+    main()
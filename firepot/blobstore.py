@@ -0,0 +1,138 @@
+"""
+Content-addressed storage for binary data (images) on disk.
+
+Blobs are keyed by the SHA-256 of their content, so identical uploads are stored once and a blob
+never changes once written. Files are sharded into sub folders by the first bytes of the hash.
+"""
+
+import base64
+import binascii
+import hashlib
+import logging
+import os
+import re
+import tempfile
+
+LOGGER = logging.getLogger(__name__)
+
+BLOB_URL = "/images/{0}"
+
+DEFAULT_CONTENT_TYPE = "application/octet-stream"
+
+# Raster image formats accepted from clients, anything a browser could render as a document (svg, html) isn't.
+IMAGE_CONTENT_TYPES = frozenset(("image/png", "image/jpeg", "image/gif", "image/webp"))
+
+# Signatures the content of the formats starts with, webp being checked apart as its signature isn't a prefix.
+IMAGE_SIGNATURES = (
+    (b'\x89PNG\r\n\x1a\n', "image/png"),
+    (b'\xff\xd8\xff', "image/jpeg"),
+    (b'GIF87a', "image/gif"),
+    (b'GIF89a', "image/gif"),
+)
+
+_HASH_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+_DATA_URL_PATTERN = re.compile(r'^data:(?P<content_type>[\w.+-]+/[\w.+-]+)?(;[\w-]+=[\w-]+)*;base64,', re.IGNORECASE)
+
+
+def is_blob_hash(value):
+    return isinstance(value, str) and _HASH_PATTERN.match(value) is not None
+
+
+def image_content_type(content):
+    """
+    Content type of a raster image, read from its signature rather than trusted from the client.
+    :param content: bytes of the image
+    :return: one of IMAGE_CONTENT_TYPES, or None when the content isn't an accepted image
+    """
+
+    for signature, content_type in IMAGE_SIGNATURES:
+        if content.startswith(signature):
+            return content_type
+
+    if content[:4] == b'RIFF' and content[8:12] == b'WEBP':
+        return "image/webp"
+
+    return None
+
+
+def decode_data(data):
+    """
+    Decode image data submitted by clients, either a data url (``data:image/png;base64,...``) or plain base64.
+    Data that isn't base64 at all is stored as the raw text.
+    The content type claimed by a data url is ignored, the content's own signature decides it.
+    :param data: submitted string
+    :return: (bytes, content type), the content type being DEFAULT_CONTENT_TYPE when the data isn't an accepted image
+    """
+
+    match = _DATA_URL_PATTERN.match(data)
+
+    if match is not None:
+        data = data[match.end():]
+
+    try:
+        content = base64.b64decode(data, validate=True)
+    except (binascii.Error, ValueError):
+        LOGGER.debug("Image data isn't base64, storing it as is")
+        content = data.encode('utf-8')
+
+    return content, image_content_type(content) or DEFAULT_CONTENT_TYPE
+
+
+class BlobStore(object):
+    """
+    Stores blobs under ``BLOB_FOLDER``.
+    """
+
+    def __init__(self, app=None):
+        self.root = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.root = app.config['BLOB_FOLDER']
+        os.makedirs(self.root, exist_ok=True)
+
+    def path(self, blob_hash):
+        if not is_blob_hash(blob_hash):
+            raise ValueError("Invalid blob hash {0}".format(blob_hash))
+
+        return os.path.join(self.root, blob_hash[:2], blob_hash[2:4], blob_hash)
+
+    def exists(self, blob_hash):
+        return is_blob_hash(blob_hash) and os.path.exists(self.path(blob_hash))
+
+    def size(self, blob_hash):
+        return os.path.getsize(self.path(blob_hash))
+
+    def open(self, blob_hash):
+        return open(self.path(blob_hash), 'rb')
+
+    def put(self, data):
+        """
+        Store a blob, unless one with the same content is already stored.
+        :param data: bytes to store
+        :return: hash of the blob
+        """
+        blob_hash = hashlib.sha256(data).hexdigest()
+        path = self.path(blob_hash)
+
+        if os.path.exists(path):
+            return blob_hash
+
+        folder = os.path.dirname(path)
+        os.makedirs(folder, exist_ok=True)
+
+        # Write next to the destination and rename, so a blob is never visible half written.
+        fd, temp_path = tempfile.mkstemp(dir=folder)
+
+        try:
+            with os.fdopen(fd, 'wb') as temp_file:
+                temp_file.write(data)
+
+            os.replace(temp_path, path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+        return blob_hash
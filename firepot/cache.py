@@ -0,0 +1,96 @@
+"""
+Small in-process caches shared by the application.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class LRUCache(object):
+    """
+    Thread-safe, size-bounded cache that evicts the least recently used entry once full.
+    Entries can optionally expire after ``ttl`` seconds, or at a time given when they're set.
+    """
+
+    def __init__(self, maxsize=128, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def configure(self, maxsize=None, ttl=_MISSING):
+        """
+        Change the size bound and/or expiry of the cache. Existing entries are discarded.
+        """
+        with self._lock:
+            if maxsize is not None:
+                self.maxsize = maxsize
+
+            if ttl is not _MISSING:
+                self.ttl = ttl
+
+            self._entries.clear()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key, _MISSING)
+
+            if entry is not _MISSING:
+                value, expires_at = entry
+
+                if expires_at is None or expires_at > time.time():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+
+                del self._entries[key]
+
+            self.misses += 1
+            return default
+
+    def set(self, key, value, expires_at=None):
+        """
+        :param expires_at: time (in seconds since the epoch) the entry expires at.
+            When the cache has a ``ttl`` too, the entry expires at the earliest of the two.
+        """
+        if self.ttl:
+            expires_at = min(expires_at, time.time() + self.ttl) if expires_at is not None else time.time() + self.ttl
+
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+
+        return dict(
+            size=len(self._entries),
+            maxsize=self.maxsize,
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            hit_rate=(self.hits / lookups) if lookups else 0.0
+        )
@@ -0,0 +1,629 @@
+"""
+Read side of the store catalog.
+
+Builds the item documents served by the store and inventory endpoints with a fixed number of queries,
+regardless of how many items, products, tags or images the catalog holds.
+
+Documents are kept in the denormalized ``catalog_read_model`` table, refreshed in the same transaction as
+any write to an item, product, tag or image, so the store endpoints read a single indexed table.
+
+Rendered responses are kept in an in-process snapshot cache keyed by the catalog version, which is
+bumped whenever a session commits a change to an item, product, tag or image. Each snapshot carries
+a strong ETag derived from its content, so conditional requests are answered from memory.
+
+Tag filters are answered by an in-memory inverted index of tag -> bitmap of item ids, rebuilt from
+the read model when the catalog version changes.
+"""
+
+import datetime
+import hashlib
+import itertools
+import logging
+import threading
+import time
+from collections import namedtuple
+
+from sqlalchemy import event, func, bindparam
+from sqlalchemy.orm import Session, selectinload, lazyload
+from sqlalchemy.orm.attributes import get_history
+
+from firepot import messages, serializers
+from firepot.cache import LRUCache
+from firepot.extensions import db
+from firepot.models import Item, Product, Tag, Image, CatalogReadModel, item_tags_table
+from firepot.utils import render_payload, render_raw_payload, paginate
+
+LOGGER = logging.getLogger(__name__)
+
+CATALOG_MODELS = (Item, Product, Tag, Image)
+
+snapshot_cache = LRUCache(maxsize=256)
+
+Snapshot = namedtuple('Snapshot', ['body', 'etag'])
+
+
+def make_snapshot(body):
+    """
+    Wrap a rendered response body along with its ETag.
+    The ETag is a content hash, so it agrees across workers whatever their catalog version is.
+    """
+    return Snapshot(body=body, etag=hashlib.sha256(body).hexdigest()[:32])
+
+
+class CatalogVersion(object):
+    """
+    Process wide counter identifying the current state of the catalog.
+    """
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def bump(self):
+        with self._lock:
+            self.value += 1
+            return self.value
+
+
+catalog_version = CatalogVersion()
+
+TAG_MATCH_ANY = "any"
+TAG_MATCH_ALL = "all"
+
+
+# Positions of the bits set in each byte value, for decoding bitmaps a byte at a time.
+_BYTE_BITS = [tuple(bit for bit in range(8) if value >> bit & 1) for value in range(256)]
+
+
+def ids_bitmap(item_ids):
+    """
+    Build the bitmap of a collection of item ids, bit n being set for item n.
+    Bits are set in a byte buffer turned into an int once, linear in the number of ids and the largest id.
+    """
+    item_ids = list(item_ids)
+
+    if len(item_ids) == 0:
+        return 0
+
+    buffer = bytearray(max(item_ids) // 8 + 1)
+
+    for item_id in item_ids:
+        buffer[item_id >> 3] |= 1 << (item_id & 7)
+
+    return int.from_bytes(buffer, 'little')
+
+
+def bitmap_ids(bitmap, after_id=None, limit=None):
+    """
+    Decode the item ids of a bitmap in ascending order, in a single pass over its bytes.
+    :param after_id: only ids greater than this one are decoded
+    :param limit: decoding stops once this many ids are found
+    :return: list of item ids
+    """
+    start = 0 if after_id is None else max(after_id + 1, 0)
+    bitmap >>= start
+
+    item_ids = []
+
+    for index, value in enumerate(bitmap.to_bytes((bitmap.bit_length() + 7) // 8, 'little')):
+        if value == 0:
+            continue
+
+        base = start + index * 8
+        item_ids.extend(base + bit for bit in _BYTE_BITS[value])
+
+        if limit is not None and len(item_ids) >= limit:
+            return item_ids[:limit]
+
+    return item_ids
+
+
+class VersionedIndex(object):
+    """
+    Inverted index of key -> bitmap of item ids, rebuilt by :meth:`_build` when the catalog version changes,
+    or once it is ``max_age`` seconds old.
+    Bitmaps are plain ints, bit n being set when item n is in the set, built by :func:`ids_bitmap`.
+    """
+
+    # Name of the index in the logs.
+    name = "index"
+
+    def __init__(self, max_age=None):
+        self.max_age = max_age
+
+        self.version = None
+        self.built_at = 0
+        self.bitmaps = {}
+
+        self._lock = threading.Lock()
+
+    def _is_current(self, version):
+        if self.version != version:
+            return False
+
+        return self.max_age is None or time.time() - self.built_at < self.max_age
+
+    def _build(self):
+        """
+        :return: dict of key -> bitmap
+        """
+        raise NotImplementedError()
+
+    def invalidate(self):
+        self.version = None
+
+    def get_bitmaps(self):
+        # Read the version before the catalog, as for the snapshots.
+        version = catalog_version.value
+
+        if not self._is_current(version):
+            with self._lock:
+                if not self._is_current(version):
+                    self.bitmaps = self._build()
+                    self.version = version
+                    self.built_at = time.time()
+
+                    LOGGER.debug("Rebuilt {0} of {1} keys".format(self.name, len(self.bitmaps)))
+
+        return self.bitmaps
+
+
+class TagIndex(VersionedIndex):
+    """
+    Inverted index of tag name -> bitmap of the ids of the items for sale with that tag,
+    so AND/OR queries are a couple of integer operations.
+    """
+
+    name = "tag index"
+
+    def _build(self):
+        """
+        Read the tags of every item for sale in one query.
+        """
+        tagged = {}
+
+        rows = db.session.query(item_tags_table.c.item_id, Tag.name) \
+            .join(Tag, Tag.id == item_tags_table.c.tag_id) \
+            .join(CatalogReadModel, CatalogReadModel.item_id == item_tags_table.c.item_id) \
+            .filter(CatalogReadModel.in_stock.is_(True), CatalogReadModel.for_sale.is_(True))
+
+        for item_id, name in rows:
+            tagged.setdefault(name.lower(), []).append(item_id)
+
+        return {name: ids_bitmap(item_ids) for name, item_ids in tagged.items()}
+
+    def lookup(self, tag_names, match=TAG_MATCH_ANY, after_id=None, limit=None):
+        """
+        Find the items for sale carrying the given tags.
+        :param tag_names: names of the tags, case insensitive
+        :param match: TAG_MATCH_ANY for items with any of the tags, TAG_MATCH_ALL for items with all of them
+        :param after_id: only items with a greater id are returned
+        :param limit: number of items returned, all of them when None
+        :return: sorted list of item ids
+        """
+        bitmaps = self.get_bitmaps()
+        tag_bitmaps = [bitmaps.get(name.lower(), 0) for name in tag_names]
+
+        if len(tag_bitmaps) == 0:
+            return []
+
+        result = tag_bitmaps[0]
+
+        for bitmap in tag_bitmaps[1:]:
+            if match == TAG_MATCH_ALL:
+                result &= bitmap
+            else:
+                result |= bitmap
+
+        return bitmap_ids(result, after_id=after_id, limit=limit)
+
+
+tag_index = TagIndex()
+
+
+def init_app(app):
+    snapshot_cache.configure(maxsize=app.config['CATALOG_CACHE_SIZE'], ttl=app.config['CATALOG_CACHE_TTL'])
+    tag_index.max_age = app.config['CATALOG_CACHE_TTL']
+
+
+def invalidate():
+    """
+    Drop everything cached from the catalog, for changes made behind the session's back (raw SQL).
+    """
+    snapshot_cache.clear()
+    tag_index.invalidate()
+
+
+def mark_items_changed(session, item_ids):
+    """
+    Flag items whose documents have to be refreshed when the session commits.
+    Writes made through the ORM are tracked automatically, this is for bulk statements that bypass it.
+    """
+    session.info.setdefault('catalog_items', set()).update(item_id for item_id in item_ids if item_id is not None)
+    session.info['catalog_changed'] = True
+
+
+@event.listens_for(Session, 'after_flush')
+def _track_catalog_writes(session, flush_context):
+    item_ids = set()
+    tag_ids = set()
+
+    for instance in session.new | session.dirty | session.deleted:
+        if not isinstance(instance, CATALOG_MODELS):
+            continue
+
+        if isinstance(instance, Item):
+            item_ids.add(instance.id)
+        elif isinstance(instance, Tag):
+            # Items of a deleted tag are only known from its collections, loaded by the ORM to unlink them.
+            for collection in ('items', 'tag'):
+                item_ids.update(item.id for item in instance.__dict__.get(collection, []))
+
+            tag_ids.add(instance.id)
+        else:
+            item_ids.update(get_history(instance, 'item_id').sum())
+
+    if len(item_ids) == 0 and len(tag_ids) == 0:
+        return
+
+    if len(tag_ids) > 0:
+        rows = session.connection().execute(
+            db.select([item_tags_table.c.item_id]).where(item_tags_table.c.tag_id.in_(tag_ids))
+        )
+        item_ids.update(row.item_id for row in rows)
+
+    mark_items_changed(session, item_ids)
+
+
+@event.listens_for(Session, 'before_commit')
+def _refresh_read_model(session):
+    # Commit flushes right after this hook, flushing earlier tracks the changes still pending in the session.
+    session.flush()
+
+    item_ids = session.info.pop('catalog_items', set())
+
+    if len(item_ids) > 0:
+        refresh_read_model(item_ids, session=session)
+
+
+@event.listens_for(Session, 'after_commit')
+def _bump_catalog_version(session):
+    if session.info.pop('catalog_changed', False):
+        LOGGER.debug("Catalog version bumped to {0}".format(catalog_version.bump()))
+
+
+def load_products(item_ids, session=None):
+    """
+    Load the products for a group of items with a single query.
+    :param item_ids: ids of the items to load products for
+    :param session: session to query with, defaults to the application's session
+    :return: dict of item id -> list of products, ordered by product id
+    """
+
+    products_map = {item_id: [] for item_id in item_ids}
+
+    if len(products_map) == 0:
+        return products_map
+
+    products = (session or db.session).query(Product) \
+        .filter(Product.item_id.in_(products_map.keys())).order_by(Product.id).all()
+
+    for product in products:
+        products_map[product.item_id].append(product)
+
+    return products_map
+
+
+def _catalog_query(in_stock_only, session=None):
+    query = (session or db.session).query(Item).options(
+        selectinload(Item.images),
+        selectinload(Item.tags).options(lazyload(Tag.tag)),
+    )
+
+    if in_stock_only:
+        query = query.filter(Item.stock >= 1)
+
+    return query
+
+
+def load_catalog(in_stock_only=True, item_ids=None, after_id=None, limit=None, session=None):
+    """
+    Load the items of the catalog along with their images, tags and products.
+
+    Items, images, tags and products are each fetched once, so the number of queries stays the
+    same as the catalog grows.
+    :param in_stock_only: only include items with stock available
+    :param item_ids: only load the items with these ids
+    :param after_id: only include items with an id greater than this (keyset pagination)
+    :param limit: maximum number of items to load
+    :param session: session to query with, defaults to the application's session
+    :return: list of (item, products) tuples ordered by item id
+    """
+
+    query = _catalog_query(in_stock_only, session=session)
+
+    if item_ids is not None:
+        query = query.filter(Item.id.in_(item_ids))
+
+    if after_id is not None:
+        query = query.filter(Item.id > after_id)
+
+    query = query.order_by(Item.id)
+
+    if limit is not None:
+        query = query.limit(limit)
+
+    items = query.all()
+
+    products_map = load_products([item.id for item in items], session=session)
+
+    return [(item, products_map[item.id]) for item in items]
+
+
+def iter_catalog(in_stock_only=True, batch_size=100):
+    """
+    Iterate over the whole catalog from a server side cursor, keeping only one batch of items
+    (with their images, tags and products) in memory at a time.
+    :param in_stock_only: only include items with stock available
+    :param batch_size: number of items fetched per batch
+    :return: generator of (item, products) tuples ordered by item id
+    """
+
+    items = _catalog_query(in_stock_only).order_by(Item.id) \
+        .execution_options(stream_results=True).yield_per(batch_size)
+
+    items = iter(items)
+
+    while True:
+        batch = list(itertools.islice(items, batch_size))
+
+        if len(batch) == 0:
+            return
+
+        products_map = load_products([item.id for item in batch])
+
+        for item in batch:
+            yield item, products_map[item.id]
+
+
+def read_model_row(item, products):
+    """
+    Render the read model row of an item.
+    The ``search_*`` values aren't columns, they feed the weighted search vector on PostgreSQL.
+    """
+    keywords = ' '.join([tag.name for tag in item.tags] + [product.name for product in products])
+
+    return dict(
+        item_id=item.id,
+        document=serializers.dumps(serializers.ITEM.serialize(item, products=products)).decode("utf-8"),
+        min_price=min(product.get_cost() for product in products) if len(products) > 0 else None,
+        in_stock=item.stock is not None and item.stock >= 1,
+        for_sale=len(products) > 0,
+        search_text='\n'.join([item.name or '', keywords, item.description or '']),
+        search_name=item.name or '',
+        search_keywords=keywords,
+        search_description=item.description or '',
+        updated_at=datetime.datetime.utcnow()
+    )
+
+
+SEARCH_CONFIG = 'english'
+
+_SEARCH_VALUES = ('search_name', 'search_keywords', 'search_description')
+
+
+def _search_vector():
+    """
+    tsvector of a read model row, ranking name matches over tag & product names over the description.
+    """
+    return func.setweight(func.to_tsvector(SEARCH_CONFIG, bindparam('search_name')), 'A') \
+        .op('||')(func.setweight(func.to_tsvector(SEARCH_CONFIG, bindparam('search_keywords')), 'B')) \
+        .op('||')(func.setweight(func.to_tsvector(SEARCH_CONFIG, bindparam('search_description')), 'C'))
+
+
+def read_model_insert(session, rows):
+    """
+    Insert rendered read model rows, computing their search vector where the database supports it.
+    """
+    table = CatalogReadModel.__table__
+
+    if session.connection().dialect.name == 'postgresql':
+        session.execute(table.insert().values(search_vector=_search_vector()), rows)
+        return
+
+    for row in rows:
+        for key in _SEARCH_VALUES:
+            row.pop(key)
+
+    session.execute(table.insert(), rows)
+
+
+def refresh_read_model(item_ids, session=None):
+    """
+    Re-render the read model rows of items, removing the rows of items that no longer exist.
+    Runs inside the session's current transaction, which holds the items locked until it ends: refreshes of the
+    same item take turns, each rendering what the one before it committed.
+    :param item_ids: ids of the items to refresh
+    :param session: session to refresh with, defaults to the application's session
+    """
+
+    session = session or db.session
+    item_ids = sorted(item_ids)
+
+    with session.no_autoflush:
+        # Locked in id order, so refreshes of overlapping items don't deadlock
+        session.query(Item.id).filter(Item.id.in_(item_ids)).order_by(Item.id).with_for_update().all()
+
+        rows = [read_model_row(item, products) for item, products in
+                load_catalog(in_stock_only=False, item_ids=item_ids, session=session)]
+
+    table = CatalogReadModel.__table__
+
+    session.execute(table.delete().where(table.c.item_id.in_(item_ids)))
+
+    if len(rows) > 0:
+        read_model_insert(session, rows)
+
+    LOGGER.debug("Refreshed {0} catalog read model rows".format(len(rows)))
+
+
+def rebuild_read_model(batch_size=500):
+    """
+    Re-render the whole read model, committing once per batch of items.
+    Rows are replaced batch by batch, so the store keeps serving the catalog while it is rebuilt,
+    then the rows of items that no longer exist are removed.
+    :return: number of items rendered
+    """
+
+    rendered = 0
+    query = db.session.query(Item.id).order_by(Item.id)
+
+    item_ids = [item_id for item_id, in query.limit(batch_size)]
+
+    while len(item_ids) > 0:
+        refresh_read_model(item_ids)
+        db.session.commit()
+
+        rendered += len(item_ids)
+        item_ids = [item_id for item_id, in query.filter(Item.id > item_ids[-1]).limit(batch_size)]
+
+    table = CatalogReadModel.__table__
+
+    db.session.execute(table.delete().where(~table.c.item_id.in_(db.session.query(Item.id))))
+    db.session.commit()
+
+    return rendered
+
+
+def listing_snapshot(after_id=None, limit=None):
+    """
+    Rendered store listing, served from the snapshot cache when the catalog hasn't changed since
+    it was last rendered.
+    :param after_id: keyset of the page, the id of the last item of the previous page
+    :param limit: page size, the full listing is rendered when None
+    :return: :class:`Snapshot`
+    """
+
+    # Read the version before the catalog so a write committed meanwhile is never cached as current.
+    key = (catalog_version.value, 'listing', after_id, limit)
+
+    snapshot = snapshot_cache.get(key)
+
+    if snapshot is None:
+        if limit is None:
+            body = _render_listing()
+        else:
+            body = _render_listing_page(after_id, limit)
+
+        snapshot = make_snapshot(body)
+        snapshot_cache.set(key, snapshot)
+
+    return snapshot
+
+
+def item_snapshot(item_id):
+    """
+    Rendered response for a single item, served from the snapshot cache when possible.
+    :param item_id: id of the item
+    :return: :class:`Snapshot`, or None when there's no item with that id
+    """
+
+    key = (catalog_version.value, 'item', item_id)
+
+    snapshot = snapshot_cache.get(key)
+
+    if snapshot is None:
+        document = db.session.query(CatalogReadModel.document).filter(CatalogReadModel.item_id == item_id).scalar()
+
+        if document is None:
+            return None
+
+        snapshot = make_snapshot(render_raw_payload(msg=messages.ITEM_RETRIEVED,
+                                                    raw_payload='{"item": ' + document + '}'))
+        snapshot_cache.set(key, snapshot)
+
+    return snapshot
+
+
+def items_map_json(rows):
+    """
+    Join read model documents into the json of the store's items map (item id -> item document),
+    without decoding them.
+    :param rows: iterable of (item id, document)
+    """
+    return '{' + ', '.join('"{0}": {1}'.format(item_id, document) for item_id, document in rows) + '}'
+
+
+def _listing_query():
+    return db.session.query(CatalogReadModel.item_id, CatalogReadModel.document, CatalogReadModel.for_sale) \
+        .filter(CatalogReadModel.in_stock.is_(True)).order_by(CatalogReadModel.item_id)
+
+
+def _render_listing():
+    rows = _listing_query().all()
+
+    if len(rows) == 0:
+        return render_payload(msg=messages.NO_STOCK_AVAILABLE, status="error")
+
+    items = items_map_json((row.item_id, row.document) for row in rows if row.for_sale)
+
+    return render_raw_payload(msg=messages.STORE_PRODUCTS_LIST, raw_payload='{"items": ' + items + '}')
+
+
+def _render_listing_page(after_id, limit):
+    query = _listing_query().filter(CatalogReadModel.for_sale.is_(True))
+
+    if after_id is not None:
+        query = query.filter(CatalogReadModel.item_id > after_id)
+
+    rows, next_cursor = paginate(query.limit(limit + 1).all(), limit, key=lambda row: row.item_id)
+
+    if after_id is None and len(rows) == 0:
+        return render_payload(msg=messages.NO_STOCK_AVAILABLE, status="error")
+
+    items = items_map_json((row.item_id, row.document) for row in rows)
+
+    return render_raw_payload(msg=messages.STORE_PRODUCTS_LIST, raw_payload='{"items": ' + items + '}',
+                              next_cursor=next_cursor)
+
+
+def tagged_listing_snapshot(tag_names, match=TAG_MATCH_ANY, after_id=None, limit=None):
+    """
+    Rendered store listing of the items carrying the given tags, served from the snapshot cache when possible.
+    :param tag_names: names of the tags to filter by
+    :param match: TAG_MATCH_ANY or TAG_MATCH_ALL
+    :param after_id: keyset of the page, the id of the last item of the previous page
+    :param limit: page size, all the matching items are rendered when None
+    :return: :class:`Snapshot`
+    """
+
+    tag_names = tuple(sorted(set(name.lower() for name in tag_names)))
+
+    key = (catalog_version.value, 'tags', tag_names, match, after_id, limit)
+
+    snapshot = snapshot_cache.get(key)
+
+    if snapshot is None:
+        # One more than the page, telling whether there's a next page.
+        item_ids = tag_index.lookup(tag_names, match=match, after_id=after_id,
+                                    limit=None if limit is None else limit + 1)
+
+        next_cursor = None
+
+        if limit is not None:
+            item_ids, next_cursor = paginate(item_ids, limit, key=lambda item_id: item_id)
+
+        rows = []
+
+        if len(item_ids) > 0:
+            rows = db.session.query(CatalogReadModel.item_id, CatalogReadModel.document) \
+                .filter(CatalogReadModel.item_id.in_(item_ids)).order_by(CatalogReadModel.item_id).all()
+
+        envelope = dict(next_cursor=next_cursor) if limit is not None else {}
+
+        snapshot = make_snapshot(render_raw_payload(msg=messages.STORE_PRODUCTS_LIST,
+                                                    raw_payload='{"items": ' + items_map_json(rows) + '}',
+                                                    **envelope))
+        snapshot_cache.set(key, snapshot)
+
+    return snapshot
@@ -0,0 +1,169 @@
+"""
+Command line interface of the application, available through the `flask` command.
+"""
+
+import logging
+import time
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy.orm import undefer
+
+from firepot.extensions import db
+
+LOGGER = logging.getLogger(__name__)
+
+
+@click.group('catalog')
+def catalog_cli():
+    """Manage the store catalog."""
+
+
+@catalog_cli.command('rebuild')
+@click.option('--batch-size', default=500, show_default=True, help="Items rendered per transaction.")
+@with_appcontext
+def rebuild_catalog(batch_size):
+    """Re-render the catalog read model served by the store from the items tables."""
+    from firepot import catalog
+
+    rendered = catalog.rebuild_read_model(batch_size=batch_size)
+
+    click.echo("Rendered {0} items into the catalog read model".format(rendered))
+
+
+@click.group('images')
+def images_cli():
+    """Manage stored images."""
+
+
+@images_cli.command('migrate')
+@click.option('--batch-size', default=100, show_default=True, help="Images moved per transaction.")
+@with_appcontext
+def migrate_images(batch_size):
+    """Move base64 image data stored in the database into the blob store."""
+    from firepot.models import Image
+
+    moved = 0
+
+    while True:
+        images = Image.query.options(undefer(Image.data)) \
+            .filter(Image.blob_hash.is_(None), Image.data.isnot(None)) \
+            .order_by(Image.id).limit(batch_size).all()
+
+        if len(images) == 0:
+            break
+
+        for image in images:
+            # Images saved before the content was checked are kept, served as binary data when not images
+            image.store(image.data, images_only=False)
+
+        db.session.commit()
+        moved += len(images)
+
+        click.echo("Moved {0} images".format(moved))
+
+    click.echo("Done, {0} images moved into the blob store".format(moved))
+
+
+@click.group('sessions')
+def sessions_cli():
+    """Manage login sessions."""
+
+
+@sessions_cli.command('purge')
+@click.option('--batch-size', default=1000, show_default=True, help="Sessions deleted per transaction.")
+@with_appcontext
+def purge_sessions(batch_size):
+    """Delete expired login sessions, meant to be run periodically (e.g. from cron)."""
+    from firepot.models import UserSession
+
+    purged = UserSession.purge_expired(batch_size=batch_size)
+
+    click.echo("Purged {0} expired sessions".format(purged))
+
+
+@click.group('idempotency')
+def idempotency_cli():
+    """Manage the responses kept for requests made with an Idempotency-Key."""
+
+
+@idempotency_cli.command('purge')
+@click.option('--batch-size', default=1000, show_default=True, help="Responses deleted per transaction.")
+@with_appcontext
+def purge_idempotency_keys(batch_size):
+    """Delete expired responses, meant to be run periodically (e.g. from cron)."""
+    from firepot.models import IdempotencyRecord
+
+    purged = IdempotencyRecord.purge_expired(batch_size=batch_size)
+
+    click.echo("Purged {0} expired idempotency keys".format(purged))
+
+
+@click.group('users')
+def users_cli():
+    """Manage users."""
+
+
+@users_cli.command('import')
+@click.argument('source', type=click.File('r', encoding='utf-8'))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']), default=None,
+              help="Format of the file, guessed from its extension when not given.")
+@click.option('--errors', 'errors_path', type=click.Path(dir_okay=False), default=None,
+              help="File the rows that couldn't be imported are written to [default: SOURCE.errors.jsonl].")
+@click.option('--batch-size', default=1000, show_default=True, help="Users inserted per transaction.")
+@click.option('--workers', type=int, default=None, help="Processes hashing passwords [default: cpu count].")
+@with_appcontext
+def import_users(source, fmt, errors_path, batch_size, workers):
+    """Import users from a CSV (with a header line) or JSON lines file.
+
+    Rows hold first_name, last_name, email, phone_number, password and birth_date (ISO 8601).
+    """
+    from firepot.importer import UserImporter, read_rows, FORMAT_CSV, FORMAT_JSONL
+
+    if fmt is None:
+        fmt = FORMAT_CSV if source.name.lower().endswith('.csv') else FORMAT_JSONL
+
+    if errors_path is None:
+        errors_path = "{0}.errors.jsonl".format(source.name)
+
+    def progress(stats):
+        click.echo("Imported {0} users, {1:.0f} rows/s".format(stats.imported, stats.rows_per_second))
+
+    with open(errors_path, 'w', encoding='utf-8') as errors:
+        stats = UserImporter(errors, batch_size=batch_size, workers=workers).run(read_rows(source, fmt), progress)
+
+    click.echo("Done, {0} of {1} rows imported in {2:.0f} rows/s".format(stats.imported, stats.read,
+                                                                         stats.rows_per_second))
+
+    if stats.skipped > 0:
+        click.echo("{0} rows skipped, see {1}".format(stats.skipped, errors_path))
+
+
+@click.group('jobs')
+def jobs_cli():
+    """Run background jobs."""
+
+
+@jobs_cli.command('worker')
+@click.option('--threads', default=2, show_default=True, help="Threads running jobs.")
+@click.option('--once', is_flag=True, help="Run the jobs due and exit instead of waiting for more.")
+@with_appcontext
+def jobs_worker(threads, once):
+    """Run the jobs of the outbox out of the web workers, for deployments setting JOBS_WORKERS to 0."""
+    from firepot.jobs import queue
+
+    if once:
+        click.echo("Ran {0} jobs".format(queue.run_all()))
+        return
+
+    queue.start(workers=threads)
+    click.echo("Running jobs with {0} threads, interrupt to stop".format(threads))
+
+    try:
+        while True:
+            time.sleep(60)
+            stats = queue.stats()
+            LOGGER.info("Jobs: {0} completed, {1} pending, {2} failed".format(stats['completed'], stats['pending'],
+                                                                              stats['failed_jobs']))
+    except KeyboardInterrupt:
+        queue.stop()
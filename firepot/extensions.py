@@ -3,7 +3,12 @@ from flask_hashing import Hashing
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 
+from firepot.blobstore import BlobStore
+from firepot.passwords import PasswordHasher
+
 db = SQLAlchemy()
 hashing = Hashing()
 cors = CORS()
 migrate = Migrate()
+blob_store = BlobStore()
+password_hasher = PasswordHasher()
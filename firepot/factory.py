@@ -7,7 +7,7 @@ import os
 from flask import Flask
 
 from firepot.config import Config, TestConfig
-from firepot.extensions import db, cors, hashing, migrate
+from firepot.extensions import db, cors, hashing, migrate, blob_store, password_hasher
 import logging
 import logging.handlers
 
@@ -71,11 +71,46 @@ def configure_logging(app):
 
 
 def register_blueprints(app):
-    from firepot.routes import auth_blueprint, store_blueprint, admin_blueprint
+    from firepot.routes import auth_blueprint, store_blueprint, admin_blueprint, images_blueprint, cart_blueprint, \
+        user_blueprint
 
     app.register_blueprint(auth_blueprint)
     app.register_blueprint(store_blueprint)
     app.register_blueprint(admin_blueprint)
+    app.register_blueprint(images_blueprint)
+    app.register_blueprint(cart_blueprint)
+    app.register_blueprint(user_blueprint)
+
+
+def register_request_hooks(app):
+    from firepot.utils import load_identity
+
+    app.before_request(load_identity)
+
+
+def register_error_handlers(app):
+    from firepot import messages
+    from firepot.passwords import HashingOverloaded
+    from firepot.utils import error_message
+
+    @app.errorhandler(HashingOverloaded)
+    def hashing_overloaded(error):
+        response = error_message(messages.HASHING_OVERLOADED)
+        response.status_code = 503
+        response.headers['Retry-After'] = str(error.retry_after)
+        return response
+
+
+def register_commands(app):
+    from firepot.commands import catalog_cli, images_cli, sessions_cli, users_cli, jobs_cli, \
+        idempotency_cli
+
+    app.cli.add_command(catalog_cli)
+    app.cli.add_command(images_cli)
+    app.cli.add_command(sessions_cli)
+    app.cli.add_command(users_cli)
+    app.cli.add_command(jobs_cli)
+    app.cli.add_command(idempotency_cli)
 
 
 def configure_extensions(app):
@@ -99,6 +134,16 @@ def configure_extensions(app):
     hashing.init_app(app=app)
     cors.init_app(app=app)
     migrate.init_app(app=app)
+    blob_store.init_app(app=app)
+    password_hasher.init_app(app=app)
+
+    from firepot import catalog, search, permissions, ratelimit, jobs, utils
+    catalog.init_app(app)
+    search.init_app(app)
+    permissions.init_app(app)
+    ratelimit.init_app(app)
+    jobs.init_app(app)
+    utils.init_app(app)
 
 
 def create_app(config_override=None, testing=False):
@@ -126,6 +171,12 @@ def create_app(config_override=None, testing=False):
 
     LOGGER.debug("Blueprints have been registered")
 
+    register_request_hooks(app)
+
+    register_error_handlers(app)
+
+    register_commands(app)
+
     configure_extensions(app)
 
     LOGGER.debug("Registered extensions")
@@ -0,0 +1,216 @@
+"""
+Bulk import of users from CSV or JSON lines files, used by `flask users import`.
+
+Rows are streamed from the file and checked, then duplicates are dropped. A row is a duplicate when its email
+or phone number is already taken, by an existing user or by an earlier row. The remaining rows are inserted in
+batches with a single executemany per batch, their passwords hashed on a pool of processes. Rows that can't be
+imported are written to an error file, one JSON object per line, with the reason they were skipped.
+"""
+
+import csv
+import datetime
+import json
+import logging
+import math
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from uuid import uuid4
+
+from sqlalchemy.exc import IntegrityError
+
+from firepot.extensions import db, password_hasher
+from firepot.models import User
+from firepot.passwords import hash_password
+
+LOGGER = logging.getLogger(__name__)
+
+FORMAT_CSV = "csv"
+FORMAT_JSONL = "jsonl"
+
+FIELDS = ('first_name', 'last_name', 'email', 'phone_number', 'password', 'birth_date')
+
+
+class ImportStats(object):
+
+    def __init__(self):
+        self.read = 0
+        self.imported = 0
+        self.skipped = 0
+        self.started = time.perf_counter()
+
+    @property
+    def rows_per_second(self):
+        elapsed = time.perf_counter() - self.started
+        return self.read / elapsed if elapsed > 0 else 0.0
+
+
+def read_rows(stream, fmt):
+    """
+    Read the rows of a file.
+    :param fmt: :data:`FORMAT_CSV` (with a header line) or :data:`FORMAT_JSONL`
+    :return: generator of (line number, row dict), the row being None when its line can't be parsed
+    """
+    if fmt == FORMAT_CSV:
+        reader = csv.DictReader(stream)
+
+        for row in reader:
+            yield reader.line_num, row
+
+        return
+
+    for line_number, line in enumerate(stream, start=1):
+        if line.strip() == '':
+            continue
+
+        try:
+            row = json.loads(line)
+        except ValueError:
+            row = None
+
+        yield line_number, row if isinstance(row, dict) else None
+
+
+def check_row(row):
+    """
+    :return: (column values of the user, None) or (None, reason the row is invalid)
+    """
+    if row is None:
+        return None, "Unreadable row"
+
+    values = {field: str(row.get(field) or '').strip() for field in FIELDS}
+
+    missing = [field for field in FIELDS if values[field] == '']
+
+    if len(missing) > 0:
+        return None, "Missing {0}".format(', '.join(missing))
+
+    try:
+        values['birth_date'] = datetime.datetime.fromisoformat(values['birth_date'])
+    except ValueError:
+        return None, "Invalid birth_date"
+
+    # Passwords are taken as they are, surrounding spaces included.
+    values['password'] = str(row['password'])
+
+    return values, None
+
+
+def _hash_passwords(passwords, method, rounds):
+    return [hash_password(password, salt, method, rounds) for password, salt in passwords]
+
+
+class UserImporter(object):
+    """
+    :param errors: text stream the rows that couldn't be imported are written to
+    :param batch_size: users inserted per statement and transaction
+    :param workers: processes hashing passwords, hashed in this process when 0
+    """
+
+    def __init__(self, errors, batch_size=1000, workers=None):
+        self.errors = errors
+        self.batch_size = batch_size
+        self.workers = os.cpu_count() if workers is None else workers
+
+        self.stats = ImportStats()
+
+        self._emails = set()
+        self._phone_numbers = set()
+        self._executor = None
+
+    def _skip(self, line_number, row, error):
+        self.stats.skipped += 1
+
+        email = row.get('email') if isinstance(row, dict) else None
+
+        self.errors.write(json.dumps({'line': line_number, 'email': email, 'error': error}) + '\n')
+
+    def _hash(self, rows):
+        passwords = [(row.pop('password'), row['salt_code']) for line_number, row in rows]
+        method, rounds = password_hasher.method, password_hasher.rounds
+
+        if self._executor is None:
+            return _hash_passwords(passwords, method, rounds)
+
+        chunk_size = math.ceil(len(passwords) / (self.workers * 4))
+        chunks = [passwords[i:i + chunk_size] for i in range(0, len(passwords), chunk_size)]
+
+        return [password for chunk in self._executor.map(_hash_passwords, chunks, repeat(method), repeat(rounds))
+                for password in chunk]
+
+    def _insert(self, rows):
+        for line_number, row in rows:
+            row['salt_code'] = str(uuid4()).strip('-')
+
+        for (line_number, row), password in zip(rows, self._hash(rows)):
+            row.update(password=password, password_rounds=password_hasher.rounds, permissions_version=0)
+
+        try:
+            db.session.execute(User.__table__.insert(), [row for line_number, row in rows])
+            db.session.commit()
+            self.stats.imported += len(rows)
+            return
+        except IntegrityError:
+            db.session.rollback()
+            LOGGER.warning("Batch of users conflicts with users created meanwhile, inserting them one by one")
+
+        for line_number, row in rows:
+            try:
+                db.session.execute(User.__table__.insert(), row)
+                db.session.commit()
+                self.stats.imported += 1
+            except IntegrityError:
+                db.session.rollback()
+                self._skip(line_number, row, "Already exists")
+
+    def run(self, rows, progress=None):
+        """
+        Import users.
+        :param rows: iterable of (line number, row dict), see :func:`read_rows`
+        :param progress: called with the :class:`ImportStats` after each batch
+        :return: :class:`ImportStats`
+        """
+        self._emails = {email.lower() for email, in db.session.query(User.email)}
+        self._phone_numbers = {phone_number for phone_number, in db.session.query(User.phone_number)}
+
+        if self.workers > 0:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+
+        batch = []
+
+        try:
+            for line_number, row in rows:
+                self.stats.read += 1
+
+                values, error = check_row(row)
+
+                if error is None and values['email'].lower() in self._emails:
+                    error = "Duplicate email"
+                elif error is None and values['phone_number'] in self._phone_numbers:
+                    error = "Duplicate phone_number"
+
+                if error is not None:
+                    self._skip(line_number, row, error)
+                    continue
+
+                self._emails.add(values['email'].lower())
+                self._phone_numbers.add(values['phone_number'])
+
+                batch.append((line_number, values))
+
+                if len(batch) >= self.batch_size:
+                    self._insert(batch)
+                    batch = []
+
+                    if progress is not None:
+                        progress(self.stats)
+
+            if len(batch) > 0:
+                self._insert(batch)
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+        return self.stats
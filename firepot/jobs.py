@@ -0,0 +1,309 @@
+"""
+Background jobs, for the work following a request that doesn't have to hold up its response.
+
+Jobs are rows of the ``jobs`` outbox table, added by :func:`enqueue` to the session of the request: a job exists
+if and only if the transaction asking for it commits, and it survives a crash of the worker process. Once that
+transaction commits, jobs are run by a pool of threads of the worker process, or by ``flask jobs worker`` in a
+process of its own when JOBS_WORKERS is 0.
+
+Runners claim jobs with ``SELECT ... FOR UPDATE SKIP LOCKED``, so any number of them share the table without
+running a job twice. A claim leases the job by pushing its ``run_at`` forward, so the job of a runner that dies
+is run again once its lease is over. A job runs in a transaction of its own, which deletes it when it succeeds.
+Failing jobs are retried with exponential backoff, up to JOBS_MAX_ATTEMPTS, then kept in the table as failed.
+"""
+
+import datetime
+import json
+import logging
+import os
+import threading
+from collections import deque
+
+from sqlalchemy import event, func
+from sqlalchemy.orm import Session
+
+from firepot.extensions import db
+from firepot.models import Job
+
+LOGGER = logging.getLogger(__name__)
+
+# Job name -> function running it, called with the keyword arguments given to enqueue.
+handlers = {}
+
+
+def handler(name):
+    """
+    Decorator registering a function as the handler of a job.
+    Handlers run within an application context, their writes committed along with the deletion of their job.
+    """
+
+    def register(function):
+        handlers[name] = function
+        return function
+
+    return register
+
+
+def enqueue(name, session=None, **arguments):
+    """
+    Add a job to the session, to be run once the session commits.
+    :param arguments: json serializable keyword arguments of the handler
+    :raises ValueError: if no handler is registered for the job
+    """
+    if name not in handlers:
+        raise ValueError("Unknown job {0}".format(name))
+
+    session = session or db.session
+    now = datetime.datetime.utcnow()
+
+    session.add(Job(name=name, arguments=json.dumps(arguments), status=Job.STATUS_PENDING, attempts=0,
+                    created_at=now, run_at=now))
+    session.info['jobs_enqueued'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def _wake_runners(session):
+    if session.info.pop('jobs_enqueued', False):
+        queue.wake()
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _forget_enqueued(session, previous_transaction):
+    session.info.pop('jobs_enqueued', None)
+
+
+class JobQueue(object):
+    """
+    Runs the jobs of the outbox, from a pool of threads started in the worker process by the first commit
+    enqueuing a job, or synchronously through :meth:`run_pending`.
+    """
+
+    def __init__(self):
+        self.app = None
+
+        self.workers = 0
+        self.batch_size = 10
+        self.poll_interval = 5
+        self.max_attempts = 5
+        self.retry_delay = 10
+        self.lease = 300
+
+        self.completed = 0
+        self.retried = 0
+        self.failed = 0
+        self._latencies = deque(maxlen=1024)
+
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._threads = []
+        self._pid = None
+
+    def init_app(self, app):
+        self.app = app
+        self.workers = app.config['JOBS_WORKERS']
+        self.batch_size = app.config['JOBS_BATCH_SIZE']
+        self.poll_interval = app.config['JOBS_POLL_INTERVAL']
+        self.max_attempts = app.config['JOBS_MAX_ATTEMPTS']
+        self.retry_delay = app.config['JOBS_RETRY_DELAY']
+        self.lease = app.config['JOBS_LEASE']
+
+    def start(self, workers=None):
+        """
+        Start the runner threads of this process, if they aren't running already.
+        Threads don't survive a fork, so they are started again in a forked worker.
+        """
+        workers = self.workers if workers is None else workers
+
+        with self._lock:
+            if self._pid == os.getpid() and any(thread.is_alive() for thread in self._threads):
+                return
+
+            self._pid = os.getpid()
+            self._stopping.clear()
+            self._threads = [threading.Thread(target=self._run_forever, name="firepot-jobs-{0}".format(i),
+                                              daemon=True) for i in range(workers)]
+
+            for thread in self._threads:
+                thread.start()
+
+    def stop(self, timeout=None):
+        self._stopping.set()
+        self._wakeup.set()
+
+        for thread in self._threads:
+            thread.join(timeout)
+
+        self._threads = []
+
+    def wake(self):
+        """
+        Signal the runners that jobs were committed, starting them when needed.
+        """
+        if self.workers > 0:
+            self.start()
+
+        self._wakeup.set()
+
+    def _run_forever(self):
+        with self.app.app_context():
+            try:
+                while not self._stopping.is_set():
+                    try:
+                        ran = self.run_pending()
+                    except Exception:
+                        LOGGER.exception("Unable to claim jobs")
+                        db.session.rollback()
+                        ran = 0
+
+                    if ran == 0:
+                        self._wakeup.wait(self.poll_interval)
+                        self._wakeup.clear()
+            finally:
+                db.session.remove()
+
+    def claim(self):
+        """
+        Lease a batch of due jobs to this runner.
+        :return: list of (id, name, arguments, created_at, attempts) of the jobs claimed
+        """
+        now = datetime.datetime.utcnow()
+
+        jobs = db.session.query(Job.id, Job.name, Job.arguments, Job.created_at, Job.attempts) \
+            .filter(Job.status == Job.STATUS_PENDING, Job.run_at <= now) \
+            .order_by(Job.run_at).limit(self.batch_size) \
+            .with_for_update(skip_locked=True).all()
+
+        if len(jobs) > 0:
+            Job.query.filter(Job.id.in_([job.id for job in jobs])) \
+                .update({Job.run_at: now + datetime.timedelta(seconds=self.lease), Job.attempts: Job.attempts + 1},
+                        synchronize_session=False)
+
+        db.session.commit()
+
+        return jobs
+
+    def run_pending(self):
+        """
+        Claim and run a batch of due jobs.
+        :return: number of jobs run
+        """
+        jobs = self.claim()
+
+        for job in jobs:
+            self._run(job)
+
+        return len(jobs)
+
+    def run_all(self):
+        """
+        Run due jobs until there are none left.
+        :return: number of jobs run
+        """
+        ran = 0
+
+        while True:
+            batch = self.run_pending()
+            ran += batch
+
+            if batch == 0:
+                return ran
+
+    def _run(self, job):
+        attempt = job.attempts + 1
+
+        with self._lock:
+            self._latencies.append((datetime.datetime.utcnow() - job.created_at).total_seconds())
+
+        try:
+            function = handlers.get(job.name)
+
+            if function is None:
+                raise LookupError("No handler for job {0}".format(job.name))
+
+            function(**json.loads(job.arguments))
+
+            Job.query.filter(Job.id == job.id).delete(synchronize_session=False)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            self._retry(job, attempt, e)
+            return
+
+        with self._lock:
+            self.completed += 1
+
+    def _retry(self, job, attempt, error):
+        values = {Job.last_error: "{0}: {1}".format(type(error).__name__, error)}
+
+        if attempt >= self.max_attempts:
+            LOGGER.exception("Job {0} {1} failed for good after {2} attempts".format(job.name, job.id, attempt))
+            values[Job.status] = Job.STATUS_FAILED
+        else:
+            delay = self.retry_delay * 2 ** (attempt - 1)
+            LOGGER.warning("Job {0} {1} failed, retrying in {2}s".format(job.name, job.id, delay), exc_info=True)
+            values[Job.run_at] = datetime.datetime.utcnow() + datetime.timedelta(seconds=delay)
+
+        Job.query.filter(Job.id == job.id).update(values, synchronize_session=False)
+        db.session.commit()
+
+        with self._lock:
+            if attempt >= self.max_attempts:
+                self.failed += 1
+            else:
+                self.retried += 1
+
+    def stats(self):
+        """
+        Counters of this process, along with the depth of the queue shared by all runners.
+        Latency is the time jobs waited, from their enqueuing to the start of their latest attempt.
+        """
+        depth = dict(db.session.query(Job.status, func.count(Job.id)).group_by(Job.status).all())
+
+        with self._lock:
+            latencies = sorted(self._latencies)
+            completed, retried, failed = self.completed, self.retried, self.failed
+
+        return dict(
+            workers=len([thread for thread in self._threads if thread.is_alive()]),
+            pending=depth.get(Job.STATUS_PENDING, 0),
+            failed_jobs=depth.get(Job.STATUS_FAILED, 0),
+            completed=completed,
+            retried=retried,
+            failed=failed,
+            latency_mean=sum(latencies) / len(latencies) if latencies else 0.0,
+            latency_p95=latencies[int(len(latencies) * 0.95)] if latencies else 0.0
+        )
+
+
+queue = JobQueue()
+
+
+def init_app(app):
+    queue.init_app(app)
+
+
+ORDER_CONFIRMATION = "order_confirmation"
+
+
+@handler(ORDER_CONFIRMATION)
+def render_order_confirmation(order_id):
+    """
+    Render the confirmation of an order placed at checkout.
+    There's no mailer yet, the confirmation is logged.
+    """
+    from firepot.models import Order, User
+
+    order = Order.query.get(order_id)
+
+    if order is None:
+        LOGGER.warning("Order {0} to confirm no longer exists".format(order_id))
+        return
+
+    user = User.query.get(order.user_id)
+
+    lines = ["{0} x {1} at {2}".format(line.amount, line.name, line.price) for line in order.items]
+    total = sum(line.amount * line.price for line in order.items)
+
+    LOGGER.info("Confirmation of order {0} to {1}:\n{2}\nTotal {3}".format(order.id, user.email, '\n'.join(lines),
+                                                                          total))
@@ -6,6 +6,11 @@ EMAIL_ALREADY_CLAIMED = "This email has already been claimed. Try another one."
 REGISTRATION_SUCCESSFUL = "Registration Successful"
 LOGIN_FAILED = "Login Failed. Check your email & password then try again."
 LOGIN_SUCCESS = "Login Successful."
+RATE_LIMITED = "Too many requests, try again later."
+TOKEN_REFRESHED = "Token refreshed."
+NO_REFRESH_TOKEN = "No refresh token was provided."
+INVALID_REFRESH_TOKEN = "Invalid or expired refresh token, log in again."
+HASHING_OVERLOADED = "Too many logins are being processed, try again shortly."
 
 DUPLICATE_IMAGE_NAME = 'An image with that name already exists'
 DUPLICATE_PRODUCT_NAME = "Duplicate product name '{0}'"
@@ -15,9 +20,32 @@ DUPLICATE_ITEM_NAME="An item with this name already exists"
 
 ITEM_CREATED = "Item created"
 INVALID_ITEM_ID = "No item with id {0}"
+INVALID_TAG_MATCH = "Tag match must be either 'any' or 'all'"
 PRODUCT_CREATED = "Product created!"
 
 INVENTORY_LISTINGS = "Inventory Listings"
+STORE_PRODUCTS_LIST = "Store Products List"
+ITEM_RETRIEVED = "Item retrieved"
+SEARCH_RESULTS = "Search Results"
+NO_SEARCH_QUERY = "No search query was provided."
 IMAGE_SAVED = "Image Saved"
+IMAGE_NOT_FOUND = "Image not found"
+UNSUPPORTED_IMAGE = "Images must be JPEG, PNG, GIF or WebP."
 
 PRODUCT_DELETED = "Product Deleted"
+
+CART = "Cart"
+CART_UPDATED = "Cart updated"
+INVALID_CART_ITEMS = "Cart changes must be a list of items with a product_id and an amount."
+UNKNOWN_CART_PRODUCT = "One of the products doesn't exist."
+UNKNOWN_USER = "Unable to identify user"
+CART_EMPTY = "The cart is empty."
+INSUFFICIENT_STOCK = "Not enough stock left for an item in the cart."
+ORDER_PLACED = "Order placed"
+ORDERS = "Orders"
+CART_QUOTE = "Cart Quote"
+INVALID_IDEMPOTENCY_KEY = "Idempotency-Key must hold 1 to 128 characters"
+IDEMPOTENCY_KEY_REUSED = "Idempotency-Key already used for another request"
+IDEMPOTENT_REQUEST_IN_PROGRESS = "A request with this Idempotency-Key is still being processed"
+
+METRICS = "Metrics"
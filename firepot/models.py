@@ -1,12 +1,38 @@
+import datetime
+import hashlib
+import secrets
 from uuid import uuid4
 
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.dialects.postgresql import TSVECTOR
+from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.orm import deferred, selectinload, undefer
+
+from firepot import serializers, permissions
+from firepot.blobstore import BLOB_URL, IMAGE_CONTENT_TYPES, decode_data
 from firepot.database import SurrogatePK, SqlModel, Column, relationship
-from firepot.extensions import db, hashing
+from firepot.extensions import db, blob_store, password_hasher
 
 import logging
 
 LOGGER = logging.getLogger(__name__)
 
+class UnsupportedImage(Exception):
+    """
+    Raised when image data submitted by a client isn't one of the accepted raster formats.
+    """
+
+
+class InsufficientStock(Exception):
+    """
+    Raised when an item doesn't have the stock an order takes.
+    """
+
+    def __init__(self, item_id):
+        super().__init__("Insufficient stock for item {0}".format(item_id))
+        self.item_id = item_id
+
+
 class SetupRecord(SurrogatePK, SqlModel):
     __tablename__ = "firepot_setup"
 
@@ -21,7 +47,7 @@ class SetupRecord(SurrogatePK, SqlModel):
 class OrderItem(SurrogatePK, SqlModel):
     __tablename__ = "order_items"
 
-    order_id = db.Column(db.Integer, db.ForeignKey("order.id"))
+    order_id = db.Column(db.Integer, db.ForeignKey("order.id"), index=True)
     product_id = db.Column(db.Integer, db.ForeignKey("products.id"))
 
     name = db.Column(db.Text)
@@ -39,9 +65,23 @@ class OrderItem(SurrogatePK, SqlModel):
             price=price
         )
 
+    @staticmethod
+    def line_name(product, item):
+        """
+        Name of an order line, the name of the item followed by the product's.
+        """
+        return f'{item.name} {product.name}' if item is not None else product.name
+
+    def to_dict(self):
+        return serializers.ORDER_ITEM.serialize(self)
+
 
 class Order(SurrogatePK, SqlModel):
     __tablename__ = "order"
+    __table_args__ = (
+        # Serves both the lookups by user and the keyset pagination of their order history.
+        db.Index('ix_order_user_id_id', 'user_id', 'id'),
+    )
 
     user_id = db.Column(db.Integer, db.ForeignKey("user.id"))
 
@@ -52,11 +92,36 @@ class Order(SurrogatePK, SqlModel):
             user_id=user_id,
         )
 
-    def add_item(self, cart_item):
-        self.items.append(
-            OrderItem(self.id, cart_item.product_id, f'{cart_item.product.item.name} {cart_item.product.name}',
-                      cart_item.amount, cart_item.product.get_cost())
-        )
+    def to_dict(self):
+        return serializers.ORDER.serialize(self)
+
+    @classmethod
+    def history(cls, user_id, before_id=None, limit=None):
+        """
+        Orders of a user, latest first, with their totals and their lines loaded by one more query for the whole
+        page.
+        :param before_id: id of the last order of the previous page
+        :param limit: orders returned, all of them when None
+        """
+        query = cls.query.options(undefer(cls.total), selectinload(cls.items)).filter(cls.user_id == user_id)
+
+        if before_id is not None:
+            query = query.filter(cls.id < before_id)
+
+        query = query.order_by(cls.id.desc())
+
+        if limit is not None:
+            query = query.limit(limit)
+
+        return query.all()
+
+
+# Sum of the order's lines, computed by the query loading the order when undeferred.
+Order.total = deferred(
+    db.select([db.func.coalesce(db.func.sum(OrderItem.amount * OrderItem.price), 0)])
+    .where(OrderItem.order_id == Order.id)
+    .scalar_subquery()
+)
 
 
 class CartItem(SqlModel):
@@ -65,6 +130,9 @@ class CartItem(SqlModel):
     to an order when sold.
     """
     __tablename__ = "cart_items"
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'product_id', name='uq_cart_items_user_id_product_id'),
+    )
 
     id = db.Column(db.Integer, autoincrement=True, primary_key=True)
 
@@ -80,35 +148,143 @@ class CartItem(SqlModel):
         super().__init__(user_id=user_id, product_id=product_id, amount=amount)
 
     def to_dict(self):
-        return dict(
-            user_id=self.user_id,
-            product_id=self.product_id,
-            amount=self.amount
-        )
+        return serializers.CART_ITEM.serialize(self)
+
+    @classmethod
+    def _line_total(cls):
+        # In bigint, the product of an amount and a price may not fit their int columns.
+        return db.cast(cls.amount, db.BigInteger) * Product.effective_cost
+
+    @classmethod
+    def _cart_total(cls):
+        # Total of the cart on each of its lines. The sum of bigints is a numeric, cast back so totals stay integers.
+        return db.cast(db.func.sum(cls._line_total()).over(), db.BigInteger)
+
+    @classmethod
+    def load_cart(cls, user_id, lock=False):
+        """
+        Lines of a user's cart along with their products and items, priced and totaled by the database like
+        :meth:`quote`, loaded by one query.
+        :param lock: lock the cart lines until the transaction ends. PostgreSQL doesn't lock the rows of a query
+            with window functions, so the total is left out then
+        :return: list of (cart item, product, item, price, total) ordered by product id, item being None for
+            products without one, total being the cart's total repeated on each line, None when locked
+        """
+        if lock:
+            total = db.literal(None)
+        else:
+            total = cls._cart_total()
+
+        query = db.session.query(cls, Product, Item, Product.effective_cost.label('price'), total.label('total')) \
+            .join(Product, Product.id == cls.product_id) \
+            .outerjoin(Item, Item.id == Product.item_id) \
+            .filter(cls.user_id == user_id) \
+            .order_by(cls.product_id)
+
+        if lock:
+            query = query.with_for_update(of=cls)
+
+        return query.all()
+
+    @classmethod
+    def quote(cls, user_id):
+        """
+        Price a user's cart at the current costs of its products, in a single statement.
+        :return: (list of rows with product_id, amount, price and line_total, total of the cart)
+        """
+        lines = db.session.query(cls.product_id, cls.amount, Product.effective_cost.label('price'),
+                                 cls._line_total().label('line_total'), cls._cart_total().label('total')) \
+            .join(Product, Product.id == cls.product_id) \
+            .filter(cls.user_id == user_id) \
+            .order_by(cls.product_id) \
+            .all()
+
+        return lines, lines[0].total if len(lines) > 0 else 0
+
+    @classmethod
+    def upsert(cls, user_id, amounts, replace=False, commit=True):
+        """
+        Apply a batch of changes to a user's cart in one INSERT ... ON CONFLICT DO UPDATE statement.
+        :param amounts: dict of product id -> amount
+        :param replace: set the amounts of the lines already in the cart rather than adding to them,
+            lines set to 0 being removed
+        :raises sqlalchemy.exc.IntegrityError: when a product doesn't exist
+        :raises sqlalchemy.exc.DataError: when amounts added go past the range of the amount column
+        """
+        if replace:
+            removed = [product_id for product_id, amount in amounts.items() if amount == 0]
+            amounts = {product_id: amount for product_id, amount in amounts.items() if amount != 0}
+
+            if len(removed) > 0:
+                cls.query.filter(cls.user_id == user_id, cls.product_id.in_(removed)) \
+                    .delete(synchronize_session=False)
+
+        if len(amounts) > 0:
+            statement = postgresql.insert(cls.__table__).values([
+                dict(user_id=user_id, product_id=product_id, amount=amount) for product_id, amount in amounts.items()
+            ])
+
+            amount = statement.excluded.amount if replace else cls.__table__.c.amount + statement.excluded.amount
+
+            statement = statement.on_conflict_do_update(
+                index_elements=[cls.__table__.c.user_id, cls.__table__.c.product_id],
+                set_=dict(amount=amount)
+            )
+
+            db.session.execute(statement)
+
+        if commit:
+            db.session.commit()
 
 
 class Image(SurrogatePK, SqlModel):
     """
     Images are used on items for display.
+    The image itself lives in the blob store, and is served by its hash from /images/<hash>.
     """
     __tablename__ = "image"
 
     name = db.Column(db.Text, unique=True)
-    data = db.Column(db.Text)
+
+    # Base64 image data of rows created before the blob store, moved out by `flask images migrate`.
+    data = deferred(db.Column(db.Text, nullable=True))
+
+    blob_hash = db.Column(db.String(64), nullable=True, index=True)
+    content_type = db.Column(db.Text, nullable=True)
+    size = db.Column(db.Integer, nullable=True)
 
     item_id = db.Column(db.Integer, db.ForeignKey("item.id"))
 
     def __init__(self, name, data):
         super().__init__(
-            name=name,
-            data=data
+            name=name
         )
 
+        self.store(data)
+
+    def store(self, data, images_only=True):
+        """
+        Move base64 image data into the blob store.
+        :param data: base64 image data, or a data url
+        :param images_only: refuse data that isn't an accepted raster image, rather than storing it as binary data
+        :raises UnsupportedImage: if the data isn't an accepted image and images_only is set
+        """
+        content, content_type = decode_data(data)
+
+        if images_only and content_type not in IMAGE_CONTENT_TYPES:
+            raise UnsupportedImage()
+
+        self.blob_hash = blob_store.put(content)
+        self.content_type = content_type
+        self.size = len(content)
+        self.data = None
+
+    @property
+    def url(self):
+        return BLOB_URL.format(self.blob_hash) if self.blob_hash is not None else None
+
     def to_dict(self):
-        return dict(
-            name=self.name,
-            data=self.data
-        )
+        return serializers.IMAGE.serialize(self)
 
 
 class Product(SurrogatePK, SqlModel):
@@ -138,29 +314,47 @@ class Product(SurrogatePK, SqlModel):
         )
 
     def to_dict(self):
-        return dict(
-            name=self.name,
-            item_id=self.item_id,
-            cost=self.cost,
-            sale_cost=self.sale_cost,
-            stock_weight=self.stock_weight
-        )
+        return serializers.PRODUCT.serialize(self)
 
     def get_item(self):
         return Item.query.filter_by(id=self.item_id).first()
 
+    @hybrid_property
+    def on_sale(self):
+        """
+        Whether the product sells at its sale cost, a sale cost of 0 (or none) meaning it isn't on sale.
+        """
+        return self.sale_cost is not None and 0 < self.sale_cost < self.cost
+
+    @on_sale.expression
+    def on_sale(cls):
+        return db.and_(cls.sale_cost > 0, cls.sale_cost < cls.cost)
+
+    @hybrid_property
+    def effective_cost(self):
+        """
+        Price the product sells at, the lowest of its cost and sale cost. Usable in queries, e.g. to sum prices.
+        """
+        return self.sale_cost if self.on_sale else self.cost
+
+    @effective_cost.expression
+    def effective_cost(cls):
+        return db.case([(cls.on_sale, cls.sale_cost)], else_=cls.cost)
+
     def get_cost(self):
         """
         Returns the lowest number of the two defined cost values for this.
         :return:
         """
-        return self.sale_cost if 0 < self.sale_cost < self.cost else self.cost
+        return self.effective_cost
 
 
 item_tags_table = db.Table(
     'item_tags',
     db.Column('item_id', db.Integer, db.ForeignKey('item.id')),
-    db.Column('tag_id', db.Integer, db.ForeignKey('tags.id'))
+    db.Column('tag_id', db.Integer, db.ForeignKey('tags.id')),
+    db.Index('ix_item_tags_tag_id_item_id', 'tag_id', 'item_id'),
+    db.Index('ix_item_tags_item_id_tag_id', 'item_id', 'tag_id')
 )
 
 
@@ -192,16 +386,75 @@ class Item(SurrogatePK, SqlModel):
             stock=stock
         )
 
-    def to_dict(self):
-        return dict(
-            id=self.id,
-            name=self.name,
-            description=self.description,
-            cover_image_id=self.cover_image_id,
-            images=[img.to_dict() for img in self.images],
-            tags=[tag.to_dict() for tag in self.tags],
-            products=[product.to_dict() for product in self.products]
-        )
+    def to_dict(self, products=None):
+        """
+        :param products: already loaded products of this item, queried when not provided.
+        """
+        return serializers.ITEM.serialize(self, products=products)
+
+    @classmethod
+    def reserve_stock(cls, quantities):
+        """
+        Take stock from items in the current transaction, each with a conditional UPDATE that only applies when
+        the item has enough stock. Items are updated in id order, so concurrent orders lock them in the same order.
+        :param quantities: dict of item id -> stock taken
+        :raises InsufficientStock: when an item lacks stock, the transaction then has to be rolled back
+        """
+        from firepot import catalog
+
+        table = cls.__table__
+        returning = db.session.connection().dialect.name == 'postgresql'
+        sold_out = []
+
+        for item_id in sorted(quantities):
+            statement = table.update() \
+                .where(table.c.id == item_id) \
+                .where(table.c.stock >= quantities[item_id]) \
+                .values(stock=table.c.stock - quantities[item_id])
+
+            if returning:
+                remaining = db.session.execute(statement.returning(table.c.stock)).scalar()
+
+                if remaining is None:
+                    raise InsufficientStock(item_id)
+
+                if remaining < 1:
+                    sold_out.append(item_id)
+            else:
+                if db.session.execute(statement).rowcount == 0:
+                    raise InsufficientStock(item_id)
+
+                sold_out.append(item_id)
+
+        # Only items going out of stock change in the catalog.
+        catalog.mark_items_changed(db.session, sold_out)
+
+
+class CatalogReadModel(SqlModel):
+    """
+    Denormalized copy of the catalog served by the store, one row per item holding its rendered document.
+    Maintained by :mod:`firepot.catalog` in the same transaction as the writes to the catalog.
+    """
+    __tablename__ = "catalog_read_model"
+    __table_args__ = (
+        db.Index('ix_catalog_read_model_listing', 'in_stock', 'item_id'),
+        db.Index('ix_catalog_read_model_search_vector', 'search_vector', postgresql_using='gin'),
+    )
+
+    item_id = db.Column(db.Integer, db.ForeignKey("item.id", ondelete="CASCADE"), primary_key=True)
+
+    document = db.Column(db.Text, nullable=False)  # json of Item.to_dict()
+
+    min_price = db.Column(db.Integer, nullable=True)  # lowest cost of the item's products
+    in_stock = db.Column(db.Boolean, nullable=False, default=False)
+    for_sale = db.Column(db.Boolean, nullable=False, default=False)  # whether the item has any products
+
+    # Item name, tags, product names and description, searched through search_vector on PostgreSQL
+    # and through an in-memory trigram index elsewhere.
+    search_text = db.Column(db.Text, nullable=False, default="")
+    search_vector = db.Column(db.Text().with_variant(TSVECTOR(), 'postgresql'), nullable=True)
+
+    updated_at = db.Column(db.DateTime, nullable=False)
 
 
 class Tag(SurrogatePK, SqlModel):
@@ -216,10 +469,7 @@ class Tag(SurrogatePK, SqlModel):
             __init__(name=name)
 
     def to_dict(self):
-        return dict(
-            id=self.id,
-            name=self.name
-        )
+        return serializers.TAG.serialize(self)
 
 
 class UserPermission(SqlModel):
@@ -281,9 +531,15 @@ class User(SurrogatePK, SqlModel):
 
     birth_date = Column(db.DateTime,nullable=False)
 
+    # Hashing rounds the password was hashed with, upgraded to HASHING_ROUNDS on login.
+    password_rounds = Column(db.Integer, nullable=False, default=1, server_default='1')
+
+    # Bumped whenever the user's permissions change, see firepot.permissions.
+    permissions_version = Column(db.Integer, nullable=False, default=0, server_default='0')
+
     def __init__(self, first_name, last_name, email, phone_number, password,birth_date):
         salt_code = str(uuid4()).strip('-')  # generated saltcode
-        hashed_password = hashing.hash_value(password, salt_code)
+        hashed_password = password_hasher.hash(password, salt_code)
 
         super().__init__(
             first_name=first_name,
@@ -292,26 +548,51 @@ class User(SurrogatePK, SqlModel):
             phone_number=phone_number,
             password=hashed_password,
             salt_code=salt_code,
-            birth_date=birth_date
+            birth_date=birth_date,
+            password_rounds=password_hasher.rounds
         )
 
     def set_password(self, password):
-        self.password = hashing.hash_value(password, self.salt_code)
+        self.password = password_hasher.hash(password, self.salt_code)
+        self.password_rounds = password_hasher.rounds
 
     def check_password(self, password):
-        return hashing.check_value(self.password, password, self.salt_code)
+        return password_hasher.check(self.password, password, self.salt_code, rounds=self.password_rounds)
 
-    def has_permission(self, node):
+    def password_needs_rehash(self):
+        """
+        Whether the password was hashed with fewer or more rounds than HASHING_ROUNDS.
+        """
+        return self.password_rounds != password_hasher.rounds
 
-        perm_node = Permission.query.filter_by(node=node).first()
+    @classmethod
+    def get_with_permission_nodes(cls, **criteria):
+        """
+        Load a user together with the nodes of the permissions they hold, in a single query.
+        :param criteria: column values identifying the user, such as id or email
+        :return: (user, frozenset of permission nodes); (None, empty frozenset) when there's no such user
+        """
+        rows = db.session.query(cls, Permission.node) \
+            .outerjoin(UserPermission, UserPermission.user_id == cls.id) \
+            .outerjoin(Permission, Permission.id == UserPermission.permission_id) \
+            .filter(*[getattr(cls, name) == value for name, value in criteria.items()]) \
+            .all()
 
-        if perm_node is None:
-            LOGGER.debug("unable to locate requested node {0}".format(node))
-            return False
+        if len(rows) == 0:
+            return None, frozenset()
+
+        return rows[0][0], frozenset(node for user, node in rows if node is not None)
+
+    def permission_nodes(self):
+        """
+        Nodes of the permissions this user holds, cached per user.
+        :return: frozenset of permission nodes
+        """
+        return permissions.permission_nodes(self.id)
 
-        user_node = UserPermission.query.filter_by(user_id=self.id, permission_id=perm_node.id).first()
+    def has_permission(self, node):
 
-        if user_node is None:
+        if node not in self.permission_nodes():
             LOGGER.debug("User doesn't have node {0}".format(node))
             return False
 
@@ -332,12 +613,260 @@ class User(SurrogatePK, SqlModel):
         return self.has_permission(node)
 
     def save_cart_as_order(self):
+        """
+        Turn the user's cart into an order, in a single transaction.
+        The cart lines are loaded and locked along with their products and items by one query, the stock of the items
+        reserved (see :meth:`Item.reserve_stock`), then the order lines are inserted and the cart emptied by
+        one statement each. Work following the order is left to background jobs enqueued in the same transaction.
+        :return: the order, None when the cart is empty
+        :raises InsufficientStock: when an item lacks stock, nothing is ordered then
+        """
+        from firepot import jobs
+
+        # Locked, a concurrent checkout of the same cart waits for this one and then finds the lines gone.
+        lines = CartItem.load_cart(self.id, lock=True)
+
+        if len(lines) == 0:
+            db.session.rollback()
+            return None
+
+        quantities = {}
+
+        for cart_item, product, item, price, total in lines:
+            if item is not None:
+                quantities[item.id] = quantities.get(item.id, 0) + cart_item.amount * product.stock_weight
+
+        try:
+            Item.reserve_stock(quantities)
+        except InsufficientStock:
+            db.session.rollback()
+            raise
+
         order = Order(self.id)
+        order.save(commit=False)
 
-        for cart_item in self.cart_items:
-            order.add_item(cart_item)
-            cart_item.delete()
+        # Flushed for its id.
+        db.session.flush()
 
-        order.save(commit=True)
+        db.session.execute(OrderItem.__table__.insert(), [
+            dict(order_id=order.id, product_id=product.id, amount=cart_item.amount, price=price,
+                 name=OrderItem.line_name(product, item))
+            for cart_item, product, item, price, total in lines
+        ])
 
-        self.save(commit=True)
+        # Only the lines ordered, lines added to the cart meanwhile stay in it.
+        CartItem.query.filter(CartItem.user_id == self.id,
+                              CartItem.product_id.in_([line.Product.id for line in lines])) \
+            .delete(synchronize_session=False)
+
+        jobs.enqueue(jobs.ORDER_CONFIRMATION, order_id=order.id)
+
+        db.session.commit()
+
+        return order
+
+
+class UserSession(SurrogatePK, SqlModel):
+    """
+    Login session of a user, renewed with its refresh token.
+    Only the SHA-256 of the refresh token is stored, and the token is replaced by a new one on each renewal.
+    """
+    __tablename__ = "sessions"
+
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id", ondelete="CASCADE"), nullable=False, index=True)
+
+    token_hash = db.Column(db.String(64), nullable=False, unique=True, index=True)
+
+    created_at = db.Column(db.DateTime, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+    @staticmethod
+    def hash_token(token):
+        return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+    @classmethod
+    def start(cls, user_id, lifetime):
+        """
+        Start a session for a user.
+        :param lifetime: timedelta the refresh token is valid for
+        :return: refresh token
+        """
+        token = secrets.token_urlsafe(32)
+        now = datetime.datetime.utcnow()
+
+        cls(user_id=user_id, token_hash=cls.hash_token(token), created_at=now, expires_at=now + lifetime) \
+            .save(commit=True)
+
+        return token
+
+    @classmethod
+    def renew(cls, token, lifetime):
+        """
+        Exchange a refresh token for a new one, extending its session.
+        The session row is locked while it's renewed, a token can't be exchanged twice.
+        :param lifetime: timedelta the new refresh token is valid for
+        The user's permissions version and nodes are read by the same query, so they agree with each other.
+        :return: (user id, permissions version of the user, frozenset of their permission nodes, new refresh token),
+            (None, None, None, None) when the token is unknown or expired
+        """
+        now = datetime.datetime.utcnow()
+
+        rows = db.session.query(cls, User.permissions_version, Permission.node) \
+            .join(User, User.id == cls.user_id) \
+            .outerjoin(UserPermission, UserPermission.user_id == User.id) \
+            .outerjoin(Permission, Permission.id == UserPermission.permission_id) \
+            .filter(cls.token_hash == cls.hash_token(token), cls.expires_at > now) \
+            .with_for_update(of=cls).all()
+
+        if len(rows) == 0:
+            db.session.rollback()
+            return None, None, None, None
+
+        session, permissions_version = rows[0][0], rows[0][1]
+        nodes = frozenset(node for row_session, version, node in rows if node is not None)
+        user_id = session.user_id
+        token = secrets.token_urlsafe(32)
+
+        session.token_hash = cls.hash_token(token)
+        session.expires_at = now + lifetime
+        session.save(commit=True)
+
+        return user_id, permissions_version, nodes, token
+
+    @classmethod
+    def purge_expired(cls, batch_size=1000):
+        """
+        Delete expired sessions, a batch per transaction.
+        :return: number of sessions deleted
+        """
+        purged = 0
+
+        while True:
+            expired = db.session.query(cls.id).filter(cls.expires_at <= datetime.datetime.utcnow()) \
+                .order_by(cls.expires_at).limit(batch_size)
+
+            deleted = cls.query.filter(cls.id.in_(expired)).delete(synchronize_session=False)
+            db.session.commit()
+
+            purged += deleted
+
+            if deleted < batch_size:
+                return purged
+
+
+class Job(SurrogatePK, SqlModel):
+    """
+    Background job of the outbox, run by :mod:`firepot.jobs` once the transaction that added it commits.
+    """
+    __tablename__ = "jobs"
+    __table_args__ = (
+        # Serves the claims of the workers, pending jobs due first.
+        db.Index('ix_jobs_status_run_at', 'status', 'run_at'),
+    )
+
+    STATUS_PENDING = "pending"
+    STATUS_FAILED = "failed"
+
+    name = db.Column(db.String(64), nullable=False)
+    arguments = db.Column(db.Text, nullable=False)  # json of the keyword arguments of the job
+
+    status = db.Column(db.String(16), nullable=False, default=STATUS_PENDING)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    last_error = db.Column(db.Text, nullable=True)
+
+    created_at = db.Column(db.DateTime, nullable=False)
+    run_at = db.Column(db.DateTime, nullable=False)  # due date, or end of the lease of the worker running it
+
+
+class IdempotencyRecord(SqlModel):
+    """
+    Response of a request made with an Idempotency-Key, replayed when the request is retried.
+    See :func:`firepot.utils.idempotent`.
+    """
+    __tablename__ = "idempotency_keys"
+
+    user_id = db.Column(db.Integer, primary_key=True, autoincrement=False)  # 0 for anonymous requests
+    endpoint = db.Column(db.String(128), primary_key=True)
+    key = db.Column(db.String(128), primary_key=True)
+
+    request_hash = db.Column(db.String(64), nullable=False)  # SHA-256 of the request body
+
+    status_code = db.Column(db.Integer, nullable=True)  # None while the request is processed
+    body = db.Column(db.LargeBinary, nullable=True)
+
+    # End of the lease of the request being processed, then of the time the response is kept.
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+    @classmethod
+    def lookup(cls, user_id, endpoint, key):
+        """
+        :return: the unexpired record of a key, None if there is none
+        """
+        return cls.query.filter(cls.user_id == user_id, cls.endpoint == endpoint, cls.key == key,
+                                cls.expires_at > datetime.datetime.utcnow()).first()
+
+    @classmethod
+    def claim(cls, user_id, endpoint, key, request_hash, lease):
+        """
+        Record that a request with a key is being processed, taking over an expired record of the key.
+        Committed right away, so concurrent requests with the same key see it.
+        :param lease: timedelta after which the request is deemed abandoned
+        :return: whether the key was claimed, False when another request holds it
+        """
+        now = datetime.datetime.utcnow()
+        values = dict(user_id=user_id, endpoint=endpoint, key=key, request_hash=request_hash, status_code=None,
+                      body=None, expires_at=now + lease)
+
+        statement = postgresql.insert(cls.__table__).values(**values)
+        statement = statement.on_conflict_do_update(
+            index_elements=[cls.user_id, cls.endpoint, cls.key],
+            set_={name: statement.excluded[name] for name in ('request_hash', 'status_code', 'body', 'expires_at')},
+            where=cls.__table__.c.expires_at <= now
+        )
+
+        claimed = db.session.execute(statement).rowcount > 0
+        db.session.commit()
+
+        return claimed
+
+    @classmethod
+    def complete(cls, user_id, endpoint, key, status_code, body, ttl):
+        """
+        Store the response of a claimed key.
+        :param ttl: timedelta the response is replayed for
+        """
+        cls.query.filter(cls.user_id == user_id, cls.endpoint == endpoint, cls.key == key) \
+            .update({cls.status_code: status_code, cls.body: body,
+                     cls.expires_at: datetime.datetime.utcnow() + ttl}, synchronize_session=False)
+        db.session.commit()
+
+    @classmethod
+    def release(cls, user_id, endpoint, key):
+        """
+        Drop the claim of a key whose request failed, so it can be retried.
+        """
+        cls.query.filter(cls.user_id == user_id, cls.endpoint == endpoint, cls.key == key) \
+            .delete(synchronize_session=False)
+        db.session.commit()
+
+    @classmethod
+    def purge_expired(cls, batch_size=1000):
+        """
+        Delete expired records, batch_size rows per transaction.
+        :return: number of records deleted
+        """
+        purged = 0
+
+        while True:
+            expired = db.session.query(cls.user_id, cls.endpoint, cls.key) \
+                .filter(cls.expires_at <= datetime.datetime.utcnow()) \
+                .order_by(cls.expires_at).limit(batch_size).subquery()
+
+            deleted = cls.query.filter(db.tuple_(cls.user_id, cls.endpoint, cls.key).in_(db.select([expired])))\
+                .delete(synchronize_session=False)
+            db.session.commit()
+
+            purged += deleted
+
+            if deleted < batch_size:
+                return purged
@@ -0,0 +1,126 @@
+"""
+Password hashing on a dedicated, bounded pool of worker threads.
+
+At most ``HASHING_CONCURRENCY`` hashes are computed at once, with up to ``HASHING_QUEUE_DEPTH`` more waiting
+for a worker. Past that, hashing is refused right away with :class:`HashingOverloaded` (answered with a 503
+and a Retry-After header) rather than piling up requests behind a login burst.
+
+Hashes are compatible with the ones made by flask_hashing: the salted value is hashed ``rounds`` times, each
+round hashing the hex digest of the previous one.
+"""
+
+import hashlib
+import hmac
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+LOGGER = logging.getLogger(__name__)
+
+
+class HashingOverloaded(Exception):
+    """
+    Raised when the hashing pool and its queue are full.
+    """
+
+    def __init__(self, retry_after):
+        super().__init__("Password hashing is overloaded")
+        self.retry_after = retry_after
+
+
+def hash_password(value, salt, method, rounds):
+    salt = salt.encode('utf-8')
+
+    for _ in range(rounds):
+        value = hashlib.new(method, salt + value.encode('utf-8')).hexdigest()
+
+    return value
+
+
+class PasswordHasher(object):
+    """
+    Hashes and checks passwords on the hashing pool.
+    """
+
+    def __init__(self, app=None):
+        self.method = 'sha512'
+        self.rounds = 1
+        self.retry_after = 1
+        self.concurrency = 0
+        self.queue_depth = 0
+
+        self.completed = 0
+        self.rejected = 0
+
+        self._executor = None
+        self._slots = None
+        self._lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.method = app.config['HASHING_METHOD']
+        self.rounds = app.config['HASHING_ROUNDS']
+        self.retry_after = app.config['HASHING_RETRY_AFTER']
+
+        self.configure(app.config['HASHING_CONCURRENCY'], app.config['HASHING_QUEUE_DEPTH'])
+
+    def configure(self, concurrency, queue_depth):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+
+        self.concurrency = concurrency
+        self.queue_depth = queue_depth
+
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="firepot-hashing")
+        self._slots = threading.BoundedSemaphore(concurrency + queue_depth)
+
+    def _run(self, function, *args):
+        slots = self._slots
+
+        if not slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+
+            LOGGER.warning("Password hashing pool is full, refusing to hash")
+            raise HashingOverloaded(self.retry_after)
+
+        try:
+            future = self._executor.submit(function, *args)
+        except BaseException:
+            slots.release()
+            raise
+
+        future.add_done_callback(lambda done: slots.release())
+
+        result = future.result()
+
+        with self._lock:
+            self.completed += 1
+
+        return result
+
+    def hash(self, password, salt, rounds=None):
+        """
+        :param rounds: rounds to hash with, defaults to ``HASHING_ROUNDS``
+        :return: hex digest of the password
+        :raises HashingOverloaded: when the pool and its queue are full
+        """
+        return self._run(hash_password, password, salt, self.method, rounds or self.rounds)
+
+    def check(self, password_hash, password, salt, rounds=None):
+        """
+        Check a password against its hash, made with ``rounds`` rounds.
+        :raises HashingOverloaded: when the pool and its queue are full
+        """
+        return hmac.compare_digest(password_hash, self.hash(password, salt, rounds=rounds))
+
+    def stats(self):
+        return dict(
+            concurrency=self.concurrency,
+            queue_depth=self.queue_depth,
+            rounds=self.rounds,
+            completed=self.completed,
+            rejected=self.rejected
+        )
@@ -1 +1,128 @@
+"""
+Permission nodes, and the caches of the permission set and permissions version of each user.
+
+A user's permissions are kept as a frozenset of their nodes, so checking one is a set membership test.
+Sets are dropped from the cache when the session commits (or rolls back) changes to the users'
+:class:`firepot.models.UserPermission` rows or to any :class:`firepot.models.Permission`.
+
+The same changes bump the users' ``permissions_version``, which authentication tokens carry along with the
+nodes the user held when the token was issued: a token whose version is still current is authorized from
+its claims alone.
+"""
+
+import logging
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import get_history
+
+from firepot.cache import LRUCache
+from firepot.extensions import db
+
+LOGGER = logging.getLogger(__name__)
+
 ADMIN_PERMS = "firepot.admin"
+
+permission_cache = LRUCache(4096)
+version_cache = LRUCache(4096)
+
+
+def init_app(app):
+    permission_cache.configure(maxsize=app.config['PERMISSION_CACHE_SIZE'], ttl=app.config['PERMISSION_CACHE_TTL'])
+    version_cache.configure(maxsize=app.config['PERMISSION_CACHE_SIZE'], ttl=app.config['PERMISSION_CACHE_TTL'])
+
+
+def permission_nodes(user_id):
+    """
+    Nodes of the permissions a user holds, cached per user.
+    :return: frozenset of permission nodes
+    """
+    from firepot.models import Permission, UserPermission
+
+    nodes = permission_cache.get(user_id)
+
+    if nodes is None:
+        rows = db.session.query(Permission.node) \
+            .join(UserPermission, UserPermission.permission_id == Permission.id) \
+            .filter(UserPermission.user_id == user_id)
+
+        nodes = frozenset(node for node, in rows)
+        permission_cache.set(user_id, nodes)
+
+    return nodes
+
+
+def permissions_version(user_id):
+    """
+    Current permissions version of a user, cached per user.
+    :return: version, None when there's no such user
+    """
+    from firepot.models import User
+
+    version = version_cache.get(user_id)
+
+    if version is None:
+        version = db.session.query(User.permissions_version).filter(User.id == user_id).scalar()
+
+        if version is not None:
+            version_cache.set(user_id, version)
+
+    return version
+
+
+def invalidate(user_ids=None):
+    """
+    Drop cached permission sets and versions.
+    :param user_ids: users whose entries are dropped, all of them when None
+    """
+    if user_ids is None:
+        permission_cache.clear()
+        version_cache.clear()
+        return
+
+    for user_id in user_ids:
+        permission_cache.delete(user_id)
+        version_cache.delete(user_id)
+
+
+@event.listens_for(Session, 'after_flush')
+def _track_permission_writes(session, flush_context):
+    from firepot.models import Permission, UserPermission, User
+
+    user_ids = set()
+    all_users = False
+
+    for instance in session.new | session.dirty | session.deleted:
+        if isinstance(instance, UserPermission):
+            user_ids.update(get_history(instance, 'user_id').sum())
+        elif isinstance(instance, Permission) and instance not in session.new:
+            # Renamed or deleted nodes may be held by any user.
+            all_users = True
+        elif isinstance(instance, User) and instance in session.deleted:
+            user_ids.add(instance.id)
+
+    if len(user_ids) == 0 and not all_users:
+        return
+
+    statement = User.__table__.update().values(permissions_version=User.__table__.c.permissions_version + 1)
+
+    if not all_users:
+        statement = statement.where(User.__table__.c.id.in_(user_ids))
+
+    session.connection().execute(statement)
+
+    # None stands for every user.
+    if all_users or session.info.get('permission_users', set()) is None:
+        session.info['permission_users'] = None
+    else:
+        session.info.setdefault('permission_users', set()).update(user_ids)
+
+    # Drop the sets right away too, so the session reads its own changes.
+    invalidate(session.info['permission_users'])
+
+
+@event.listens_for(Session, 'after_commit')
+@event.listens_for(Session, 'after_soft_rollback')
+def _invalidate_permissions(session, *args):
+    if 'permission_users' in session.info:
+        invalidate(session.info.pop('permission_users'))
@@ -0,0 +1,220 @@
+"""
+Rate limiting of the authentication endpoints, by client ip and by account email.
+
+Limits are token buckets of ``count`` requests refilled over ``period`` seconds, kept in their GCRA form: a
+single "theoretical arrival time" per key, which moves forward by ``period / count`` with each request allowed.
+A request is refused once that time runs more than ``period`` ahead of now.
+
+Buckets live in the worker's memory by default. Setting ``RATELIMIT_SHARED_FILE`` keeps them in a memory
+mapped file instead, so all the workers of a host share the same buckets.
+"""
+
+import fcntl
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import request
+
+from firepot import messages
+from firepot.utils import error_message
+
+LOGGER = logging.getLogger(__name__)
+
+SCOPE_IP = "ip"
+SCOPE_EMAIL = "email"
+
+
+class MemoryBackend(object):
+    """
+    Buckets of a single worker, at most ``maxsize`` of them, the least recently used being evicted first so each
+    request costs O(1) however many keys are seen. Updates are plain dict operations, without locking; racing
+    requests of a key may let an extra request through, never refuse one wrongly.
+    """
+
+    def __init__(self, maxsize=65536):
+        self.maxsize = maxsize
+        self._arrivals = OrderedDict()
+
+    def acquire(self, key, interval, period, now):
+        arrival = max(self._arrivals.get(key, now), now) + interval
+
+        if arrival - now > period:
+            return False, arrival - now - period
+
+        # Reinserted rather than moved, so a key evicted by a racing request meanwhile doesn't raise.
+        self._arrivals.pop(key, None)
+        self._arrivals[key] = arrival
+
+        while len(self._arrivals) > self.maxsize:
+            try:
+                self._arrivals.popitem(last=False)
+            except KeyError:
+                break
+
+        return True, 0
+
+    def clear(self):
+        self._arrivals.clear()
+
+
+class SharedMemoryBackend(object):
+    """
+    Buckets shared by the processes mapping the same file, as a fixed table of (key hash, arrival time) slots.
+    Keys hashing to a taken slot replace its bucket. Each slot is locked with a record lock while it's updated.
+    """
+
+    SLOT = struct.Struct('=Qd')
+
+    def __init__(self, path, slots=65536):
+        self.path = path
+        self.slots = slots
+
+        size = slots * self.SLOT.size
+
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+
+        if os.fstat(self._fd).st_size < size:
+            os.ftruncate(self._fd, size)
+
+        self._map = mmap.mmap(self._fd, size)
+
+        # Record locks are held by the process, threads of a worker also need to exclude one another.
+        self._lock = threading.Lock()
+
+    def acquire(self, key, interval, period, now):
+        key_hash = int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'little')
+        offset = (key_hash % self.slots) * self.SLOT.size
+
+        with self._lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, self.SLOT.size, offset)
+
+            try:
+                slot_hash, arrival = self.SLOT.unpack_from(self._map, offset)
+
+                if slot_hash != key_hash:
+                    arrival = now
+
+                arrival = max(arrival, now) + interval
+
+                if arrival - now > period:
+                    return False, arrival - now - period
+
+                self.SLOT.pack_into(self._map, offset, key_hash, arrival)
+
+                return True, 0
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, self.SLOT.size, offset)
+
+    def clear(self):
+        with self._lock:
+            self._map[:] = bytes(len(self._map))
+
+
+class RateLimiter(object):
+    """
+    Checks requests against the limits of each scope, see :func:`init_app`.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.limits = {}
+        self.backend = MemoryBackend()
+
+        self.allowed = 0
+        self.rejected = {}
+
+    def configure(self, limits, backend):
+        """
+        :param limits: dict of scope -> (count, period in seconds)
+        :param backend: :class:`MemoryBackend` or :class:`SharedMemoryBackend`
+        """
+        self.limits = dict(limits)
+        self.backend = backend
+
+    def hit(self, scope, value):
+        """
+        Count a request against the limit of a scope.
+        :return: (allowed, seconds until the request would be allowed)
+        """
+        count, period = self.limits[scope]
+
+        allowed, retry_after = self.backend.acquire("{0}:{1}".format(scope, value), period / count, period,
+                                                    time.time())
+
+        if not allowed:
+            self.rejected[scope] = self.rejected.get(scope, 0) + 1
+
+        return allowed, retry_after
+
+    def stats(self):
+        return dict(
+            enabled=self.enabled,
+            backend=type(self.backend).__name__,
+            allowed=self.allowed,
+            rejected=dict(self.rejected)
+        )
+
+
+limiter = RateLimiter()
+
+
+def init_app(app):
+    if app.config['RATELIMIT_SHARED_FILE']:
+        backend = SharedMemoryBackend(app.config['RATELIMIT_SHARED_FILE'], slots=app.config['RATELIMIT_SLOTS'])
+    else:
+        backend = MemoryBackend(maxsize=app.config['RATELIMIT_SLOTS'])
+
+    limiter.configure({
+        SCOPE_IP: app.config['RATELIMIT_IP'],
+        SCOPE_EMAIL: app.config['RATELIMIT_EMAIL']
+    }, backend)
+
+    limiter.enabled = app.config['RATELIMIT_ENABLED']
+
+
+def _request_email():
+    _json = request.get_json(silent=True)
+
+    if not isinstance(_json, dict) or not isinstance(_json.get('email'), str):
+        return None
+
+    return _json['email'].strip().lower()
+
+
+def rate_limited(api_method):
+    """
+    Decorator limiting the requests made to an endpoint by the client's ip, and by the email of the json payload.
+    Refused requests are answered with a 429 and a Retry-After header.
+    """
+
+    @wraps(api_method)
+    def decorated_method(*args, **kwargs):
+        if not limiter.enabled:
+            return api_method(*args, **kwargs)
+
+        for scope, value in ((SCOPE_IP, request.remote_addr), (SCOPE_EMAIL, _request_email())):
+            if value is None:
+                continue
+
+            allowed, retry_after = limiter.hit(scope, value)
+
+            if not allowed:
+                LOGGER.warning("Rate limited request to {0} by {1}".format(request.path, scope))
+
+                response = error_message(messages.RATE_LIMITED)
+                response.status_code = 429
+                response.headers['Retry-After'] = str(int(retry_after) + 1)
+                return response
+
+        limiter.allowed += 1
+
+        return api_method(*args, **kwargs)
+
+    return decorated_method
@@ -1,3 +1,6 @@
 from firepot.routes.auth import auth_blueprint
 from firepot.routes.store import store_blueprint
 from firepot.routes.admin import admin_blueprint
+from firepot.routes.images import images_blueprint
+from firepot.routes.cart import cart_blueprint
+from firepot.routes.user import user_blueprint
@@ -1,9 +1,11 @@
 from flask import Blueprint, request
 from flask_cors import cross_origin
 
-from firepot import messages
-from firepot.models import Item, Product, Tag, Image
-from firepot.utils import status_message, payload, admins_only
+from firepot import messages, catalog, permissions, ratelimit, jobs
+from firepot.extensions import password_hasher
+from firepot.models import Item, Product, Tag, Image, UnsupportedImage
+from firepot.utils import status_message, payload, admins_only, page_args, paginate, error_message, token_cache, \
+    idempotent
 
 admin_blueprint = Blueprint(__name__, "admin", url_prefix="/admin")
 
@@ -13,6 +15,20 @@ admin_blueprint = Blueprint(__name__, "admin", url_prefix="/admin")
 def index():
     return status_message(msg="Welcome")
 
+
+@admin_blueprint.route('/metrics/', methods=['GET'])
+@admins_only
+def metrics():
+    return payload(msg=messages.METRICS, payload={
+        'catalog': dict(version=catalog.catalog_version.value, snapshots=catalog.snapshot_cache.stats()),
+        'permissions': permissions.permission_cache.stats(),
+        'tokens': token_cache.stats(),
+        'hashing': password_hasher.stats(),
+        'rate_limit': ratelimit.limiter.stats(),
+        'jobs': jobs.queue.stats()
+    })
+
+
 @admins_only
 @cross_origin
 @admin_blueprint.route('/inventory/delete-item/', methods=['POST'])
@@ -61,31 +77,45 @@ def images_save():
     if image is not None:
         return status_message(messages.DUPLICATE_IMAGE_NAME, status="error")
 
-    # todo verify it's base64 image data somewhere here.
+    try:
+        image = Image(name=name, data=data)
+    except UnsupportedImage:
+        return error_message(messages.UNSUPPORTED_IMAGE)
 
-    image = Image(name=name, data=data)
     image.save(commit=True)
 
-    return payload(messages.IMAGE_SAVED, payload=dict(image_id=image.id))
+    return payload(messages.IMAGE_SAVED, payload=dict(image_id=image.id, url=image.url))
 
 
 @admin_blueprint.route('/inventory/list/', methods=['GET'])
 @admins_only
 def list_inventory_items():
-    _json = request.get_json()
+    """
+    List every item of the inventory. The full listing is streamed as it's read from the database,
+    unless a ``limit`` or ``cursor`` is provided to paginate it, with the cursor of the next page in ``next_cursor``.
+    """
+    try:
+        limit, after_id = page_args()
+    except ValueError as e:
+        return error_message(str(e))
 
-    items = Item.query.all()
+    if limit is None:
+        items = catalog.iter_catalog(in_stock_only=False)
 
-    item_data = []
+        return payload(msg=messages.INVENTORY_LISTINGS,
+                       payload=(item.to_dict(products=products) for item, products in items), stream=True)
 
-    for item in items:
-        item_data.append(item.to_dict())
+    items = catalog.load_catalog(in_stock_only=False, after_id=after_id, limit=limit + 1)
+    items, next_cursor = paginate(items, limit, key=lambda row: row[0].id)
 
-    return payload(msg=messages.INVENTORY_LISTINGS, payload=item_data)
+    return payload(msg=messages.INVENTORY_LISTINGS,
+                   payload=[item.to_dict(products=products) for item, products in items],
+                   next_cursor=next_cursor)
 
 
 @admin_blueprint.route('/inventory/new/', methods=['POST'])
 @admins_only
+@idempotent
 def new_inventory_item():
     _json = request.get_json()
 
@@ -110,6 +140,11 @@ def new_inventory_item():
     if item_image is not None:
         return status_message(messages.DUPLICATE_IMAGE_NAME, status='error')
 
+    try:
+        item_image = Image(name=cover_image_name, data=cover_image_data)
+    except UnsupportedImage:
+        return error_message(messages.UNSUPPORTED_IMAGE)
+
     tags = []
 
     for tag in tags_list:
@@ -121,11 +156,8 @@ def new_inventory_item():
 
         tags.append(_tag)
 
-    # todo secure image data
-
     # todo secure description
 
-    item_image = Image(name=cover_image_name, data=cover_image_data)
     item_image.save(commit=True)
 
     item = Item(name=name, description=description, cover_image_id=item_image.id, images=[item_image], tags=tags,
@@ -1,13 +1,30 @@
-from flask import Blueprint, request, jsonify
+import datetime
 
-from firepot.models import User
+from flask import Blueprint, request, jsonify, current_app
+
+from firepot.models import User, UserSession
 from firepot.utils import error_message, payload, encode_auth_token, decode_auth_token, validate_auth_token, \
     status_message
-from firepot import messages
+from firepot import messages, permissions
+from firepot.ratelimit import rate_limited
 
 auth_blueprint = Blueprint(__name__, "auth", url_prefix="/auth")
 
 
+def _access_token(user_id, permission_nodes, permissions_version):
+    """
+    :param permission_nodes: nodes the user holds, read from the database along with permissions_version,
+        never from the per-worker cache: a stale set paired with the current version would outlive a revocation.
+    """
+    token = encode_auth_token(user_id, permission_nodes, permissions_version)
+
+    return token.decode("utf-8") if isinstance(token, bytes) else token
+
+
+def _refresh_token_lifetime():
+    return datetime.timedelta(days=current_app.config['REFRESH_TOKEN_DAYS'])
+
+
 @auth_blueprint.route('/', methods=['GET'])
 @validate_auth_token
 def index():
@@ -15,6 +32,7 @@ def index():
 
 
 @auth_blueprint.route("/login/", methods=['POST'])
+@rate_limited
 def login():
     _json = request.get_json()
 
@@ -27,31 +45,57 @@ def login():
     if password is None:
         return error_message(messages.NO_PASSWORD_PROVIDED)
 
-    user = User.query.filter_by(email=email).first()
+    user, nodes = User.get_with_permission_nodes(email=email)
 
     if user is None:
         return error_message(messages.LOGIN_FAILED)
 
+    # Read before the user is expired by a commit, along with the nodes.
+    permissions_version = user.permissions_version
+
     if not user.check_password(password):
         # todo login log error log inform user of invalid login
 
         return error_message(messages.LOGIN_FAILED)
 
-    try:
-        authentication_token = encode_auth_token(user.id).decode("utf-8")
-    except:
-        authentication_token = encode_auth_token(user.id)
+    if user.password_needs_rehash():
+        user.set_password(password)
+        user.save(commit=True)
 
     return payload(messages.LOGIN_SUCCESS, {
         "id": user.id,
         "email": user.phone_number,
         "name": user.first_name,
-        "auth": authentication_token,
-        "admin": user.has_permission("firepot.admin")
+        "auth": _access_token(user.id, nodes, permissions_version),
+        "admin": permissions.ADMIN_PERMS in nodes,
+        "refresh": UserSession.start(user.id, _refresh_token_lifetime())
+    })
+
+
+@auth_blueprint.route("/refresh/", methods=['POST'])
+@rate_limited
+def refresh():
+    _json = request.get_json(silent=True) or {}
+
+    token = _json.get('refresh')
+
+    if not token:
+        return error_message(messages.NO_REFRESH_TOKEN)
+
+    user_id, permissions_version, nodes, token = UserSession.renew(token, _refresh_token_lifetime())
+
+    if user_id is None:
+        return error_message(messages.INVALID_REFRESH_TOKEN), 401
+
+    return payload(messages.TOKEN_REFRESHED, {
+        "id": user_id,
+        "auth": _access_token(user_id, nodes, permissions_version),
+        "refresh": token
     })
 
 
 @auth_blueprint.route("/register/", methods=['POST'])
+@rate_limited
 def register():
     _json = request.get_json()
 
@@ -77,13 +121,9 @@ def register():
     user = User(first_name=first_name, last_name=last_name, email=email, password=password)
     user.save(commit=True)
 
-    try:
-        authentication_token = encode_auth_token(user.id).decode("utf-8")
-    except:
-        authentication_token = encode_auth_token(user.id)
-
     return payload(messages.REGISTRATION_SUCCESSFUL, {
-        'auth': authentication_token,
+        'auth': _access_token(user.id, frozenset(), user.permissions_version),
         'name': user.first_name,
-        'id': user.id
+        'id': user.id,
+        'refresh': UserSession.start(user.id, _refresh_token_lifetime())
     })
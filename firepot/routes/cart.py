@@ -0,0 +1,156 @@
+from flask import Blueprint, request
+from sqlalchemy.exc import DataError, IntegrityError
+
+from firepot import messages, serializers
+from firepot.extensions import db
+from firepot.models import CartItem, OrderItem, InsufficientStock
+from firepot.utils import validate_auth_token, json_only, payload, error_message, get_user_id, get_user, \
+    idempotent
+
+cart_blueprint = Blueprint(__name__, "cart", url_prefix="/cart")
+
+# Largest value of the integer columns product ids and amounts are stored in.
+_INTEGER_MAX = 2 ** 31 - 1
+
+
+def _cart_payload(user_id):
+    lines = CartItem.load_cart(user_id)
+
+    return {
+        "items": [dict(serializers.CART_ITEM.serialize(cart_item), name=OrderItem.line_name(product, item),
+                       price=price, product=serializers.PRODUCT.serialize(product))
+                  for cart_item, product, item, price, total in lines],
+        "total": lines[0].total if len(lines) > 0 else 0
+    }
+
+
+def _cart_changes(minimum_amount):
+    """
+    Read the batch of cart changes of the request, ``{"items": [{"product_id": 1, "amount": 2}, ...]}``.
+    Changes to the same product are summed.
+    :return: dict of product id -> amount, None when the payload is invalid
+    """
+    _json = request.get_json(silent=True) or {}
+    items = _json.get('items')
+
+    if not isinstance(items, list) or len(items) == 0:
+        return None
+
+    amounts = {}
+
+    for change in items:
+        if not isinstance(change, dict):
+            return None
+
+        product_id, amount = change.get('product_id'), change.get('amount', 1)
+
+        if type(product_id) is not int or type(amount) is not int or not 0 < product_id <= _INTEGER_MAX:
+            return None
+
+        amount += amounts.get(product_id, 0)
+
+        if not minimum_amount <= amount <= _INTEGER_MAX:
+            return None
+
+        amounts[product_id] = amount
+
+    return amounts
+
+
+def _update_cart(replace):
+    user_id = get_user_id(request)
+
+    if user_id is None:
+        return error_message(messages.UNKNOWN_USER), 401
+
+    amounts = _cart_changes(minimum_amount=0 if replace else 1)
+
+    if amounts is None:
+        return error_message(messages.INVALID_CART_ITEMS)
+
+    try:
+        CartItem.upsert(user_id, amounts, replace=replace)
+    except IntegrityError:
+        db.session.rollback()
+        return error_message(messages.UNKNOWN_CART_PRODUCT)
+    except DataError:
+        # Amounts added to the line already in the cart went past the column's range
+        db.session.rollback()
+        return error_message(messages.INVALID_CART_ITEMS)
+
+    return payload(messages.CART_UPDATED, _cart_payload(user_id))
+
+
+@cart_blueprint.route("/", methods=['GET'])
+@validate_auth_token
+def cart():
+    user_id = get_user_id(request)
+
+    if user_id is None:
+        return error_message(messages.UNKNOWN_USER), 401
+
+    return payload(messages.CART, _cart_payload(user_id))
+
+
+@cart_blueprint.route("/quote/", methods=['GET'])
+@validate_auth_token
+def cart_quote():
+    """
+    Price the cart at the current costs of its products, priced and totaled by the database in one statement.
+    """
+    user_id = get_user_id(request)
+
+    if user_id is None:
+        return error_message(messages.UNKNOWN_USER), 401
+
+    lines, total = CartItem.quote(user_id)
+
+    return payload(messages.CART_QUOTE, {
+        "items": [dict(product_id=line.product_id, amount=line.amount, price=line.price, line_total=line.line_total)
+                  for line in lines],
+        "total": total
+    })
+
+
+@cart_blueprint.route("/add/", methods=['POST'])
+@validate_auth_token
+@json_only
+def cart_add():
+    """
+    Add a batch of products to the cart, adding to the amounts of the products already in it.
+    """
+    return _update_cart(replace=False)
+
+
+@cart_blueprint.route("/set/", methods=['POST'])
+@validate_auth_token
+@json_only
+def cart_set():
+    """
+    Set the amounts of a batch of products in the cart, products set to 0 being removed from it.
+    """
+    return _update_cart(replace=True)
+
+
+@cart_blueprint.route("/checkout/", methods=['POST'])
+@validate_auth_token
+@idempotent
+def checkout():
+    """
+    Order the content of the cart, reserving the stock of its items.
+    Retries sent with the same ``Idempotency-Key`` header get the response of the first request.
+    """
+    user = get_user(request)
+
+    if user is None:
+        return error_message(messages.UNKNOWN_USER), 401
+
+    try:
+        order = user.save_cart_as_order()
+    except InsufficientStock as e:
+        return payload(messages.INSUFFICIENT_STOCK, {"item_id": e.item_id}, status="error"), 409
+
+    if order is None:
+        return error_message(messages.CART_EMPTY)
+
+    return payload(messages.ORDER_PLACED, {"id": order.id})
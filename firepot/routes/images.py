@@ -0,0 +1,47 @@
+from flask import Blueprint, Response, request
+from werkzeug.wsgi import wrap_file
+
+from firepot import messages
+from firepot.blobstore import IMAGE_CONTENT_TYPES, DEFAULT_CONTENT_TYPE
+from firepot.extensions import blob_store
+from firepot.models import Image
+from firepot.utils import status_message
+
+images_blueprint = Blueprint(__name__, "images", url_prefix="/images")
+
+# Blobs are content addressed and never change, so clients may keep them for as long as they like.
+BLOB_MAX_AGE = 365 * 24 * 60 * 60
+
+
+@images_blueprint.route("/<blob_hash>", methods=['GET'])
+def image_blob(blob_hash):
+    """
+    Stream an image from the blob store. Supports conditional and Range requests.
+    """
+
+    if not blob_store.exists(blob_hash):
+        return status_message(msg=messages.IMAGE_NOT_FOUND, status="error"), 404
+
+    if request.if_none_match.contains(blob_hash):
+        response = Response(status=304)
+    else:
+        image = Image.query.filter_by(blob_hash=blob_hash).first()
+        content_type = image.content_type if image is not None else None
+
+        # Rows stored before uploads were checked may hold any type a client claimed
+        if content_type not in IMAGE_CONTENT_TYPES:
+            content_type = DEFAULT_CONTENT_TYPE
+
+        response = Response(wrap_file(request.environ, blob_store.open(blob_hash)),
+                            mimetype=content_type, direct_passthrough=True)
+        response.content_length = blob_store.size(blob_hash)
+
+    # Browsers must not guess a document out of a blob
+    response.headers['X-Content-Type-Options'] = 'nosniff'
+
+    response.set_etag(blob_hash)
+    response.cache_control.public = True
+    response.cache_control.max_age = BLOB_MAX_AGE
+    response.cache_control.immutable = True
+
+    return response.make_conditional(request, accept_ranges=True, complete_length=blob_store.size(blob_hash))
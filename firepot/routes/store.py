@@ -1,9 +1,7 @@
-from flask import Blueprint, jsonify
+from flask import Blueprint, request, current_app
 
-from firepot import messages
-from firepot.utils import validate_auth_token, payload, status_message
-
-from firepot.models import Product, Item
+from firepot import messages, catalog, search
+from firepot.utils import validate_auth_token, status_message, conditional_json_response, page_args, error_message
 
 store_blueprint = Blueprint(__name__, "store_blueprint", url_prefix="/store")
 
@@ -13,45 +11,65 @@ store_blueprint = Blueprint(__name__, "store_blueprint", url_prefix="/store")
 def store_products():
     """
     Return (in json to client) all the products in stock.
+    Paginated when a ``limit`` or ``cursor`` is provided, with the cursor of the next page in ``next_cursor``.
+    Filtered by tag when ``tags`` (comma separated) is provided, ``match`` being either ``any`` (default) or ``all``.
     """
 
-    items_in_stock = Item.query.filter(Item.stock >= 1).all()
+    try:
+        limit, after_id = page_args()
+    except ValueError as e:
+        return error_message(str(e))
+
+    tags = request.args.get('tags')
+
+    if tags is not None:
+        match = request.args.get('match', catalog.TAG_MATCH_ANY)
+
+        if match not in (catalog.TAG_MATCH_ANY, catalog.TAG_MATCH_ALL):
+            return error_message(messages.INVALID_TAG_MATCH)
+
+        tag_names = [name.strip() for name in tags.split(',') if name.strip()]
 
-    if len(items_in_stock) == 0:
-        return status_message(msg=messages.NO_STOCK_AVAILABLE, status="error")
+        snapshot = catalog.tagged_listing_snapshot(tag_names, match=match, after_id=after_id, limit=limit)
+    else:
+        snapshot = catalog.listing_snapshot(after_id=after_id, limit=limit)
 
-    items_map = {}
+    return conditional_json_response(snapshot.body, snapshot.etag)
 
-    for item in items_in_stock:
-        item_products = Product.query.filter_by(item_id=item.id).all()
 
-        if len(item_products) == 0:
-            continue
+@store_blueprint.route("/search", methods=['GET'])
+@validate_auth_token
+def store_search():
+    """
+    Full-text search of the items for sale over their name, description, tags and product names.
+    Results are ranked best first and paginated with ``limit`` and ``cursor``.
+    """
+
+    text = request.args.get('q', '').strip()
 
-        for product in item_products:
-            _product_map = product.to_dict()
+    if len(text) == 0:
+        return error_message(messages.NO_SEARCH_QUERY)
 
-            item_id = _product_map['item_id']
+    try:
+        limit, offset = page_args()
 
-            if item_id not in items_map.keys():
-                items_map[item_id] = product.get_item().to_dict()
-                items_map[item_id]['products'] = list()  # Map of items.
+        # The cursor of search pages holds an offset, bounded before it reaches the database.
+        if offset is not None and not 0 <= offset <= current_app.config['SEARCH_OFFSET_MAX']:
+            raise ValueError("Invalid cursor")
+    except ValueError as e:
+        return error_message(str(e))
 
-            items_map[item_id]['products'].append(product.to_dict())
+    snapshot = search.search_snapshot(text, offset=offset or 0, limit=limit or current_app.config['PAGE_SIZE'])
 
-    return payload(msg="Store Products List", payload={
-        'items': items_map
-    })
+    return conditional_json_response(snapshot.body, snapshot.etag)
 
 
 @store_blueprint.route("/item/<itemid>", methods=["GET"])
 @validate_auth_token
 def item_id(itemid):
-    item = Item.query.filter_by(id=itemid).first()
+    snapshot = catalog.item_snapshot(int(itemid)) if itemid.isdigit() else None
 
-    if item is None:
+    if snapshot is None:
         return status_message(msg=messages.INVALID_ITEM_ID, status="error")
 
-    return payload(msg="Item retrieved", payload={
-        'item': item.to_dict()
-    })
+    return conditional_json_response(snapshot.body, snapshot.etag)
@@ -1,9 +1,32 @@
-from flask import Blueprint
-from firepot.models import User
+from flask import Blueprint, request, current_app
+
+from firepot import messages
+from firepot.models import Order
+from firepot.utils import validate_auth_token, payload, error_message, get_user_id, page_args, paginate
+
+user_blueprint = Blueprint(__name__, "user", url_prefix="/user")
 
-user_blueprint = Blueprint(__name__, "user", "/user")
 
 @user_blueprint.route('/orders', methods=['GET'])
+@validate_auth_token
 def user_orders_list():
-    pass
+    """
+    Order history of the user, latest first, along with the lines of the orders.
+    Paginated by ``limit`` (PAGE_SIZE by default) and ``cursor``, with the cursor of the next page in ``next_cursor``.
+    """
+    user_id = get_user_id(request)
+
+    if user_id is None:
+        return error_message(messages.UNKNOWN_USER), 401
+
+    try:
+        limit, before_id = page_args()
+    except ValueError as e:
+        return error_message(str(e))
+
+    limit = limit or current_app.config['PAGE_SIZE']
+
+    orders = Order.history(user_id, before_id=before_id, limit=limit + 1)
+    orders, next_cursor = paginate(orders, limit, key=lambda order: order.id)
 
+    return payload(messages.ORDERS, [order.to_dict() for order in orders], next_cursor=next_cursor)
@@ -0,0 +1,152 @@
+"""
+Full-text search over the catalog read model.
+
+On PostgreSQL items are matched against the GIN indexed ``search_vector`` of the read model and ranked
+with ``ts_rank_cd``. Other databases (SQLite test runs) fall back to an in-memory trigram index built
+from the read model's ``search_text``.
+"""
+
+import logging
+import re
+
+from sqlalchemy import func
+
+from firepot import messages, catalog
+from firepot.extensions import db
+from firepot.models import CatalogReadModel
+from firepot.utils import render_raw_payload, encode_cursor
+
+LOGGER = logging.getLogger(__name__)
+
+_WORD_PATTERN = re.compile(r'\w+', re.UNICODE)
+
+# Share of the query's trigrams an item must contain to be a trigram match.
+TRIGRAM_THRESHOLD = 0.5
+
+
+def trigrams(text):
+    """
+    Trigrams of the words of a text, words being padded with spaces like pg_trgm does.
+    """
+    grams = set()
+
+    for word in _WORD_PATTERN.findall(text.lower()):
+        padded = '  ' + word + ' '
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+
+    return grams
+
+
+class TrigramIndex(catalog.VersionedIndex):
+    """
+    Inverted index of trigram -> bitmap of the ids of the items for sale containing it,
+    built from the read model's ``search_text``.
+    """
+
+    name = "trigram index"
+
+    def _build(self):
+        containing = {}
+
+        rows = db.session.query(CatalogReadModel.item_id, CatalogReadModel.search_text) \
+            .filter(CatalogReadModel.in_stock.is_(True), CatalogReadModel.for_sale.is_(True))
+
+        for item_id, search_text in rows:
+            for gram in trigrams(search_text):
+                containing.setdefault(gram, []).append(item_id)
+
+        return {gram: catalog.ids_bitmap(item_ids) for gram, item_ids in containing.items()}
+
+    def search(self, text):
+        """
+        Rank the items for sale by the share of the text's trigrams they contain.
+        :return: list of (item id, score) ordered by score, best first
+        """
+        grams = trigrams(text)
+
+        if len(grams) == 0:
+            return []
+
+        bitmaps = self.get_bitmaps()
+        scores = {}
+
+        for gram in grams:
+            for item_id in catalog.bitmap_ids(bitmaps.get(gram, 0)):
+                scores[item_id] = scores.get(item_id, 0) + 1
+
+        results = [(item_id, count / len(grams)) for item_id, count in scores.items()
+                   if count / len(grams) >= TRIGRAM_THRESHOLD]
+
+        return sorted(results, key=lambda result: (-result[1], result[0]))
+
+
+trigram_index = TrigramIndex()
+
+
+def init_app(app):
+    trigram_index.max_age = app.config['CATALOG_CACHE_TTL']
+
+
+def _search_postgresql(text, offset, limit):
+    query = func.plainto_tsquery(catalog.SEARCH_CONFIG, text)
+    rank = func.ts_rank_cd(CatalogReadModel.search_vector, query).label('rank')
+
+    return db.session.query(CatalogReadModel.item_id, CatalogReadModel.document, rank) \
+        .filter(CatalogReadModel.in_stock.is_(True), CatalogReadModel.for_sale.is_(True),
+                CatalogReadModel.search_vector.op('@@')(query)) \
+        .order_by(rank.desc(), CatalogReadModel.item_id) \
+        .offset(offset).limit(limit).all()
+
+
+def _search_trigrams(text, offset, limit):
+    matches = trigram_index.search(text)[offset:offset + limit]
+
+    if len(matches) == 0:
+        return []
+
+    documents = dict(db.session.query(CatalogReadModel.item_id, CatalogReadModel.document)
+                     .filter(CatalogReadModel.item_id.in_([item_id for item_id, score in matches])))
+
+    return [(item_id, documents[item_id], score) for item_id, score in matches if item_id in documents]
+
+
+def search(text, offset=0, limit=20):
+    """
+    Search the items for sale.
+    :param text: text to search for
+    :param offset: number of results to skip
+    :param limit: maximum number of results
+    :return: list of (item id, document json, rank) ordered by rank, best first
+    """
+    if db.session.connection().dialect.name == 'postgresql':
+        return _search_postgresql(text, offset, limit)
+
+    return _search_trigrams(text, offset, limit)
+
+
+def search_snapshot(text, offset, limit):
+    """
+    Rendered page of search results, served from the catalog snapshot cache when possible.
+    The next page's cursor holds its offset.
+    :return: :class:`firepot.catalog.Snapshot`
+    """
+    text = ' '.join(text.split())
+
+    key = (catalog.catalog_version.value, 'search', text.lower(), offset, limit)
+
+    snapshot = catalog.snapshot_cache.get(key)
+
+    if snapshot is None:
+        results = search(text, offset=offset, limit=limit + 1)
+
+        next_cursor = encode_cursor(offset + limit) if len(results) > limit else None
+
+        raw_results = ', '.join('{{"rank": {0}, "item": {1}}}'.format(round(float(rank), 6), document)
+                                for item_id, document, rank in results[:limit])
+
+        snapshot = catalog.make_snapshot(render_raw_payload(msg=messages.SEARCH_RESULTS,
+                                                            raw_payload='{"results": [' + raw_results + ']}',
+                                                            next_cursor=next_cursor))
+        catalog.snapshot_cache.set(key, snapshot)
+
+    return snapshot
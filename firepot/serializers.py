@@ -0,0 +1,102 @@
+"""
+Serialization of models into json ready dicts, and of those into json.
+
+Each :class:`Serializer` compiles its field list, once, into a plain function building the dict with
+direct attribute reads, so serializing a catalog doesn't go through per-field lookups or ``to_dict``
+chains. Json is produced by orjson when it's installed, falling back on the standard library.
+"""
+
+import datetime
+import decimal
+import json
+import logging
+import uuid
+
+try:
+    import orjson
+except ImportError:  # optional dependency
+    orjson = None
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Serializer(object):
+    """
+    Serializes model instances into dicts, through ``serialize(obj, **related)``.
+    ``related`` takes already loaded values of included relationships, used instead of reading them from obj.
+
+    :param fields: attributes copied into the dict, in order
+    :param include: related attributes serialized with their own serializer, as name -> serializer.
+        Collections are serialized to lists, single relationships (``many=False`` serializers) to a dict or None.
+    :param many: whether this serializer is used for a collection when included in another one
+    """
+
+    def __init__(self, fields, include=None, many=True):
+        self.fields = tuple(fields)
+        self.include = dict(include or {})
+        self.many = many
+
+        self.serialize = self._compile()
+
+    def _compile(self):
+        namespace = {}
+        arguments = ''.join(', {0}=None'.format(name) for name in self.include)
+
+        lines = ["def serialize(obj{0}):".format(arguments), "    return {"]
+
+        for field in self.fields:
+            lines.append("        {0!r}: obj.{0},".format(field))
+
+        for name, serializer in self.include.items():
+            namespace['_serialize_' + name] = serializer.serialize
+            source = "(obj.{0} if {0} is None else {0})".format(name)
+
+            if serializer.many:
+                lines.append("        {0!r}: [_serialize_{0}(related) for related in {1}],".format(name, source))
+            else:
+                lines.append("        {0!r}: None if {1} is None else _serialize_{0}({1}),".format(name, source))
+
+        lines.append("    }")
+
+        exec(compile('\n'.join(lines), '<serializer {0}>'.format(', '.join(self.fields)), 'exec'), namespace)
+
+        return namespace['serialize']
+
+
+IMAGE = Serializer(('name', 'url', 'content_type', 'size'))
+TAG = Serializer(('id', 'name'))
+PRODUCT = Serializer(('name', 'item_id', 'cost', 'sale_cost', 'stock_weight'))
+ITEM = Serializer(('id', 'name', 'description', 'cover_image_id'), include={
+    'images': IMAGE,
+    'tags': TAG,
+    'products': PRODUCT
+})
+CART_ITEM = Serializer(('user_id', 'product_id', 'amount'))
+ORDER_ITEM = Serializer(('product_id', 'name', 'amount', 'price'))
+ORDER = Serializer(('id', 'total'), include={
+    'items': ORDER_ITEM
+})
+
+
+def _default(value):
+    if isinstance(value, decimal.Decimal):
+        return str(value)
+
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+
+    if isinstance(value, uuid.UUID):
+        return str(value)
+
+    raise TypeError("Object of type {0} is not JSON serializable".format(type(value).__name__))
+
+
+def dumps(value):
+    """
+    Serialize a value to json.
+    :return: json bytes
+    """
+    if orjson is not None:
+        return orjson.dumps(value, default=_default, option=orjson.OPT_NON_STR_KEYS)
+
+    return json.dumps(value, default=_default, separators=(',', ':')).encode('utf-8')
@@ -1,8 +1,9 @@
 import datetime
+import hashlib
 import logging
 
 import jwt
-from flask import jsonify, request
+from flask import jsonify, request, json, Response, current_app, stream_with_context, g, make_response
 
 from functools import wraps
 
@@ -10,66 +11,344 @@ import random
 import math
 
 from firepot.config import Config
-from firepot.models import User
-from firepot import permissions
+from firepot.models import User, IdempotencyRecord
+from firepot import messages, permissions, serializers
+from firepot.cache import LRUCache
+from firepot.extensions import db
 
 import base64
 
 LOGGER = logging.getLogger(__name__)
 
 
+# Claims of verified authentication tokens, by token.
+token_cache = LRUCache(8192)
+
+
+def init_app(app):
+    token_cache.configure(maxsize=app.config['TOKEN_CACHE_SIZE'])
+
+
 def base64_encode_image(input):
     image_string = base64.b64encode(input.read())
     return image_string
 
 
-def payload(msg, payload, status="success"):
-    return jsonify({
+def payload(msg, payload, status="success", stream=False, **envelope):
+    """
+    :param stream: send the payload as it is produced instead of serializing it all up front.
+        ``payload`` is then an iterable whose elements are sent as a json list.
+    :param envelope: additional top level keys of the response, such as ``next_cursor``.
+    """
+    if stream:
+        return Response(stream_with_context(_stream_envelope(msg, payload, status, envelope)),
+                        mimetype="application/json")
+
+    return json_response(serializers.dumps({
         "status": status,
         "message": msg,
-        "payload": payload
+        "payload": payload,
+        **envelope
+    }))
+
+
+def _stream_envelope(msg, elements, status, envelope):
+    """
+    Generate the json of a response envelope chunk by chunk, one chunk per payload element.
+    """
+    envelope.update({
+        "status": status,
+        "message": msg
+    })
+
+    # Reopen the serialized envelope object to append the payload list to it.
+    yield serializers.dumps(envelope)[:-1] + b',"payload":['
+
+    separator = b''
+
+    for element in elements:
+        yield separator + serializers.dumps(element)
+        separator = b','
+
+    yield b']}'
+
+
+def render_payload(msg, payload=None, status="success", **envelope):
+    """
+    Serialize a response envelope to json bytes, for bodies that are kept around rather than sent right away.
+    :param msg: message of the envelope
+    :param payload: payload of the envelope, left out when None (like :func:`status_message`)
+    :param status: status of the envelope
+    :param envelope: additional top level keys of the envelope
+    :return: json bytes
+    """
+    envelope.update({
+        "status": status,
+        "message": msg
     })
 
+    if payload is not None:
+        envelope["payload"] = payload
+
+    return serializers.dumps(envelope)
+
+
+def render_raw_payload(msg, raw_payload, status="success", **envelope):
+    """
+    Serialize a response envelope to json bytes around a payload that is already serialized.
+    :param raw_payload: json of the payload
+    :return: json bytes
+    """
+    envelope.update({
+        "status": status,
+        "message": msg
+    })
+
+    # Reopen the serialized envelope object to add the payload to it.
+    return serializers.dumps(envelope)[:-1] + b',"payload":' + raw_payload.encode("utf-8") + b'}'
+
+
+def encode_cursor(value):
+    """
+    Encode the last key of a page into an opaque cursor token for the next page.
+    """
+    return base64.urlsafe_b64encode(json.dumps([value]).encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(token):
+    """
+    Decode a cursor token created by :func:`encode_cursor`.
+    :raises ValueError: if the token is malformed
+    """
+    try:
+        value = json.loads(base64.urlsafe_b64decode(token.encode("ascii")))
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+    if not isinstance(value, list) or len(value) != 1 or not isinstance(value[0], int):
+        raise ValueError("Invalid cursor")
+
+    return value[0]
+
+
+def page_args():
+    """
+    Read the keyset pagination arguments (``limit`` and ``cursor``) of the current request.
+    Requests that provide neither aren't paginated, which keeps the full listings backwards compatible.
+    :return: (limit, after) where after is the key decoded from the cursor; (None, None) when not paginated
+    :raises ValueError: if either argument is malformed
+    """
+    limit = request.args.get('limit')
+    cursor = request.args.get('cursor')
+
+    if limit is None and cursor is None:
+        return None, None
+
+    if limit is None:
+        limit = current_app.config['PAGE_SIZE']
+    elif not limit.isdigit() or int(limit) < 1:
+        raise ValueError("Invalid limit")
+
+    limit = min(int(limit), current_app.config['PAGE_SIZE_MAX'])
+
+    after = decode_cursor(cursor) if cursor else None
+
+    return limit, after
+
+
+def paginate(rows, limit, key):
+    """
+    Split a page off rows queried with ``limit + 1``.
+    :param rows: rows of the page, plus one if there is a next page
+    :param limit: page size
+    :param key: function returning the keyset value of a row
+    :return: (rows, next_cursor) where next_cursor is None on the last page
+    """
+    if len(rows) <= limit:
+        return rows, None
+
+    rows = rows[:limit]
+
+    return rows, encode_cursor(key(rows[-1]))
+
+
+def json_response(body, status=200):
+    """
+    Create a json response from an already serialized body.
+    """
+    return Response(body, status=status, mimetype="application/json")
+
+
+def conditional_json_response(body, etag):
+    """
+    Create a json response carrying an ETag. When the request's If-None-Match already holds the ETag
+    an empty 304 is returned instead of the body.
+    :param body: serialized json body
+    :param etag: strong ETag of the body
+    """
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = json_response(body)
+
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+
+    return response
+
 
 def error_message(msg):
     return status_message(msg, status="error")
 
 
 def status_message(msg, status="success"):
-    return jsonify({
+    return json_response(serializers.dumps({
         'status': status,
         'message': msg
-    })
+    }))
 
 
-def is_validated_user_request(request):
+class Identity(object):
     """
-    Checks whether or not the request passed is a validated user request by comparing the Authorization Header.
-    :param request: request to check
-    :return:
+    Identity of the user making the current request, resolved from its authorization header.
+    The token is decoded once when the identity is created, the user and the nodes of their permissions are
+    loaded together by a single query the first time either is needed, seeding the permission cache.
+    Tokens carrying permission claims are authorized from them while the user's permissions version hasn't moved.
     """
 
-    auth_header = request.headers.get('Authorization')
+    def __init__(self, token=None, claims=None, debug_email=None):
+        """
+        :param token: bearer token of the request, None when the authorization header is missing or malformed
+        :param claims: decoded claims of the token, None when it isn't a valid token
+        :param debug_email: email of the debug user of a debug bearer token
+        """
+        self.token = token
+        self.claims = claims
+        self.debug_email = debug_email
 
-    if not auth_header:
-        return False
+        self._loaded = False
+        self._user = None
+        self._claims_current = None
 
-    # Split after 'Bearer '
+    @classmethod
+    def from_request(cls, request):
+        token = get_auth_token(request)
 
-    if ' ' not in auth_header:
-        return False
+        if token is None:
+            return cls()
 
-    token = auth_header.split(' ')[1]
+        if token == Config.DEBUG_USER_AUTHORIZATION_BEARER:
+            return cls(token, debug_email="testuser@firepot.ca")
+
+        if token == Config.DEBUG_ADMIN_AUTHORIZATION_BEARER:
+            return cls(token, debug_email="testadmin@firepot.ca")
+
+        claims = decode_auth_token(token)
+
+        return cls(token, claims=claims if claims is not False else None)
+
+    @property
+    def authenticated(self):
+        return self.claims is not None or self.debug_email is not None
+
+    @property
+    def user_id(self):
+        if self.claims is not None:
+            return self.claims.get('sub')
+
+        user = self.user
+
+        return user.id if user is not None else None
+
+    @property
+    def user(self):
+        self._load()
+        return self._user
+
+    @property
+    def claims_current(self):
+        """
+        Whether the token's permission claims are still those of the user.
+        """
+        if self._claims_current is None:
+            self._claims_current = self.claims is not None and 'pv' in self.claims and \
+                permissions.permissions_version(self.claims.get('sub')) == self.claims['pv']
+
+        return self._claims_current
+
+    @property
+    def permissions(self):
+        if self.claims_current:
+            return frozenset(self.claims.get('perms', ()))
 
-    if token == Config.DEBUG_USER_AUTHORIZATION_BEARER or token == Config.DEBUG_ADMIN_AUTHORIZATION_BEARER:
-        return True
+        user = self.user
 
-    payload = decode_auth_token(token)
+        return user.permission_nodes() if user is not None else frozenset()
 
-    if payload is False:  # If we has no payload.
-        return False
+    def has_permission(self, node):
+        return node in self.permissions
 
-    return True
+    def _load(self):
+        if self._loaded:
+            return
+
+        self._loaded = True
+
+        if self.claims is not None:
+            criteria = dict(id=self.claims.get('sub'))
+        elif self.debug_email is not None:
+            criteria = dict(email=self.debug_email)
+        else:
+            return
+
+        self._user, nodes = User.get_with_permission_nodes(**criteria)
+
+        if self._user is not None:
+            # Seed the permission cache, the user's checks are then answered without querying.
+            permissions.permission_cache.set(self._user.id, nodes)
+        elif self.debug_email is not None:
+            self._user = _create_debug_user(self.debug_email)
+
+
+def _create_debug_user(email):
+    if email == "testadmin@firepot.ca":
+        debug_user = User(name="Test Admin", password="testadminfirepotca", email=email)
+        debug_user.save(commit=True)
+        print("Created Test Admin for FirePot Debugging")
+    else:
+        debug_user = User(name="Test User", password="testuserfirepot", email=email)
+        debug_user.save(commit=True)
+        print("Created Test User for Firepot Debugging")
+
+    return debug_user
+
+
+def load_identity():
+    """
+    Resolve the identity of the current request onto ``flask.g``, registered to run before every request.
+    """
+    g.identity = Identity.from_request(request)
+
+
+def current_identity():
+    """
+    Identity of the current request, resolved on first use when :func:`load_identity` hasn't run.
+    :return: :class:`Identity`
+    """
+    if 'identity' not in g:
+        load_identity()
+
+    return g.identity
+
+
+def is_validated_user_request(request):
+    """
+    Checks whether or not the request passed is a validated user request by comparing the Authorization Header.
+    :param request: request to check
+    :return:
+    """
+
+    return current_identity().authenticated
 
 
 def admins_only(api_method):
@@ -82,16 +361,16 @@ def admins_only(api_method):
     @wraps(api_method)
     @validate_auth_token
     def decorated_method(*args, **kwargs):
-        user = get_user(request)
+        identity = current_identity()
 
-        if user is None:
+        if not identity.claims_current and identity.user is None:
             LOGGER.debug("Admin Only:: Unable to verify user")
             return jsonify({
                 'status': 'error',
                 'message': 'Unable to identify user'
             }), 401
 
-        if not user.has_permission(permissions.ADMIN_PERMS):
+        if not identity.has_permission(permissions.ADMIN_PERMS):
             LOGGER.debug("Admin Only:: Insufficient Permissions")
             return jsonify({
                 'status': 'error',
@@ -112,33 +391,23 @@ def validate_auth_token(api_method):
 
     @wraps(api_method)
     def decorated_method(*args, **kwargs):
-        auth_header = request.headers.get('Authorization')
-
-        if auth_header is None:
+        if request.headers.get('Authorization') is None:
             LOGGER.debug("Validate Auth Token:: Unable to locate authorization header")
             return jsonify({
                 'status': 'error',
                 'message': "Unable to locate authorization header"
             }), 401
 
-        if ' ' not in auth_header:
+        identity = current_identity()
+
+        if identity.token is None:
             LOGGER.debug("Validate Auth Token: Invalid Authorization token")
             return jsonify({
                 'status': 'error',
                 'message': 'Invalid auth token'
             })
 
-        # Split after 'Bearer '
-        token = auth_header.split(' ')[1]
-
-        LOGGER.debug(f'Authentication Token is {token}')
-
-        if token == Config.DEBUG_ADMIN_AUTHORIZATION_BEARER or token == Config.DEBUG_USER_AUTHORIZATION_BEARER:
-            return api_method(*args, **kwargs)
-
-        payload = decode_auth_token(token)
-
-        if payload is False:
+        if not identity.authenticated:
             LOGGER.debug("Validate Auth Token: Expired Session")
             return jsonify({
                 'status': 'error',
@@ -150,13 +419,23 @@ def validate_auth_token(api_method):
     return decorated_method
 
 
-def encode_auth_token(user_id):
+def encode_auth_token(user_id, permission_nodes=None, permissions_version=None):
+    """
+    :param permission_nodes: nodes of the user's permissions, embedded in the token (``perms`` claim)
+        along with ``permissions_version`` (``pv`` claim) so requests can be authorized without querying them.
+    :param permissions_version: permissions version of the user the nodes were read at
+    """
     try:
         payload = {
             'exp': datetime.datetime.timestamp(datetime.datetime.utcnow() + datetime.timedelta(days=1)),
             'iat': datetime.datetime.timestamp(datetime.datetime.utcnow()),
             'sub': user_id,
         }
+
+        if permission_nodes is not None and permissions_version is not None:
+            payload['perms'] = sorted(permission_nodes)
+            payload['pv'] = permissions_version
+
         token = jwt.encode(payload, Config.SECRET_KEY, algorithm='HS256')
         return token
     except Exception as e:
@@ -165,8 +444,19 @@ def encode_auth_token(user_id):
 
 
 def decode_auth_token(token):
+    """
+    Verify an authentication token and decode its claims.
+    Verified tokens are cached until they expire, so a token is only verified once per worker.
+    :return: claims of the token, False if it is invalid or expired
+    """
+    payload = token_cache.get(token)
+
+    if payload is not None:
+        return payload
+
     try:
         payload = jwt.decode(token, Config.SECRET_KEY, algorithms=['HS256'])
+        token_cache.set(token, payload, expires_at=payload.get('exp'))
         return payload
     except jwt.ExpiredSignatureError as jweEs:
         # todo handle expired signature
@@ -202,14 +492,7 @@ def get_user(request):
     :return: User or None
     """
 
-    uid = get_user_id(request)
-
-    if uid is None:
-        return None
-
-    user = User.query.filter_by(id=get_user_id(request)).first()
-
-    return user
+    return current_identity().user
 
 
 def get_user_id(request):
@@ -219,35 +502,7 @@ def get_user_id(request):
     :return: user id if present.
     """
 
-    value = None
-
-    token = get_auth_token(request)
-
-    if token == Config.DEBUG_USER_AUTHORIZATION_BEARER:
-        debug_user = User.query.filter_by(email="testuser@firepot.ca").first()
-
-        if debug_user is None:
-            debug_user = User(name="Test User", password="testuserfirepot", email="testuser@firepot.ca")
-            debug_user.save(commit=True)
-            print("Created Test User for Firepot Debugging")
-
-        return User.query.filter_by(email='testuser@firepot.ca').first().id
-
-    if token == Config.DEBUG_ADMIN_AUTHORIZATION_BEARER:
-        admin_user = User.query.filter_by(email="testadmin@firepot.ca").first()
-        if admin_user is None:
-            admin_user = User(name="Test Admin", password="testadminfirepotca", email="testadmin@firepot.ca")
-            admin_user.save(commit=True)
-            print("Created Test Admin for FirePot Debugging")
-
-        return User.query.filter_by(email="testadmin@firepot.ca").first().id
-
-    try:
-        value = decode_auth_token(get_auth_token(request))['sub']
-    except:  # todo logging
-        pass
-
-    return value
+    return current_identity().user_id
 
 
 def json_only(api_method):
@@ -269,3 +524,94 @@ def json_only(api_method):
         return api_method(*args, **kwargs)
 
     return decorated_method
+
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+
+
+def _request_in_progress():
+    response = make_response(error_message(messages.IDEMPOTENT_REQUEST_IN_PROGRESS), 409)
+    response.headers['Retry-After'] = "1"
+    return response
+
+
+def idempotent(api_method):
+    """
+    Decorator replaying the response of a request retried with the same ``Idempotency-Key`` header, instead of
+    processing it again. Goes below the authentication decorators, keys being scoped to the user and endpoint.
+
+    The response is stored for IDEMPOTENCY_TTL seconds, unless it's a server error, so a retry costs a single
+    lookup. Retries sent while the first request is processed are answered with a 409, and reusing a key for
+    another request body with a 422. Requests without the header are processed as usual.
+
+    The handler commits its work in transactions of its own, and its response is only stored afterwards, in
+    another one: the response isn't known before the handler returns. A worker dying between the two leaves the
+    key in progress until IDEMPOTENCY_LEASE runs out, and a retry past it processes the request again against
+    what the first one committed. A checkout then finds its cart empty, so the key stores that response and
+    the client never receives its order id, which it can still find in its order history.
+    """
+
+    @wraps(api_method)
+    def decorated_method(*args, **kwargs):
+        key = request.headers.get(IDEMPOTENCY_HEADER)
+
+        if key is None:
+            return api_method(*args, **kwargs)
+
+        if not 0 < len(key) <= 128:
+            return error_message(messages.INVALID_IDEMPOTENCY_KEY), 400
+
+        scope = (current_identity().user_id or 0, request.endpoint, key)
+        request_hash = hashlib.sha256(request.get_data()).hexdigest()
+
+        record = IdempotencyRecord.lookup(*scope)
+        claimed = False
+
+        if record is None:
+            lease = datetime.timedelta(seconds=current_app.config['IDEMPOTENCY_LEASE'])
+
+            # A failed claim means a concurrent request claimed the key meanwhile. When it released the key
+            # before the lookup following, the key is claimed again, once.
+            for attempt in range(2):
+                claimed = IdempotencyRecord.claim(*scope, request_hash=request_hash, lease=lease)
+
+                if claimed:
+                    break
+
+                record = IdempotencyRecord.lookup(*scope)
+
+                if record is not None:
+                    break
+
+        if record is not None:
+            if record.request_hash != request_hash:
+                return error_message(messages.IDEMPOTENCY_KEY_REUSED), 422
+
+            if record.status_code is None:
+                return _request_in_progress()
+
+            response = json_response(record.body, status=record.status_code)
+            response.headers['Idempotent-Replayed'] = "true"
+            return response
+
+        if not claimed:
+            # The key keeps changing hands, the request is never processed without holding it.
+            return _request_in_progress()
+
+        try:
+            response = make_response(api_method(*args, **kwargs))
+        except Exception:
+            db.session.rollback()
+            IdempotencyRecord.release(*scope)
+            raise
+
+        if response.status_code >= 500 or response.is_streamed:
+            db.session.rollback()
+            IdempotencyRecord.release(*scope)
+        else:
+            ttl = datetime.timedelta(seconds=current_app.config['IDEMPOTENCY_TTL'])
+            IdempotencyRecord.complete(*scope, status_code=response.status_code, body=response.get_data(), ttl=ttl)
+
+        return response
+
+    return decorated_method
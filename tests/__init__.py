@@ -1,6 +1,10 @@
+import datetime
 import os
 import tempfile
 import unittest
+from contextlib import contextmanager
+
+from sqlalchemy import event
 
 from firepot.factory import create_app
 
@@ -8,12 +12,37 @@ from firepot.config import Config, TestConfig
 
 from firepot.extensions import db
 
+# Smallest data the image uploads accept, the signature of a PNG.
+IMAGE_DATA = "data:image/png;base64,iVBORw0KGgo="
+
 
 def clean_db(db):
     for table in reversed(db.metadata.sorted_tables):
         db.session.execute(table.delete())
 
 
+class QueryCounter(object):
+    """
+    Counts the statements executed against an engine while it is active.
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+
+
+@contextmanager
+def count_queries(db):
+    counter = QueryCounter()
+    event.listen(db.engine, 'before_cursor_execute', counter)
+    try:
+        yield counter
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', counter)
+
+
 class TestCase(unittest.TestCase):
     @classmethod
     def setUpClass(cls) -> None:
@@ -39,6 +68,12 @@ class TestCase(unittest.TestCase):
         import firepot.models
         clean_db(self.db)
 
+        # Rows removed by clean_db bypass the session events that keep the caches current.
+        from firepot import catalog, search, permissions
+        catalog.invalidate()
+        search.trigram_index.invalidate()
+        permissions.invalidate()
+
     def tearDown(self):
         # db.session.rollback()
         # db.drop_all()
@@ -49,3 +84,39 @@ class TestCase(unittest.TestCase):
         self.app_context.pop()
 
         super(TestCase, self).tearDown()
+
+    def auth_headers(self, admin=False, email="user@firepot.ca", phone_number="7090000000"):
+        from firepot.models import User
+        from firepot.utils import encode_auth_token
+        from firepot import permissions
+
+        user = User(first_name="b", last_name="c", email=email, phone_number=phone_number,
+                    password="testing", birth_date=datetime.datetime(1990, 1, 1))
+        user.save(commit=True)
+
+        if admin:
+            user.add_permission(permissions.ADMIN_PERMS)
+
+        token = encode_auth_token(user.id)
+
+        if isinstance(token, bytes):
+            token = token.decode("utf-8")
+
+        return {'Authorization': 'Bearer {0}'.format(token)}
+
+    def create_item(self, name, product_count=2, tag_names=("Sativa",), stock=10):
+        from firepot.models import Item, Product, Image, Tag
+
+        image = Image(name="{0}_1".format(name), data=IMAGE_DATA)
+        image.save(commit=True)
+
+        tags = [Tag.get_or_create(name=tag_name) for tag_name in tag_names]
+
+        item = Item(name=name, description="{0} description".format(name), cover_image_id=image.id,
+                    images=[image], tags=tags, stock=stock)
+        item.save(commit=True)
+
+        for i in range(product_count):
+            Product(name="{0} ({1}g)".format(name, i + 1), item_id=item.id, cost=10 * (i + 1)).save(commit=True)
+
+        return item
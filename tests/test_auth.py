@@ -0,0 +1,307 @@
+import json
+
+from tests import TestCase, count_queries
+
+
+class TestAuth(TestCase):
+
+    def test_admin_request_single_identity_query(self):
+        headers = self.auth_headers(admin=True)
+        client = self.app.test_client()
+
+        with count_queries(self.db) as counter:
+            req = client.get("/admin/", headers=headers)
+
+        self.assertEqual(req.status_code, 200)
+        self.assertEqual(counter.count, 1)
+
+    def test_non_admin_request_rejected(self):
+        headers = self.auth_headers(admin=False)
+        client = self.app.test_client()
+
+        with count_queries(self.db) as counter:
+            req = client.get("/admin/metrics/", headers=headers)
+
+        self.assertEqual(req.status_code, 401)
+        self.assertEqual(json.loads(req.data)['message'], 'Admin permissions required')
+        self.assertEqual(counter.count, 1)
+
+    def test_invalid_token_rejected_without_query(self):
+        client = self.app.test_client()
+
+        with count_queries(self.db) as counter:
+            req = client.get("/admin/metrics/", headers={'Authorization': 'Bearer not-a-token'})
+
+        self.assertEqual(req.status_code, 401)
+        self.assertEqual(json.loads(req.data)['message'], 'Expired session')
+        self.assertEqual(counter.count, 0)
+
+    def test_permission_cache(self):
+        import datetime
+        from firepot import permissions
+        from firepot.models import User, UserPermission
+
+        user = User(first_name="b", last_name="c", email="user@firepot.ca", phone_number="7090000000",
+                    password="testing", birth_date=datetime.datetime(1990, 1, 1))
+        user.save(commit=True)
+
+        self.assertFalse(user.has_permission(permissions.ADMIN_PERMS))
+
+        with count_queries(self.db) as counter:
+            self.assertFalse(user.has_permission(permissions.ADMIN_PERMS))
+
+        self.assertEqual(counter.count, 0)
+
+        # Granting the permission drops the cached set on commit.
+        self.assertTrue(user.add_permission(permissions.ADMIN_PERMS))
+
+        UserPermission.query.filter_by(user_id=user.id).first().delete(commit=True)
+
+        self.assertFalse(user.has_permission(permissions.ADMIN_PERMS))
+        self.assertGreater(permissions.permission_cache.stats()['hits'], 0)
+
+    def test_token_cache(self):
+        import time
+        import jwt
+        from firepot.config import Config
+        from firepot.utils import encode_auth_token, decode_auth_token, token_cache
+
+        self.assertEqual(token_cache.maxsize, self.app.config['TOKEN_CACHE_SIZE'])
+
+        token = encode_auth_token(42)
+        hits = token_cache.hits
+
+        self.assertEqual(decode_auth_token(token)['sub'], 42)
+        self.assertEqual(decode_auth_token(token)['sub'], 42)
+        self.assertEqual(token_cache.hits, hits + 1)
+
+        expired = jwt.encode({'sub': 42, 'exp': time.time() - 10}, Config.SECRET_KEY, algorithm='HS256')
+
+        self.assertFalse(decode_auth_token(expired))
+        self.assertIsNone(token_cache.get(expired))
+
+        # Cached claims expire along with their token.
+        token_cache.set(token, {'sub': 42}, expires_at=time.time() - 1)
+
+        self.assertIsNone(token_cache.get(token))
+
+    def test_permission_claims(self):
+        import datetime
+        from firepot import permissions
+        from firepot.models import User, UserPermission
+        from firepot.utils import encode_auth_token
+
+        user = User(first_name="b", last_name="c", email="user@firepot.ca", phone_number="7090000000",
+                    password="testing", birth_date=datetime.datetime(1990, 1, 1))
+        user.save(commit=True)
+        user.add_permission(permissions.ADMIN_PERMS)
+
+        self.assertEqual(user.permissions_version, 1)
+
+        headers = {'Authorization': 'Bearer {0}'.format(
+            encode_auth_token(user.id, user.permission_nodes(), user.permissions_version))}
+        client = self.app.test_client()
+
+        client.get("/admin/", headers=headers)
+
+        with count_queries(self.db) as counter:
+            req = client.get("/admin/", headers=headers)
+
+        self.assertEqual(req.status_code, 200)
+        self.assertEqual(counter.count, 0)
+
+        # Revoking the permission moves the version, the claims no longer authorize the token.
+        UserPermission.query.filter_by(user_id=user.id).first().delete(commit=True)
+
+        req = client.get("/admin/metrics/", headers=headers)
+
+        self.assertEqual(req.status_code, 401)
+
+    def test_login_claims_ignore_stale_cache(self):
+        import jwt
+        from firepot import permissions
+        from firepot.models import User
+
+        self.auth_headers(admin=True)
+        user = User.query.filter_by(email="user@firepot.ca").first()
+
+        # Revoked by another worker: this worker's cache still holds the node, the version has moved on.
+        stale = user.permission_nodes()
+        user_id = user.id
+        self.db.session.execute("DELETE FROM user_permissions WHERE user_id = :id", {'id': user_id})
+        self.db.session.execute("UPDATE \"user\" SET permissions_version = permissions_version + 1 WHERE id = :id",
+                                {'id': user_id})
+        self.db.session.commit()
+        permissions.permission_cache.set(user_id, stale)
+
+        req = self.app.test_client().post("/auth/login/", json={'email': "user@firepot.ca", 'password': "testing"})
+        _json = json.loads(req.data)['payload']
+        claims = jwt.decode(_json['auth'], options={'verify_signature': False})
+
+        self.assertFalse(_json['admin'])
+        self.assertNotIn(permissions.ADMIN_PERMS, claims['perms'])
+        self.assertEqual(claims['pv'], 2)
+
+    def test_login_rehashes_password(self):
+        from firepot.extensions import password_hasher
+        from firepot.models import User
+
+        self.auth_headers()
+        rounds = password_hasher.rounds
+        password_hasher.rounds = rounds + 2
+
+        try:
+            req = self.app.test_client().post("/auth/login/", json={'email': "user@firepot.ca", 'password': "testing"})
+
+            self.assertEqual(json.loads(req.data)['status'], 'success')
+
+            user = User.query.filter_by(email="user@firepot.ca").first()
+
+            self.assertEqual(user.password_rounds, rounds + 2)
+            self.assertTrue(user.check_password("testing"))
+        finally:
+            password_hasher.rounds = rounds
+
+    def test_login_overloaded(self):
+        from firepot.extensions import password_hasher
+
+        self.auth_headers()
+
+        password_hasher.configure(concurrency=1, queue_depth=0)
+        password_hasher._slots.acquire()
+
+        try:
+            req = self.app.test_client().post("/auth/login/", json={'email': "user@firepot.ca", 'password': "testing"})
+
+            self.assertEqual(req.status_code, 503)
+            self.assertEqual(req.headers['Retry-After'], str(password_hasher.retry_after))
+            self.assertGreater(password_hasher.stats()['rejected'], 0)
+        finally:
+            password_hasher.init_app(self.app)
+
+    def test_rate_limited_login(self):
+        from firepot import ratelimit
+
+        self.auth_headers()
+        client = self.app.test_client()
+
+        ratelimit.limiter.configure({ratelimit.SCOPE_IP: (2, 60), ratelimit.SCOPE_EMAIL: (3, 60)},
+                                    ratelimit.MemoryBackend())
+        ratelimit.limiter.enabled = True
+
+        def login(remote_addr):
+            return client.post("/auth/login/", json={'email': "user@firepot.ca", 'password': "testing"},
+                               environ_base={'REMOTE_ADDR': remote_addr})
+
+        try:
+            self.assertEqual(login("10.0.0.1").status_code, 200)
+            self.assertEqual(login("10.0.0.1").status_code, 200)
+
+            req = login("10.0.0.1")
+
+            self.assertEqual(req.status_code, 429)
+            self.assertIn('Retry-After', req.headers)
+
+            # Another ip is refused once the account's own limit is reached.
+            self.assertEqual(login("10.0.0.2").status_code, 200)
+            self.assertEqual(login("10.0.0.3").status_code, 429)
+
+            self.assertEqual(ratelimit.limiter.stats()['rejected'],
+                             {ratelimit.SCOPE_IP: 1, ratelimit.SCOPE_EMAIL: 1})
+        finally:
+            ratelimit.init_app(self.app)
+            ratelimit.limiter.rejected.clear()
+
+    def test_memory_rate_limit_bounded(self):
+        from firepot.ratelimit import MemoryBackend
+
+        backend = MemoryBackend(maxsize=100)
+
+        for i in range(1000):
+            backend.acquire("email:{0}".format(i), 30, 60, 1)
+
+            # Kept in use, never evicted.
+            if i % 50 == 0:
+                self.assertTrue(backend.acquire("email:hot", 0.1, 60, 1)[0])
+
+        self.assertEqual(len(backend._arrivals), 100)
+        self.assertIn("email:hot", backend._arrivals)
+        self.assertNotIn("email:0", backend._arrivals)
+
+    def test_shared_memory_rate_limit(self):
+        import os
+        import tempfile
+        from firepot.ratelimit import SharedMemoryBackend
+
+        path = os.path.join(tempfile.mkdtemp(), "ratelimit")
+
+        first = SharedMemoryBackend(path, slots=64)
+        second = SharedMemoryBackend(path, slots=64)
+
+        self.assertTrue(first.acquire("ip:10.0.0.1", 30, 60, 1000)[0])
+        self.assertTrue(second.acquire("ip:10.0.0.1", 30, 60, 1000)[0])
+
+        allowed, retry_after = first.acquire("ip:10.0.0.1", 30, 60, 1000)
+
+        self.assertFalse(allowed)
+        self.assertEqual(retry_after, 30)
+        self.assertTrue(second.acquire("ip:10.0.0.1", 30, 60, 1030)[0])
+
+    def test_refresh_token_rotation(self):
+        import jwt
+        from firepot import permissions
+        from firepot.models import UserSession
+
+        self.auth_headers(admin=True)
+        client = self.app.test_client()
+
+        req = client.post("/auth/login/", json={'email': "user@firepot.ca", 'password': "testing"})
+        refresh_token = json.loads(req.data)['payload']['refresh']
+
+        self.assertIsNone(UserSession.query.filter_by(token_hash=refresh_token).first())
+
+        with count_queries(self.db) as counter:
+            req = client.post("/auth/refresh/", json={'refresh': refresh_token})
+
+        _json = json.loads(req.data)
+
+        self.assertEqual(_json['status'], 'success')
+        self.assertNotEqual(_json['payload']['refresh'], refresh_token)
+        self.assertLessEqual(counter.count, 2)
+
+        req = client.get("/admin/metrics/", headers={'Authorization': 'Bearer {0}'.format(_json['payload']['auth'])})
+
+        self.assertEqual(req.status_code, 200)
+
+        # The exchanged token can't be used again.
+        req = client.post("/auth/refresh/", json={'refresh': refresh_token})
+
+        self.assertEqual(req.status_code, 401)
+
+        # Revoked by another worker while this one caches the old nodes: the refreshed token isn't admin.
+        user_id = UserSession.query.first().user_id
+        permissions.permission_cache.set(user_id, frozenset([permissions.ADMIN_PERMS]))
+        self.db.session.execute("DELETE FROM user_permissions WHERE user_id = :id", {'id': user_id})
+        self.db.session.execute("UPDATE \"user\" SET permissions_version = permissions_version + 1 WHERE id = :id",
+                                {'id': user_id})
+        self.db.session.commit()
+
+        req = client.post("/auth/refresh/", json={'refresh': _json['payload']['refresh']})
+        claims = jwt.decode(json.loads(req.data)['payload']['auth'], options={'verify_signature': False})
+
+        self.assertEqual(claims['perms'], [])
+
+    def test_purge_sessions_command(self):
+        import datetime
+        from firepot.models import User, UserSession
+
+        self.auth_headers()
+        user = User.query.filter_by(email="user@firepot.ca").first()
+
+        UserSession.start(user.id, datetime.timedelta(days=1))
+        UserSession.start(user.id, datetime.timedelta(days=-1))
+
+        result = self.app.test_cli_runner().invoke(args=['sessions', 'purge'])
+
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertEqual(UserSession.query.count(), 1)
@@ -0,0 +1,216 @@
+import datetime
+import hashlib
+import json
+from unittest import mock
+
+from tests import TestCase, count_queries
+
+
+class TestCart(TestCase):
+
+    def test_cart_add_and_set(self):
+        headers = self.auth_headers()
+        client = self.app.test_client()
+
+        first, second = self.create_item("Blue Dream", product_count=2).products.all()
+
+        req = client.post("/cart/add/", headers=headers, json={'items': [
+            {'product_id': first.id, 'amount': 1},
+            {'product_id': second.id, 'amount': 2},
+            {'product_id': first.id, 'amount': 1},
+        ]})
+
+        _json = json.loads(req.data)
+
+        self.assertEqual(_json['status'], 'success')
+        self.assertEqual([(line['product_id'], line['amount']) for line in _json['payload']['items']],
+                         [(first.id, 2), (second.id, 2)])
+        self.assertEqual(_json['payload']['total'], 2 * 10 + 2 * 20)
+
+        with count_queries(self.db) as counter:
+            req = client.post("/cart/add/", headers=headers, json={'items': [{'product_id': first.id, 'amount': 3}]})
+
+        # The upsert, then the cart.
+        self.assertEqual(counter.count, 2)
+        self.assertEqual(json.loads(req.data)['payload']['items'][0]['amount'], 5)
+
+        req = client.post("/cart/set/", headers=headers, json={'items': [
+            {'product_id': first.id, 'amount': 0},
+            {'product_id': second.id, 'amount': 7},
+        ]})
+
+        items = json.loads(req.data)['payload']['items']
+
+        self.assertEqual([(line['product_id'], line['amount'], line['name']) for line in items],
+                         [(second.id, 7, "Blue Dream Blue Dream (2g)")])
+
+        req = client.get("/cart/", headers=headers)
+
+        self.assertEqual(json.loads(req.data)['payload']['total'], 7 * 20)
+
+    def test_cart_invalid_changes(self):
+        from firepot import messages
+
+        headers = self.auth_headers()
+        client = self.app.test_client()
+
+        req = client.post("/cart/add/", headers=headers, json={'items': [{'product_id': "1", 'amount': 1}]})
+
+        self.assertEqual(json.loads(req.data)['message'], messages.INVALID_CART_ITEMS)
+
+        req = client.post("/cart/add/", headers=headers, json={'items': [{'product_id': 999999, 'amount': 1}]})
+
+        self.assertEqual(json.loads(req.data)['message'], messages.UNKNOWN_CART_PRODUCT)
+
+        product = self.create_item("Blue Dream", product_count=1).products.first()
+
+        # Out of the range of the integer columns
+        for items in ([{'product_id': 2 ** 31, 'amount': 1}],
+                      [{'product_id': -1, 'amount': 1}],
+                      [{'product_id': product.id, 'amount': 2 ** 31}],
+                      [{'product_id': product.id, 'amount': 2 ** 30}, {'product_id': product.id, 'amount': 2 ** 30}]):
+            req = client.post("/cart/add/", headers=headers, json={'items': items})
+
+            self.assertEqual(json.loads(req.data)['message'], messages.INVALID_CART_ITEMS)
+
+        req = client.post("/cart/add/", headers=headers,
+                          json={'items': [{'product_id': product.id, 'amount': 2 ** 31 - 1}]})
+
+        self.assertEqual(json.loads(req.data)['status'], 'success')
+
+        # Added to the line already in the cart
+        req = client.post("/cart/add/", headers=headers, json={'items': [{'product_id': product.id, 'amount': 1}]})
+
+        self.assertEqual(json.loads(req.data)['message'], messages.INVALID_CART_ITEMS)
+
+    def test_checkout_reserves_stock(self):
+        from firepot.models import Item, CartItem
+
+        item = self.create_item("Blue Dream", product_count=2, stock=10)
+        first, second = item.products.all()
+        item_id = item.id
+
+        client = self.app.test_client()
+        buyer = self.auth_headers(email="buyer@firepot.ca", phone_number="7090000001")
+        other = self.auth_headers(email="other@firepot.ca", phone_number="7090000002")
+
+        # 1 x 1g + 3 x 2g takes 7 of the 10 in stock.
+        second.stock_weight = 2
+        second.save(commit=True)
+
+        client.post("/cart/add/", headers=buyer, json={'items': [{'product_id': first.id, 'amount': 1},
+                                                                 {'product_id': second.id, 'amount': 3}]})
+        client.post("/cart/add/", headers=other, json={'items': [{'product_id': second.id, 'amount': 2}]})
+
+        req = client.post("/cart/checkout/", headers=buyer)
+
+        self.assertEqual(json.loads(req.data)['status'], 'success')
+        self.assertEqual(Item.query.get(item_id).stock, 3)
+
+        req = client.post("/cart/checkout/", headers=other)
+
+        self.assertEqual(req.status_code, 409)
+        self.assertEqual(json.loads(req.data)['payload']['item_id'], item_id)
+        self.assertEqual(Item.query.get(item_id).stock, 3)
+        self.assertEqual(CartItem.query.filter_by(product_id=second.id).count(), 1)
+
+        req = client.post("/cart/checkout/", headers=buyer)
+
+        self.assertEqual(json.loads(req.data)['status'], 'error')
+
+    def test_checkout_idempotency_key(self):
+        from firepot import messages
+        from firepot.models import Order, IdempotencyRecord
+
+        product = self.create_item("Blue Dream", product_count=1).products.first()
+        headers = self.auth_headers()
+        client = self.app.test_client()
+
+        client.post("/cart/add/", headers=headers, json={'items': [{'product_id': product.id, 'amount': 2}]})
+
+        retry_headers = dict(headers, **{'Idempotency-Key': "checkout-1"})
+        first = client.post("/cart/checkout/", headers=retry_headers)
+
+        with count_queries(self.db) as counter:
+            retry = client.post("/cart/checkout/", headers=retry_headers)
+
+        self.assertEqual(counter.count, 1)
+        self.assertEqual(retry.status_code, first.status_code)
+        self.assertEqual(retry.data, first.data)
+        self.assertEqual(retry.headers['Idempotent-Replayed'], "true")
+        self.assertEqual(Order.query.count(), 1)
+
+        # Without the key the empty cart is checked out again.
+        self.assertEqual(json.loads(client.post("/cart/checkout/", headers=headers).data)['status'], 'error')
+
+        req = client.post("/cart/checkout/", headers=retry_headers, json={'other': 'body'})
+
+        self.assertEqual(req.status_code, 422)
+
+        # A key claimed and released by concurrent requests on every attempt is never processed unclaimed
+        with mock.patch.object(IdempotencyRecord, 'claim', return_value=False) as claim, \
+                mock.patch.object(IdempotencyRecord, 'lookup', return_value=None):
+            req = client.post("/cart/checkout/", headers=dict(headers, **{'Idempotency-Key': "checkout-3"}))
+
+        self.assertEqual(req.status_code, 409)
+        self.assertEqual(json.loads(req.data)['message'], messages.IDEMPOTENT_REQUEST_IN_PROGRESS)
+        self.assertEqual(claim.call_count, 2)
+        self.assertEqual(Order.query.count(), 1)
+
+        user_id = Order.query.one().user_id
+        IdempotencyRecord.claim(user_id, 'firepot.routes.cart.checkout', "checkout-2", request_hash=hashlib.sha256(b"").hexdigest(),
+                                lease=datetime.timedelta(minutes=1))
+
+        # A retry of a request still being processed.
+        req = client.post("/cart/checkout/", headers=dict(headers, **{'Idempotency-Key': "checkout-2"}))
+
+        self.assertEqual(req.status_code, 409)
+        self.assertEqual(req.headers['Retry-After'], "1")
+
+        IdempotencyRecord.query.update({IdempotencyRecord.expires_at: datetime.datetime.utcnow()})
+        self.db.session.commit()
+
+        result = self.app.test_cli_runner().invoke(args=['idempotency', 'purge', '--batch-size', '1'])
+
+        self.assertIn("Purged 2 expired idempotency keys", result.output)
+        self.assertEqual(IdempotencyRecord.query.count(), 0)
+
+    def test_cart_quote(self):
+        from firepot.models import Product
+
+        first, second = self.create_item("Blue Dream", product_count=2).products.all()
+        second.update(sale_cost=15)
+
+        headers = self.auth_headers()
+        client = self.app.test_client()
+
+        client.post("/cart/add/", headers=headers, json={'items': [{'product_id': first.id, 'amount': 3},
+                                                                   {'product_id': second.id, 'amount': 2}]})
+
+        with count_queries(self.db) as counter:
+            req = client.get("/cart/quote/", headers=headers)
+
+        self.assertEqual(counter.count, 1)
+
+        quote = json.loads(req.data)['payload']
+
+        self.assertEqual([(line['amount'], line['price'], line['line_total']) for line in quote['items']],
+                         [(3, 10, 30), (2, 15, 30)])
+        self.assertEqual(quote['total'], 60)
+
+        # The cart is priced and totaled by the same expressions, in its one query
+        with count_queries(self.db) as counter:
+            cart = json.loads(client.get("/cart/", headers=headers).data)['payload']
+
+        self.assertEqual(counter.count, 1)
+        self.assertEqual([line['price'] for line in cart['items']], [10, 15])
+        self.assertEqual(cart['total'], quote['total'])
+
+        self.assertEqual([product.id for product in Product.query.filter(Product.on_sale)], [second.id])
+        self.assertEqual(self.db.session.query(self.db.func.sum(Product.effective_cost)).scalar(), 25)
+
+        client.post("/cart/set/", headers=headers, json={'items': [{'product_id': first.id, 'amount': 0},
+                                                                   {'product_id': second.id, 'amount': 0}]})
+
+        self.assertEqual(json.loads(client.get("/cart/quote/", headers=headers).data)['payload'],
+                         {'items': [], 'total': 0})
@@ -0,0 +1,330 @@
+import json
+
+from tests import TestCase, count_queries
+
+
+class TestCatalog(TestCase):
+
+    def _get_products(self, headers):
+        self.db.session.expire_all()
+
+        with count_queries(self.db) as counter:
+            req = self.app.test_client().get("/store/products", headers=headers)
+
+        return json.loads(req.data), counter.count
+
+    def test_store_products_query_count_is_constant(self):
+        headers = self.auth_headers()
+
+        for i in range(2):
+            self.create_item("Small Catalog {0}".format(i))
+
+        _json, small_count = self._get_products(headers)
+
+        self.assertEqual(_json['status'], 'success')
+        self.assertEqual(len(_json['payload']['items']), 2)
+
+        for i in range(8):
+            self.create_item("Large Catalog {0}".format(i), product_count=3, tag_names=("Sativa", "Hybrid"))
+
+        _json, large_count = self._get_products(headers)
+
+        self.assertEqual(len(_json['payload']['items']), 10)
+        self.assertEqual(small_count, large_count)
+
+    def test_store_products_payload_shape(self):
+        headers = self.auth_headers()
+
+        item = self.create_item("Super Silver Haze", product_count=2)
+        self.create_item("No Products", product_count=0)
+        self.create_item("Out Of Stock", stock=0)
+
+        _json, _ = self._get_products(headers)
+        items = _json['payload']['items']
+
+        self.assertEqual(list(items.keys()), [str(item.id)])
+
+        document = items[str(item.id)]
+        self.assertEqual(document['name'], "Super Silver Haze")
+        self.assertEqual([product['cost'] for product in document['products']], [10, 20])
+        self.assertEqual([tag['name'] for tag in document['tags']], ["Sativa"])
+        self.assertEqual(len(document['images']), 1)
+
+    def test_store_snapshot_cache(self):
+        from firepot import catalog
+        from firepot.models import Product
+
+        headers = self.auth_headers()
+        item = self.create_item("Super Silver Haze", product_count=1)
+
+        _json, _ = self._get_products(headers)
+        self.assertEqual(len(_json['payload']['items']), 1)
+
+        hits = catalog.snapshot_cache.hits
+        _json, query_count = self._get_products(headers)
+
+        self.assertEqual(query_count, 0)
+        self.assertEqual(catalog.snapshot_cache.hits, hits + 1)
+
+        version = catalog.catalog_version.value
+        Product(name="Super Silver Haze (7g)", item_id=item.id, cost=60).save(commit=True)
+        self.assertGreater(catalog.catalog_version.value, version)
+
+        _json, _ = self._get_products(headers)
+        self.assertEqual(len(_json['payload']['items'][str(item.id)]['products']), 2)
+
+        req = self.app.test_client().get('/store/item/{0}'.format(item.id), headers=headers)
+        self.assertEqual(json.loads(req.data)['payload']['item']['id'], item.id)
+
+        req = self.app.test_client().get('/store/item/{0}'.format(item.id + 1), headers=headers)
+        self.assertEqual(json.loads(req.data)['status'], 'error')
+
+    def test_lru_cache_eviction(self):
+        from firepot.cache import LRUCache
+
+        cache = LRUCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+
+        cache.set('c', 3)
+
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.stats()['evictions'], 1)
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+    def test_store_conditional_get(self):
+        from firepot.models import Product
+
+        headers = self.auth_headers()
+        item = self.create_item("Super Silver Haze", product_count=1)
+
+        req = self.app.test_client().get("/store/products", headers=headers)
+        etag = req.headers['ETag']
+
+        self.assertEqual(req.status_code, 200)
+        self.assertFalse(etag.startswith('W/'))
+
+        with count_queries(self.db) as counter:
+            req = self.app.test_client().get("/store/products", headers=dict(headers, **{'If-None-Match': etag}))
+
+        self.assertEqual(req.status_code, 304)
+        self.assertEqual(req.data, b'')
+        self.assertEqual(req.headers['ETag'], etag)
+        self.assertEqual(counter.count, 0)
+
+        Product(name="Super Silver Haze (7g)", item_id=item.id, cost=60).save(commit=True)
+
+        req = self.app.test_client().get("/store/products", headers=dict(headers, **{'If-None-Match': etag}))
+
+        self.assertEqual(req.status_code, 200)
+        self.assertNotEqual(req.headers['ETag'], etag)
+
+        item_url = '/store/item/{0}'.format(item.id)
+        etag = self.app.test_client().get(item_url, headers=headers).headers['ETag']
+        req = self.app.test_client().get(item_url, headers=dict(headers, **{'If-None-Match': etag}))
+
+        self.assertEqual(req.status_code, 304)
+
+    def _get_pages(self, url, headers, limit):
+        pages = []
+        cursor = None
+
+        while True:
+            query = '{0}?limit={1}'.format(url, limit) + ('&cursor={0}'.format(cursor) if cursor else '')
+            _json = json.loads(self.app.test_client().get(query, headers=headers).data)
+
+            self.assertEqual(_json['status'], 'success', _json['message'])
+            pages.append(_json['payload'])
+
+            cursor = _json['next_cursor']
+
+            if cursor is None:
+                return pages
+
+    def test_store_products_pagination(self):
+        headers = self.auth_headers()
+
+        item_ids = [self.create_item("Item {0}".format(i)).id for i in range(5)]
+        self.create_item("No Products", product_count=0)
+
+        pages = self._get_pages("/store/products", headers, limit=2)
+
+        self.assertEqual([len(page['items']) for page in pages], [2, 2, 1])
+        self.assertEqual([int(key) for page in pages for key in page['items']], item_ids)
+
+        _json = json.loads(self.app.test_client().get("/store/products", headers=headers).data)
+        self.assertNotIn('next_cursor', _json)
+        self.assertEqual(len(_json['payload']['items']), 5)
+
+        _json = json.loads(self.app.test_client().get("/store/products?cursor=bogus", headers=headers).data)
+        self.assertEqual(_json['status'], 'error')
+
+    def test_inventory_list_pagination(self):
+        headers = self.auth_headers(admin=True)
+
+        item_ids = [self.create_item("Item {0}".format(i), stock=i).id for i in range(5)]
+
+        pages = self._get_pages("/admin/inventory/list/", headers, limit=3)
+
+        self.assertEqual([item['id'] for page in pages for item in page], item_ids)
+        self.assertEqual(len(pages), 2)
+
+    def test_inventory_list_streamed(self):
+        from firepot import catalog
+
+        headers = self.auth_headers(admin=True)
+
+        item_ids = [self.create_item("Item {0}".format(i), product_count=i % 3).id for i in range(5)]
+
+        streamed = [(item.id, len(products)) for item, products in catalog.iter_catalog(False, batch_size=2)]
+        self.assertEqual(streamed, [(item_id, i % 3) for i, item_id in enumerate(item_ids)])
+
+        req = self.app.test_client().get("/admin/inventory/list/", headers=headers)
+
+        self.assertTrue(req.is_streamed)
+
+        _json = json.loads(req.data)
+
+        self.assertEqual(_json['status'], 'success')
+        self.assertEqual([item['id'] for item in _json['payload']], item_ids)
+        self.assertEqual([len(item['products']) for item in _json['payload']], [0, 1, 2, 0, 1])
+
+    def test_read_model_maintained_on_write(self):
+        from firepot.models import CatalogReadModel, Product
+
+        item = self.create_item("Super Silver Haze", product_count=2)
+        empty = self.create_item("No Products", product_count=0, stock=0)
+
+        row = CatalogReadModel.query.get(item.id)
+
+        self.assertTrue(row.in_stock)
+        self.assertTrue(row.for_sale)
+        self.assertEqual(row.min_price, 10)
+        self.assertEqual(len(json.loads(row.document)['products']), 2)
+
+        row = CatalogReadModel.query.get(empty.id)
+
+        self.assertFalse(row.in_stock)
+        self.assertFalse(row.for_sale)
+        self.assertIsNone(row.min_price)
+
+        product = Product.query.filter_by(item_id=item.id).order_by(Product.id).first()
+        product.update(sale_cost=5)
+        self.db.session.expire_all()
+
+        self.assertEqual(CatalogReadModel.query.get(item.id).min_price, 5)
+
+        item.update(stock=0)
+        self.db.session.expire_all()
+
+        self.assertFalse(CatalogReadModel.query.get(item.id).in_stock)
+
+        item.delete(commit=True)
+
+        self.assertIsNone(CatalogReadModel.query.get(item.id))
+
+    def test_rebuild_catalog_command(self):
+        from firepot.models import CatalogReadModel
+
+        item_ids = [self.create_item("Item {0}".format(i)).id for i in range(3)]
+
+        CatalogReadModel.query.delete()
+        self.db.session.commit()
+
+        result = self.app.test_cli_runner().invoke(args=['catalog', 'rebuild', '--batch-size', '2'])
+
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertEqual([row.item_id for row in CatalogReadModel.query.order_by(CatalogReadModel.item_id)],
+                         item_ids)
+
+        # Rows are refreshed in place rather than dropped first
+        CatalogReadModel.query.filter(CatalogReadModel.item_id == item_ids[0]).update({'document': '{}'})
+        self.db.session.commit()
+
+        result = self.app.test_cli_runner().invoke(args=['catalog', 'rebuild', '--batch-size', '2'])
+
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertNotEqual(CatalogReadModel.query.get(item_ids[0]).document, '{}')
+        self.assertEqual(CatalogReadModel.query.count(), len(item_ids))
+
+    def test_concurrent_read_model_refresh(self):
+        import threading
+        import time
+        from sqlalchemy.orm import Session
+        from firepot import catalog
+        from firepot.models import Item, CatalogReadModel
+
+        item_id = self.create_item("Blue Dream").id
+        errors = []
+
+        def refresh_other_session():
+            session = Session(bind=self.db.engine)
+
+            try:
+                catalog.refresh_read_model([item_id], session=session)
+                session.commit()
+            except Exception as e:
+                errors.append(e)
+                session.rollback()
+            finally:
+                session.close()
+
+        Item.query.filter(Item.id == item_id).update({'name': "Renamed Dream"}, synchronize_session='fetch')
+        catalog.refresh_read_model([item_id])
+
+        # The other refresh of the item runs while this one's transaction is still open
+        other = threading.Thread(target=refresh_other_session)
+        other.start()
+        time.sleep(0.2)
+
+        self.db.session.commit()
+        other.join(10)
+
+        self.assertEqual(errors, [])
+        self.assertEqual(json.loads(CatalogReadModel.query.get(item_id).document)['name'], "Renamed Dream")
+
+    def test_store_products_tag_filter(self):
+        from firepot import catalog
+
+        headers = self.auth_headers()
+
+        sativa = self.create_item("Sativa Item", tag_names=("Sativa",)).id
+        both = self.create_item("Hybrid Item", tag_names=("Sativa", "Indica")).id
+        indica = self.create_item("Indica Item", tag_names=("Indica",)).id
+        self.create_item("Sold Out", tag_names=("Sativa",), stock=0)
+
+        def tagged(query):
+            _json = json.loads(self.app.test_client().get("/store/products?" + query, headers=headers).data)
+            self.assertEqual(_json['status'], 'success', _json['message'])
+            return [int(item_id) for item_id in _json['payload']['items']]
+
+        self.assertEqual(tagged("tags=sativa"), [sativa, both])
+        self.assertEqual(tagged("tags=Sativa,Indica"), [sativa, both, indica])
+        self.assertEqual(tagged("tags=Sativa,Indica&match=all"), [both])
+        self.assertEqual(tagged("tags=Sativa,Unknown&match=all"), [])
+        self.assertEqual(tagged("tags=Sativa,Indica&limit=2"), [sativa, both])
+
+        _json = json.loads(self.app.test_client().get("/store/products?tags=a&match=some", headers=headers).data)
+        self.assertEqual(_json['status'], 'error')
+
+        with count_queries(self.db) as counter:
+            self.assertEqual(catalog.tag_index.lookup(["indica"]), [both, indica])
+
+        self.assertEqual(counter.count, 0)
+
+        self.assertEqual(catalog.tag_index.lookup(["sativa", "indica"], after_id=sativa, limit=1), [both])
+
+    def test_bitmaps(self):
+        from firepot.catalog import ids_bitmap, bitmap_ids
+
+        item_ids = [0, 7, 8, 9, 500, 100000]
+        bitmap = ids_bitmap(item_ids)
+
+        self.assertEqual(bitmap, sum(1 << item_id for item_id in item_ids))
+        self.assertEqual(bitmap_ids(bitmap), item_ids)
+        self.assertEqual(bitmap_ids(bitmap, after_id=8), [9, 500, 100000])
+        self.assertEqual(bitmap_ids(bitmap, after_id=-3, limit=2), [0, 7])
+        self.assertEqual(bitmap_ids(bitmap, after_id=7, limit=2), [8, 9])
+        self.assertEqual(bitmap_ids(ids_bitmap([])), [])
@@ -0,0 +1,117 @@
+import base64
+import os
+
+from tests import TestCase
+
+IMAGE_BYTES = b'\x89PNG\r\n\x1a\n' + bytes(range(256))
+IMAGE_DATA_URL = "data:image/png;base64," + base64.b64encode(IMAGE_BYTES).decode('ascii')
+
+
+class TestImages(TestCase):
+
+    def test_image_stored_in_blob_store(self):
+        from firepot.models import Image
+        from firepot.extensions import blob_store
+
+        image = Image(name="silver_haze_1", data=IMAGE_DATA_URL)
+        image.save(commit=True)
+
+        duplicate = Image(name="silver_haze_2", data=IMAGE_DATA_URL)
+        duplicate.save(commit=True)
+
+        self.assertEqual(image.blob_hash, duplicate.blob_hash)
+        self.assertEqual(image.content_type, "image/png")
+        self.assertEqual(image.size, len(IMAGE_BYTES))
+        self.assertIsNone(image.data)
+
+        with blob_store.open(image.blob_hash) as blob:
+            self.assertEqual(blob.read(), IMAGE_BYTES)
+
+        self.assertEqual(image.to_dict()['url'], "/images/{0}".format(image.blob_hash))
+        self.assertNotIn('data', image.to_dict())
+
+    def test_image_blob_endpoint(self):
+        from firepot.models import Image
+
+        image = Image(name="silver_haze_1", data=IMAGE_DATA_URL)
+        image.save(commit=True)
+
+        client = self.app.test_client()
+
+        req = client.get(image.url)
+
+        self.assertEqual(req.status_code, 200)
+        self.assertEqual(req.data, IMAGE_BYTES)
+        self.assertEqual(req.mimetype, "image/png")
+        self.assertIn('immutable', req.headers['Cache-Control'])
+        self.assertEqual(req.headers['X-Content-Type-Options'], "nosniff")
+
+        req = client.get(image.url, headers={'Range': 'bytes=8-15'})
+
+        self.assertEqual(req.status_code, 206)
+        self.assertEqual(req.data, IMAGE_BYTES[8:16])
+
+        req = client.get(image.url, headers={'If-None-Match': '"{0}"'.format(image.blob_hash)})
+
+        self.assertEqual(req.status_code, 304)
+
+        req = client.get("/images/{0}".format("0" * 64))
+
+        self.assertEqual(req.status_code, 404)
+
+    def test_image_content_type_checked(self):
+        from firepot import messages
+        from firepot.models import Image
+
+        # The type claimed by the client is ignored, the content decides it
+        image = Image(name="silver_haze_1", data="data:text/html;base64," + base64.b64encode(IMAGE_BYTES).decode())
+
+        self.assertEqual(image.content_type, "image/png")
+
+        headers = self.auth_headers(admin=True)
+        client = self.app.test_client()
+
+        for data in ("data:image/svg+xml;base64," + base64.b64encode(b'<svg onload="alert(1)"/>').decode(),
+                     "data:image/png;base64," + base64.b64encode(b'<html><script>alert(1)</script>').decode(),
+                     "<script>alert(1)</script>"):
+            req = client.post("/admin/images/save", json=dict(name="silver_haze_2", data=data), headers=headers)
+
+            self.assertEqual(req.get_json()['message'], messages.UNSUPPORTED_IMAGE)
+
+        self.assertIsNone(Image.query.filter_by(name="silver_haze_2").first())
+
+        req = client.post("/admin/images/save", json=dict(name="silver_haze_2", data=IMAGE_DATA_URL), headers=headers)
+
+        self.assertEqual(req.get_json()['message'], messages.IMAGE_SAVED)
+
+    def test_legacy_image_content_type_not_served(self):
+        from firepot.models import Image
+
+        image = Image(name="silver_haze_1", data=IMAGE_DATA_URL)
+        image.save(commit=True)
+
+        Image.query.filter_by(id=image.id).update({'content_type': "text/html"})
+        self.db.session.commit()
+
+        req = self.app.test_client().get(image.url)
+
+        self.assertEqual(req.mimetype, "application/octet-stream")
+        self.assertEqual(req.headers['X-Content-Type-Options'], "nosniff")
+
+    def test_migrate_images_command(self):
+        from firepot.models import Image
+        from firepot.extensions import blob_store
+
+        self.db.session.execute(Image.__table__.insert().values(name="legacy_1",
+                                                                data=base64.b64encode(IMAGE_BYTES).decode()))
+        self.db.session.commit()
+
+        result = self.app.test_cli_runner().invoke(args=['images', 'migrate'])
+
+        self.assertEqual(result.exit_code, 0, result.output)
+
+        image = Image.query.filter_by(name="legacy_1").first()
+
+        self.assertIsNotNone(image.blob_hash)
+        self.assertIsNone(image.data)
+        self.assertTrue(os.path.exists(blob_store.path(image.blob_hash)))
@@ -0,0 +1,133 @@
+import datetime
+import json
+
+from tests import TestCase
+
+
+class TestJobs(TestCase):
+
+    def setUp(self):
+        super(TestJobs, self).setUp()
+
+        from firepot import jobs
+
+        self.calls = []
+        self.failures = 0
+
+        @jobs.handler("test_job")
+        def test_job(value):
+            if self.failures > 0:
+                self.failures -= 1
+                raise RuntimeError("failing on purpose")
+
+            self.calls.append(value)
+
+    def tearDown(self):
+        from firepot import jobs
+
+        jobs.handlers.pop("test_job", None)
+        super(TestJobs, self).tearDown()
+
+    def test_checkout_enqueues_confirmation(self):
+        from firepot import jobs
+        from firepot.models import Job
+
+        product = self.create_item("Blue Dream", product_count=1).products.first()
+        headers = self.auth_headers()
+        client = self.app.test_client()
+
+        client.post("/cart/add/", headers=headers, json={'items': [{'product_id': product.id, 'amount': 2}]})
+        order_id = json.loads(client.post("/cart/checkout/", headers=headers).data)['payload']['id']
+
+        job = Job.query.one()
+
+        self.assertEqual((job.name, json.loads(job.arguments)), (jobs.ORDER_CONFIRMATION, {'order_id': order_id}))
+
+        with self.assertLogs('firepot.jobs', level='INFO') as logs:
+            self.assertEqual(jobs.queue.run_all(), 1)
+
+        self.assertIn("2 x Blue Dream Blue Dream (1g) at 10", logs.output[0])
+        self.assertEqual(Job.query.count(), 0)
+
+    def test_rolled_back_jobs_are_dropped(self):
+        from firepot import jobs
+        from firepot.models import Job
+
+        jobs.enqueue("test_job", value=1)
+        self.db.session.rollback()
+
+        self.assertEqual(Job.query.count(), 0)
+        self.assertEqual(jobs.queue.run_all(), 0)
+
+        with self.assertRaises(ValueError):
+            jobs.enqueue("unknown_job")
+
+    def test_failing_job_is_retried_with_backoff(self):
+        from firepot import jobs
+        from firepot.models import Job
+
+        jobs.enqueue("test_job", value=1)
+        self.db.session.commit()
+
+        self.failures = jobs.queue.max_attempts - 1
+
+        for attempt in range(1, jobs.queue.max_attempts):
+            self.assertEqual(jobs.queue.run_pending(), 1)
+
+            job = Job.query.one()
+            delay = (job.run_at - datetime.datetime.utcnow()).total_seconds()
+
+            self.assertEqual(job.attempts, attempt)
+            self.assertAlmostEqual(delay, jobs.queue.retry_delay * 2 ** (attempt - 1), delta=5)
+            self.assertIn("failing on purpose", job.last_error)
+
+            # Not due before its backoff is over.
+            self.assertEqual(jobs.queue.run_pending(), 0)
+
+            job.run_at = datetime.datetime.utcnow()
+            self.db.session.commit()
+
+        self.assertEqual(jobs.queue.run_pending(), 1)
+        self.assertEqual(self.calls, [1])
+        self.assertEqual(Job.query.count(), 0)
+
+    def test_failing_job_gives_up(self):
+        from firepot import jobs
+        from firepot.models import Job
+
+        jobs.enqueue("test_job", value=1)
+        self.db.session.commit()
+
+        self.failures = jobs.queue.max_attempts
+
+        for attempt in range(jobs.queue.max_attempts):
+            Job.query.update({Job.run_at: datetime.datetime.utcnow()})
+            self.db.session.commit()
+
+            jobs.queue.run_pending()
+
+        job = Job.query.one()
+
+        self.assertEqual((job.status, job.attempts), (Job.STATUS_FAILED, jobs.queue.max_attempts))
+        self.assertEqual(jobs.queue.stats()['failed_jobs'], 1)
+        self.assertEqual(self.calls, [])
+
+    def test_worker_threads_run_committed_jobs(self):
+        from firepot import jobs
+
+        jobs.queue.workers = 1
+
+        try:
+            jobs.enqueue("test_job", value=2)
+            self.db.session.commit()
+
+            for i in range(100):
+                if self.calls:
+                    break
+
+                jobs.queue._stopping.wait(0.05)
+        finally:
+            jobs.queue.stop(timeout=5)
+            jobs.queue.workers = 0
+
+        self.assertEqual(self.calls, [2])
@@ -1,4 +1,6 @@
-from tests import TestCase
+import datetime
+
+from tests import TestCase, count_queries, IMAGE_DATA
 
 
 class TestModels(TestCase):
@@ -51,7 +53,7 @@ class TestModels(TestCase):
     def test_item_product_cart(self):
         from firepot.models import Item, Image, Tag, Product, User
 
-        item_image = Image(name="silver_haze_1", data="test_data")
+        item_image = Image(name="silver_haze_1", data=IMAGE_DATA)
         item_image.save(commit=True)
 
         item_image_search = Image.query.filter_by(name="silver_haze_1").first()
@@ -92,3 +94,38 @@ class TestModels(TestCase):
 
         self.assertEqual(len(user.cart_items),0)
         self.assertIsNotNone(Order.query.filter_by(user_id=user.id).first())
+
+    def test_save_cart_as_order(self):
+        from firepot.models import User, CartItem, Order, OrderItem
+
+        user = User(first_name="i", last_name="g", email="test@firepot.ca", phone_number="7090000000",
+                    password="testing", birth_date=datetime.datetime(1990, 1, 1))
+        user.save(commit=True)
+
+        products = []
+
+        for name in ("Silver Haze", "Blue Dream", "Pink Kush"):
+            products.extend(self.create_item(name, product_count=2, stock=100).products.all())
+
+        for amount, product in enumerate(products, start=1):
+            CartItem(user_id=user.id, product_id=product.id, amount=amount).save(commit=False)
+
+        self.db.session.commit()
+        user_id = user.id
+
+        with count_queries(self.db) as counter:
+            order = user.save_cart_as_order()
+
+        # Cart, one stock reservation per item, order, order lines, cart deletion and confirmation job.
+        self.assertEqual(counter.count, 8)
+
+        self.assertEqual(CartItem.query.filter_by(user_id=user_id).count(), 0)
+        self.assertEqual(Order.query.filter_by(user_id=user_id).count(), 1)
+
+        lines = OrderItem.query.filter_by(order_id=order.id).order_by(OrderItem.product_id).all()
+
+        self.assertEqual(len(lines), len(products))
+        self.assertEqual([(line.name, line.amount, line.price) for line in lines[:2]],
+                         [("Silver Haze Silver Haze (1g)", 1, 10), ("Silver Haze Silver Haze (2g)", 2, 20)])
+
+        self.assertIsNone(user.save_cart_as_order())
@@ -1,6 +1,6 @@
 from firepot.models import User
 from firepot import messages
-from tests import TestCase
+from tests import TestCase, IMAGE_DATA
 
 import json
 import random
@@ -106,7 +106,7 @@ class TestApplicationRoutes(TestCase):
 
         self.assertEqual(_json['message'], "Currently no stock available")
 
-        silver_haze_img = Image(name="silver_haze_1", data="Base64 of super silver haze bb")
+        silver_haze_img = Image(name="silver_haze_1", data=IMAGE_DATA)
         silver_haze_img.save(commit=True)
 
         self.assertIsNotNone(Image.query.filter_by(name="silver_haze_1").first())
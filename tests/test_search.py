@@ -0,0 +1,57 @@
+import json
+
+from tests import TestCase
+
+
+class TestSearch(TestCase):
+
+    def _search(self, headers, query):
+        _json = json.loads(self.app.test_client().get("/store/search?" + query, headers=headers).data)
+        self.assertEqual(_json['status'], 'success', _json['message'])
+        return _json
+
+    def test_store_search_ranked(self):
+        headers = self.auth_headers()
+
+        in_name = self.create_item("Super Lemon Haze", tag_names=("Sativa",)).id
+        in_tags = self.create_item("Jack Herer", tag_names=("Lemon",)).id
+        in_description = self.create_item("Blue Dream", tag_names=("Hybrid",)).id
+        self.create_item("Sold Out Lemon", stock=0)
+
+        from firepot.models import Item
+        Item.query.get(in_description).update(description="Sweet berry with a lemon finish")
+
+        _json = self._search(headers, "q=lemon")
+        results = [result['item']['id'] for result in _json['payload']['results']]
+
+        self.assertEqual(results, [in_name, in_tags, in_description])
+        self.assertIsNone(_json['next_cursor'])
+
+        _json = self._search(headers, "q=lemon&limit=2")
+        self.assertEqual(len(_json['payload']['results']), 2)
+
+        _json = self._search(headers, "q=lemon&limit=2&cursor=" + _json['next_cursor'])
+        self.assertEqual([result['item']['id'] for result in _json['payload']['results']], [in_description])
+
+        self.assertEqual(self._search(headers, "q=kush")['payload']['results'], [])
+
+        _json = json.loads(self.app.test_client().get("/store/search?q=", headers=headers).data)
+        self.assertEqual(_json['status'], 'error')
+
+        from firepot.utils import encode_cursor
+
+        for offset in (-5, 10 ** 20):
+            req = self.app.test_client().get("/store/search?q=lemon&cursor=" + encode_cursor(offset), headers=headers)
+
+            self.assertEqual(req.status_code, 200)
+            self.assertEqual(json.loads(req.data)['message'], "Invalid cursor")
+
+    def test_trigram_search(self):
+        from firepot.search import trigram_index
+
+        haze = self.create_item("Super Silver Haze").id
+        dream = self.create_item("Blue Dream").id
+
+        self.assertEqual([item_id for item_id, score in trigram_index.search("silver haze")], [haze])
+        self.assertEqual([item_id for item_id, score in trigram_index.search("blue dreem")], [dream])
+        self.assertEqual(trigram_index.search("kush"), [])
@@ -0,0 +1,32 @@
+import decimal
+import json
+
+from tests import TestCase
+
+
+class TestSerializers(TestCase):
+
+    def test_item_serializer(self):
+        from firepot import serializers
+
+        item = self.create_item("Blue Dream", product_count=2, tag_names=("Sativa", "Hybrid"))
+
+        document = serializers.ITEM.serialize(item)
+
+        self.assertEqual(list(document.keys()),
+                         ['id', 'name', 'description', 'cover_image_id', 'images', 'tags', 'products'])
+        self.assertEqual(document['name'], "Blue Dream")
+        self.assertEqual(sorted(tag['name'] for tag in document['tags']), ["Hybrid", "Sativa"])
+        self.assertEqual(len(document['products']), 2)
+        self.assertEqual(item.to_dict(), document)
+
+        document = serializers.ITEM.serialize(item, products=item.products[:1])
+
+        self.assertEqual(len(document['products']), 1)
+
+    def test_dumps(self):
+        from firepot import serializers
+
+        value = {"cost": decimal.Decimal("10.50"), 1: [None, True]}
+
+        self.assertEqual(json.loads(serializers.dumps(value)), {"cost": "10.50", "1": [None, True]})
@@ -0,0 +1,95 @@
+import json
+import os
+import tempfile
+
+from tests import TestCase, count_queries
+
+USERS_CSV = """first_name,last_name,email,phone_number,password,birth_date
+Alice,A,alice@firepot.ca,7091000001,alice-pw,1990-01-01
+Bob,B,bob@firepot.ca,7091000002,bob-pw,1991-02-03
+Carol,C,ALICE@firepot.ca,7091000003,carol-pw,1992-03-04
+Dave,D,dave@firepot.ca,7091000002,dave-pw,1993-04-05
+Erin,E,erin@firepot.ca,7091000005,,1994-05-06
+Frank,F,user@firepot.ca,7091000006,frank-pw,1995-06-07
+Gina,G,gina@firepot.ca,7091000007,gina-pw,not-a-date
+"""
+
+
+class TestUsers(TestCase):
+
+    def test_import_users_command(self):
+        from firepot.models import User
+
+        self.auth_headers(email="user@firepot.ca")
+
+        folder = tempfile.mkdtemp()
+        source = os.path.join(folder, "users.csv")
+        errors = os.path.join(folder, "errors.jsonl")
+
+        with open(source, 'w') as users_file:
+            users_file.write(USERS_CSV)
+
+        result = self.app.test_cli_runner().invoke(args=['users', 'import', source, '--errors', errors,
+                                                         '--batch-size', '1', '--workers', '2'])
+
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("2 of 7 rows imported", result.output)
+
+        alice = User.query.filter_by(email="alice@firepot.ca").first()
+
+        self.assertTrue(alice.check_password("alice-pw"))
+        self.assertFalse(alice.password_needs_rehash())
+        self.assertIsNotNone(User.query.filter_by(email="bob@firepot.ca").first())
+
+        with open(errors) as errors_file:
+            skipped = [json.loads(line) for line in errors_file]
+
+        self.assertEqual([(row['line'], row['error']) for row in skipped], [
+            (4, "Duplicate email"),
+            (5, "Duplicate phone_number"),
+            (6, "Missing password"),
+            (7, "Duplicate email"),
+            (8, "Invalid birth_date"),
+        ])
+
+    def test_orders_history(self):
+        from firepot.models import User, Order, OrderItem
+
+        headers = self.auth_headers()
+        user = User.query.filter_by(email="user@firepot.ca").first()
+        product = self.create_item("Blue Dream", product_count=1).products.first()
+
+        for i in range(5):
+            order = Order(user.id)
+            order.save(commit=True)
+
+            OrderItem(order.id, product.id, "Blue Dream (1g)", i + 1, 10).save(commit=True)
+
+        client = self.app.test_client()
+
+        with count_queries(self.db) as counter:
+            req = client.get("/user/orders?limit=2", headers=headers)
+
+        # The page of orders and their lines.
+        self.assertEqual(counter.count, 2)
+
+        data = json.loads(req.data)
+        amounts = [[line['amount'] for line in order['items']] for order in data['payload']]
+
+        self.assertEqual(amounts, [[5], [4]])
+        self.assertEqual([order['total'] for order in data['payload']], [50, 40])
+
+        # Only computed when asked for.
+        self.assertNotIn("sum(", str(Order.query.statement).lower())
+
+        pages = [data]
+
+        while pages[-1]['next_cursor'] is not None:
+            req = client.get("/user/orders?limit=2&cursor={0}".format(pages[-1]['next_cursor']), headers=headers)
+            pages.append(json.loads(req.data))
+
+        self.assertEqual([len(page['payload']) for page in pages], [2, 2, 1])
+
+        other = self.auth_headers(email="other@firepot.ca", phone_number="7090000001")
+
+        self.assertEqual(json.loads(client.get("/user/orders", headers=other).data)['payload'], [])